@@ -0,0 +1,100 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# --- ゲーム終了後の分析（評価・要約）のバックグラウンド実行 ---
+# 評価の生成には数十秒かかることがあり、その間はスクリプトが止まって画面を移動できなかった。
+# 分析をユーザー・セッションIDごとのジョブとしてワーカーで実行し、画面は状態を読んで表示するだけにする。
+# ジョブはプロセス内で共有するので、ホームに戻ったり別の章を始めたりしても、結果は後から受け取れる。
+
+MAX_JOBS_PER_USER = 10  # 完了したジョブはユーザーごとにこの件数だけ残す
+
+
+class AnalysisJob:
+    """1回のプレイの分析。steps の各手順を並行して実行し、結果を results に入れる"""
+
+    def __init__(self, username, session_id, chapter, steps):
+        self.username = username
+        self.session_id = session_id
+        self.chapter = chapter
+        self.steps = steps        # {手順名: 関数}
+        self.results = {}         # {手順名: 結果}（成功したものだけ）
+        self.errors = {}          # {手順名: 例外}
+        self.running = set()      # 実行中の手順名
+        self.delivered = False    # 結果を画面側（履歴のキャッシュなど）に反映したか
+
+    @property
+    def status(self):
+        """"running" / "failed" / "done" """
+        if self.running:
+            return "running"
+        return "failed" if self.errors else "done"
+
+
+class AnalysisJobs:
+    """ユーザーごとの分析ジョブと、それを実行するワーカー"""
+
+    def __init__(self, max_workers=4):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="post-game-analysis")
+        self._lock = threading.Lock()
+        self._jobs = {}  # {username: [AnalysisJob]}（古い順）
+
+    def for_user(self, username):
+        with self._lock:
+            return list(self._jobs.get(username, []))
+
+    def submit(self, username, session_id, chapter, steps):
+        """同じセッションのジョブがあればそれを返す（失敗した手順だけをやり直す）。なければ新しく始める"""
+        with self._lock:
+            jobs = self._jobs.setdefault(username, [])
+            job = next((j for j in jobs if j.session_id == session_id), None)
+            if job is None:
+                job = AnalysisJob(username, session_id, chapter, steps)
+                jobs.append(job)
+                # 完了して反映済みの古いジョブから捨てる
+                while len(jobs) > MAX_JOBS_PER_USER and jobs[0].status != "running" and jobs[0].delivered:
+                    jobs.pop(0)
+            pending = [name for name in job.steps if name not in job.results and name not in job.running]
+            for name in pending:
+                job.errors.pop(name, None)
+                job.running.add(name)
+        for name in pending:
+            self._executor.submit(self._run, job, name)
+        return job
+
+    def _run(self, job, name):
+        try:
+            result = job.steps[name]()
+        except Exception as e:
+            logger.warning("post-game analysis step failed: user=%s session=%s step=%s",
+                           job.username, job.session_id, name, exc_info=True)
+            with self._lock:
+                job.errors[name] = e
+                job.running.discard(name)
+            return
+        with self._lock:
+            job.results[name] = result
+            job.running.discard(name)
+
+    def take_results(self, username, step):
+        """その手順が終わっていて、まだ画面側に反映していないジョブを返し、反映済みにする"""
+        with self._lock:
+            jobs = [job for job in self._jobs.get(username, []) if step in job.results and not job.delivered]
+            for job in jobs:
+                job.delivered = True
+            return jobs
+
+
+_jobs = None
+_jobs_lock = threading.Lock()
+
+
+def get_analysis_jobs(max_workers=4):
+    """プロセス内で共有する AnalysisJobs"""
+    global _jobs
+    with _jobs_lock:
+        if _jobs is None:
+            _jobs = AnalysisJobs(max_workers)
+        return _jobs
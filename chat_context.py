@@ -0,0 +1,119 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from llm_client import create
+
+logger = logging.getLogger(__name__)
+
+# --- 会話AIに送る文脈の上限 ---
+# 送信のたびに会話全体を messages に積み直していたため、ターンが進むほど入力トークンと待ち時間が増えていた。
+# システムプロンプトと直近 N 往復はそのまま送り、それより前の発言は要約（1つの system メッセージ）にまとめる。
+# 要約は、要約に含まれていない古い発言がたまるたびに、前回の要約に追記する形で裏で更新する。
+# 要約が追いつくまでの古い発言はそのまま送るので、文脈が欠けることはない。
+
+FOLD_STEP = 4  # 要約に含まれていない古い発言がこの数たまったら要約を更新する
+
+SUMMARY_PROMPT = """
+    あなたは日本語学習ゲームの会話を記録する係です。
+    [これまでの要約]に[新しいやり取り]の内容を加えて、要約を更新してください。
+    登場人物が会話を自然に続けるために必要な事実（プレイヤーが伝えた情報、決まったこと、まだ答えていない質問）だけを、
+    短い箇条書きで残してください。出力は更新した要約だけにしてください。
+
+    [これまでの要約]
+    {summary}
+
+    [新しいやり取り]
+    {exchanges}
+"""
+
+ROLE_LABELS = {"user": "プレイヤー", "assistant": "AI"}
+
+
+def estimate_tokens(text):
+    """トークン数の目安。ASCII は4文字で1トークン、それ以外（日本語など）は1文字1トークンとして数える"""
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+def messages_tokens(messages):
+    return sum(estimate_tokens(m["content"]) + 4 for m in messages)  # 4 はメッセージごとの区切りの分
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="chat-context")
+        return _executor
+
+
+class ChatContext:
+    """1回のプレイの要約と、要約に含めた発言の数"""
+
+    def __init__(self, session_id, keep_exchanges=6, summary_tokens=300):
+        self.session_id = session_id
+        self.keep_exchanges = keep_exchanges
+        self.summary_tokens = summary_tokens
+        self.summary = ""
+        self.summarized = 0    # 要約に含めた発言の数（履歴の先頭から）
+        self._pending = False  # 要約の更新を実行中か
+        self._lock = threading.Lock()
+
+    def fit(self, client, messages):
+        """
+        [system, 履歴..., 今回の入力] の messages を、system・要約・要約に含まれていない発言・今回の入力にする。
+        (送る messages, 節約したトークン数の目安) を返す
+        """
+        system, history, current = messages[0], messages[1:-1], messages[-1]
+        older = max(0, len(history) - 2 * self.keep_exchanges)
+        with self._lock:
+            summary, summarized = self.summary, min(self.summarized, older)
+        fitted = [system]
+        if summary and summarized:
+            fitted.append({"role": "system", "content": "[これまでの会話の要約]\n" + summary})
+        fitted += history[summarized:] + [current]
+
+        full_tokens, sent_tokens = messages_tokens(messages), messages_tokens(fitted)
+        logger.info("chat context: session=%s full=%d sent=%d saved=%d",
+                    self.session_id, full_tokens, sent_tokens, full_tokens - sent_tokens)
+        self._schedule_fold(client, history, older)
+        return fitted, full_tokens - sent_tokens
+
+    def _schedule_fold(self, client, history, older):
+        with self._lock:
+            if self._pending or older - self.summarized < FOLD_STEP:
+                return
+            self._pending = True
+            start, summary = self.summarized, self.summary
+        _get_executor().submit(self._fold, client, summary, history[start:older], older)
+
+    def _fold(self, client, summary, exchanges, upto):
+        try:
+            text = "\n".join(f"{ROLE_LABELS.get(m['role'], m['role'])}: {m['content']}" for m in exchanges)
+            response = create(
+                client, "context_summary",
+                [{"role": "system", "content": SUMMARY_PROMPT.format(summary=summary or "（なし）", exchanges=text)}],
+                max_tokens=self.summary_tokens,
+            )
+            new_summary = response.choices[0].message.content.strip()
+            with self._lock:
+                self.summary, self.summarized = new_summary, upto
+        except Exception:
+            # 要約に失敗しても、古い発言をそのまま送り続けるだけなので、次の機会にやり直す
+            logger.warning("chat context summary failed: session=%s", self.session_id, exc_info=True)
+        finally:
+            with self._lock:
+                self._pending = False
+
+
+def get_chat_context(state, session_id, keep_exchanges=6, summary_tokens=300):
+    """st.session_state に保持している ChatContext を返す（プレイが変わったら作り直す）"""
+    context = state.get("chat_context")
+    if context is None or context.session_id != session_id:
+        context = ChatContext(session_id, keep_exchanges, summary_tokens)
+        state["chat_context"] = context
+    return context
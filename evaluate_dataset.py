@@ -1,6 +1,7 @@
 import re
 import os
 from openai import OpenAI
+from llm_client import complete
 
 def preprocess_line(line):
     """
@@ -65,18 +66,21 @@ def get_evaluation(client, conversation_log):
 {conversation_log}
 """
 
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": evaluation_prompt},
-                {"role": "user", "content": eval_user_content}
-            ],
-            temperature=0,
-        )
-        return response.choices[0].message.content
-    except Exception as e:
-        return f"--- ERROR ---\nAn error occurred: {e}\n--- END ERROR ---"
+    # 失敗しても他のチャンクの評価は続けられるように、例外にせず結果で受け取る（長い実行なので多めに再試行する）
+    # チャンクごとに評価のモデルが変わらないよう、代わりのモデルは使わない
+    result = complete(
+        client, "evaluate",
+        [
+            {"role": "system", "content": evaluation_prompt},
+            {"role": "user", "content": eval_user_content}
+        ],
+        temperature=0,
+        retries=6,
+        fallbacks=[],
+    )
+    if not result.ok:
+        return f"--- ERROR ---\nAn error occurred: {result.error}\n--- END ERROR ---"
+    return result.text
 
 def main():
     # --- List of input files ---
@@ -1,7 +1,8 @@
 import os
 from openai import OpenAI
-import re
+from llm_client import LLMError, create
 import csv
+from scores import SCORE_FIELDS, parse_scores
 import time
 
 # --- 初期設定 ---
@@ -17,53 +18,36 @@ client = OpenAI(api_key=api_key)
 output_dir = r"C:\Users\salmi\web\evaluation_results"
 os.makedirs(output_dir, exist_ok=True)
 
+# 150 回近い会話を続けて回すので、アプリより多めに再試行する（1回の 429 で実行全体が止まらないように）
+HARNESS_RETRIES = 6
+# 結果を比べる実行なので、途中で別のモデルに切り替わらないよう代わりのモデルは使わない（失敗したらそこで止める）
+HARNESS_FALLBACKS = []
+
 # --- AIエージェント定義 ---
 def chat_with_gpt(messages):
-    completion = client.chat.completions.create(
-        model="gpt-4o",
-        messages=messages,
-        temperature=0.7
-    )
+    completion = create(client, "dialog", messages, temperature=0.7, retries=HARNESS_RETRIES, fallbacks=HARNESS_FALLBACKS)
     return completion.choices[0].message.content
 
 def demo_play(messages):
-    completion = client.chat.completions.create(
-        model="gpt-4o",
-        messages=messages,
-        temperature=0
-    )
+    completion = create(client, "demo_player", messages, temperature=0, retries=HARNESS_RETRIES, fallbacks=HARNESS_FALLBACKS)
     return completion.choices[0].message.content
 
 def evaluation_with_gpt(messages):
-    completion = client.chat.completions.create(
-        model="gpt-4o",
-        messages=messages,
-        temperature=0
-    )
+    completion = create(client, "evaluate", messages, temperature=0, retries=HARNESS_RETRIES, fallbacks=HARNESS_FALLBACKS)
     return completion.choices[0].message.content
 
 def extract_scores(evaluation_text):
     """
     評価テキストから3つのスコア（文法、表現の自然さ、論理性）と平均点を抽出する。
     """
-    # マークダウンの太字(**)を削除して、揺れを吸収しやすくする
-    cleaned_text = evaluation_text.replace('**', '')
-    
-    # コロンは全角・半角の両方を許容し、スペースの有無も考慮する
-    scores = re.findall(r"スコア\s*[:：]\s*(\d{1,3})/100", cleaned_text)
-    
-    if len(scores) == 3:
-        try:
-            grammar = int(scores[0])
-            naturalness = int(scores[1])
-            logic = int(scores[2])
-            average = (grammar + naturalness + logic) / 3
-            return grammar, naturalness, logic, f"{average:.2f}"
-        except (ValueError, IndexError):
-            # スコアの変換に失敗した場合
-            return 0, 0, 0, "0.00"
-    # スコアが3つ見つからなかった場合
-    return 0, 0, 0, "0.00"
+    # 観点別スコアの取り出しはアプリの評価保存時と同じ parse_scores を使う
+    scores = parse_scores(evaluation_text)
+    if None in scores.values():
+        # スコアが3つ見つからなかった場合
+        return 0, 0, 0, "0.00"
+    grammar, naturalness, logic = (scores[field] for field in SCORE_FIELDS)
+    average = (grammar + naturalness + logic) / 3
+    return grammar, naturalness, logic, f"{average:.2f}"
 
 # --- プロンプト定義 (test_Game.py の初期バージョン) ---
 player_demo_prompt = """
@@ -355,53 +339,59 @@ def run_evaluation():
             print(f"\n[反復訓練 ({ITERATION_COUNT}回)]")
             for test in range(ITERATION_COUNT):
                 print(f"\n--- 反復訓練: {test + 1}/{ITERATION_COUNT} ---")
-                prompt = base_prompt + selected_story_prompt + end_prompt
-                messages1 = [{"role": "system", "content": prompt}]
+                training_length = len(messages2_training)
+                try:
+                    prompt = base_prompt + selected_story_prompt + end_prompt
+                    messages1 = [{"role": "system", "content": prompt}]
                 
-                memory = ""
-                cnt = 0
-                while True:
-                    if cnt >= TURN_LIMIT: 
-                        print(f"会話が{TURN_LIMIT}ターンに達したため、強制的に終了します。")
-                        break
+                    memory = ""
+                    cnt = 0
+                    while True:
+                        if cnt >= TURN_LIMIT: 
+                            print(f"会話が{TURN_LIMIT}ターンに達したため、強制的に終了します。")
+                            break
                     
-                    response2 = demo_play(messages2_training)
-                    print(f"仮想プレイヤー: {response2}\n")
-                    messages1.append({"role": "user", "content": response2})
-                    messages2_training.append({"role": "assistant", "content": response2})
+                        response2 = demo_play(messages2_training)
+                        print(f"仮想プレイヤー: {response2}\n")
+                        messages1.append({"role": "user", "content": response2})
+                        messages2_training.append({"role": "assistant", "content": response2})
                     
-                    response1 = chat_with_gpt(messages1)
-                    print(f"会話用エージェント: {response1}\n")
+                        response1 = chat_with_gpt(messages1)
+                        print(f"会話用エージェント: {response1}\n")
                     
-                    if "ミッション達成" in response1 or "ミッション失敗" in response1:
-                        print("ミッションが終了しました。評価に移行します。")
-                        break
+                        if "ミッション達成" in response1 or "ミッション失敗" in response1:
+                            print("ミッションが終了しました。評価に移行します。")
+                            break
                         
-                    messages1.append({"role": "assistant", "content": response1})
-                    messages2_training.append({"role": "user", "content": response1})
-                    memory += f"プレイヤー：{response2}\nエージェント：{response1}\n"
-                    cnt += 1
-
-                # --- 評価とフィードバックの生成 ---
-                eval_content = evaluation_prompt + f"\n**[評価対象の会話ログ]**\n{memory}"
-                response_feedback = evaluation_with_gpt([{"role": "system", "content": eval_content}])
+                        messages1.append({"role": "assistant", "content": response1})
+                        messages2_training.append({"role": "user", "content": response1})
+                        memory += f"プレイヤー：{response2}\nエージェント：{response1}\n"
+                        cnt += 1
+
+                    # --- 評価とフィードバックの生成 ---
+                    eval_content = evaluation_prompt + f"\n**[評価対象の会話ログ]**\n{memory}"
+                    response_feedback = evaluation_with_gpt([{"role": "system", "content": eval_content}])
                 
-                # --- 詳細ログのファイル追記 ---
-                output_filename = os.path.join(output_dir, f"{persona_id}_evaluation_log.txt")
-                with open(output_filename, "a", encoding="utf-8") as f:
-                    f.write(f"--- Persona: {persona_id}, Chapter: {chapter}, Iteration: {test + 1} ---\n")
-                    f.write(f"[会話ログ]\n{memory}\n---\n[評価・フィードバック]\n{response_feedback}\n\n")
-
-                # --- スコアを抽出し、CSVに追記 ---
-                grammar, naturalness, logic, avg = extract_scores(response_feedback)
-                with open(summary_file_path, 'a', newline='', encoding='utf-8') as f:
-                    writer = csv.writer(f)
-                    writer.writerow([persona_id, chapter, test + 1, grammar, naturalness, logic, avg])
-
-                # --- 次の反復のためにフィードバックを仮想プレイヤーに与える ---
-                feedback_for_player = f"今回のシミュレーションは終了しました。以下のフィードバックをもとに改善してください。\nFB：{response_feedback}\nこの反省を活かして、もう一度最初から同じシチュエーションでの会話を始めてください。"
-                messages2_training.append({"role": "system", "content": feedback_for_player})
-            
+                    # --- 詳細ログのファイル追記 ---
+                    output_filename = os.path.join(output_dir, f"{persona_id}_evaluation_log.txt")
+                    with open(output_filename, "a", encoding="utf-8") as f:
+                        f.write(f"--- Persona: {persona_id}, Chapter: {chapter}, Iteration: {test + 1} ---\n")
+                        f.write(f"[会話ログ]\n{memory}\n---\n[評価・フィードバック]\n{response_feedback}\n\n")
+
+                    # --- スコアを抽出し、CSVに追記 ---
+                    grammar, naturalness, logic, avg = extract_scores(response_feedback)
+                    with open(summary_file_path, 'a', newline='', encoding='utf-8') as f:
+                        writer = csv.writer(f)
+                        writer.writerow([persona_id, chapter, test + 1, grammar, naturalness, logic, avg])
+
+                    # --- 次の反復のためにフィードバックを仮想プレイヤーに与える ---
+                    feedback_for_player = f"今回のシミュレーションは終了しました。以下のフィードバックをもとに改善してください。\nFB：{response_feedback}\nこの反省を活かして、もう一度最初から同じシチュエーションでの会話を始めてください。"
+                    messages2_training.append({"role": "system", "content": feedback_for_player})
+                except LLMError as e:
+                    # 再試行しても応答が得られなかった回は記録せず、仮想プレイヤーの記憶も戻して次の回に進む
+                    del messages2_training[training_length:]
+                    print(f"エラー: {e.site} の呼び出しに失敗しました（{e.kind}, model={e.model}, {e.attempts}回試行）。この回をスキップします。")
+
             print(f"--- シチュエーション Chapter {chapter} のテストが完了 ---")
 
         print(f"--- ペルソナ '{persona_id}' のテストが完了 ---\n")
@@ -1,6 +1,7 @@
 import os
 import re
 import csv
+from scores import SCORE_FIELDS, parse_scores
 
 # --- 設定 ---
 # ★パーソナライズ版の評価結果フォルダを指定
@@ -9,14 +10,6 @@ results_dir = r"C:\Users\salmi\web\evaluation_results_personalized"
 # ★パーソナライズ版の出力CSVファイルを指定
 output_csv_path = r"C:\Users\salmi\web\personalized_score_summary.csv"
 
-def parse_score(text, category_name):
-    """指定されたカテゴリのスコアを正規表現で抽出する"""
-    pattern = re.compile(f"###\s*\d+\.?\s*{category_name}.*?^\*\*スコア:\*\*\s*(\d+)/100", re.MULTILINE | re.DOTALL)
-    match = pattern.search(text)
-    if match:
-        return match.group(1)
-    return "N/A"
-
 def parse_filename_personalized(filename):
     """パーソナライズ版のファイル名からペルソナIDとフェーズを抽出する"""
     parts = filename.replace('.txt', '').split('_')
@@ -53,9 +46,10 @@ def main():
         with open(file_path, 'r', encoding='utf-8') as f:
             content = f.read()
 
-            score_grammar = parse_score(content, "文法と語彙の正確さ")
-            score_naturalness = parse_score(content, "表現の自然さと適切さ")
-            score_fluency = parse_score(content, "会話の論理性と流暢さ")
+            # 観点別スコアはアプリの評価保存時と同じ parse_scores で取り出す
+            scores = parse_scores(content)
+            score_grammar, score_naturalness, score_fluency = (
+                "N/A" if scores[field] is None else str(scores[field]) for field in SCORE_FIELDS)
 
             all_scores.append({
                 'Persona': persona_id,
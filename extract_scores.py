@@ -1,6 +1,6 @@
 import os
-import re
 import csv
+from scores import SCORE_FIELDS, parse_scores
 
 # --- 設定 ---
 # 評価結果ファイルが保存されているディレクトリ
@@ -9,15 +9,6 @@ results_dir = r"C:\Users\salmi\web\evaluation_results"
 # 出力するCSVファイル
 output_csv_path = r"C:\Users\salmi\web\score_summary.csv"
 
-def parse_score(text, category_name):
-    """指定されたカテゴリのスコアを正規表現で抽出する"""
-    # 正規表現パターン: 例) ### 1. 文法と語彙の正確さ
-    pattern = re.compile(f"###\s*\d+\.?\s*{category_name}.*?^\*\*スコア:\*\*\s*(\d+)/100", re.MULTILINE | re.DOTALL)
-    match = pattern.search(text)
-    if match:
-        return match.group(1)
-    return "N/A" # 見つからない場合は N/A を返す
-
 def parse_filename(filename):
     """ファイル名からペルソナIDと評価フェーズを抽出する"""
     parts = filename.replace('.txt', '').split('_')
@@ -57,9 +48,10 @@ def main():
 
             # ファイル名と内容から情報を抽出
             persona_id, phase = parse_filename(filename)
-            score_grammar = parse_score(content, "文法と語彙の正確さ")
-            score_naturalness = parse_score(content, "表現の自然さと適切さ")
-            score_fluency = parse_score(content, "会話の論理性と流暢さ")
+            # 観点別スコアはアプリの評価保存時と同じ parse_scores で取り出す
+            scores = parse_scores(content)
+            score_grammar, score_naturalness, score_fluency = (
+                "N/A" if scores[field] is None else str(scores[field]) for field in SCORE_FIELDS)
 
             # 抽出したデータを辞書としてリストに追加
             all_scores.append({
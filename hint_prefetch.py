@@ -0,0 +1,74 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+logger = logging.getLogger(__name__)
+
+# --- 「次の行動のヒント」の先読み ---
+# ヒントのボタンを押してから生成を始めると、行き詰まったプレイヤーをさらに数秒待たせることになる。
+# AIの発言が表示された時点で、そのターンのヒントを裏で生成しておき、ボタンが押されたらそれを返す。
+# 先読みはターン（会話履歴の長さ）に結び付け、会話が進んだら使わずに捨てる。
+# 使われないこともある生成なので、1回のプレイで先読みする回数に上限を設け、安いモデルで生成する。
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="hint-prefetch")
+        return _executor
+
+
+class HintPrefetch:
+    """1回のプレイの、先読みしたヒントと先読みの回数"""
+
+    def __init__(self, session_id, budget=20):
+        self.session_id = session_id
+        self.budget = budget
+        self.used = 0
+        self.turn = None    # 先読みしたターン
+        self.future = None
+
+    def wants(self, turn):
+        """このターンをまだ先読みしておらず、上限にも達していないか"""
+        return self.turn != turn and self.used < self.budget
+
+    def start(self, turn, generate):
+        if not self.wants(turn):
+            return
+        if self.future is not None:
+            self.future.cancel()  # 前のターンの分がまだ始まっていなければ取り消す
+        self.turn = turn
+        self.used += 1
+        self.future = _get_executor().submit(generate)
+
+    def take(self, turn, timeout=10):
+        """
+        そのターンの先読みがあれば結果を返す（生成中なら timeout 秒まで待つ）。なければ・失敗していれば None。
+        まだ順番待ちで始まっていない先読みは取り消して None を返し、呼び出し側にその場で生成させる
+        （ほかのプレイの先読みが詰まっている間、待たせ続けないため）
+        """
+        if self.future is None or self.turn != turn:
+            return None
+        if self.future.cancel():
+            return None
+        try:
+            return self.future.result(timeout)
+        except FutureTimeout:
+            logger.info("action hint prefetch timed out: session=%s turn=%s", self.session_id, turn)
+            return None
+        except Exception:
+            logger.warning("action hint prefetch failed: session=%s turn=%s", self.session_id, turn, exc_info=True)
+            return None
+
+
+def get_hint_prefetch(state, session_id, budget=20):
+    """st.session_state に保持している HintPrefetch を返す（プレイが変わったら作り直す）"""
+    prefetch = state.get("hint_prefetch")
+    if prefetch is None or prefetch.session_id != session_id:
+        prefetch = HintPrefetch(session_id, budget)
+        state["hint_prefetch"] = prefetch
+    return prefetch
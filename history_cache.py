@@ -0,0 +1,83 @@
+from message_log import parse_eval_blocks, split_title, split_turns, strip_title
+from session_index import new_entry, apply_turns, apply_eval
+
+# --- 会話履歴・フィードバックの解析結果のキャッシュ（セッション単位） ---
+# 「会話履歴を確認」「過去のフィードバック」の画面は、再実行のたびに load_message で全履歴を取得し
+# 正規表現で分解していた。会話の索引と解析済みのフィードバックを st.session_state に保持し、
+# record_message で追記された分はその場で反映する。会話の本文は開いたセッションの分だけ読み出して保持する。
+
+
+class HistoryCache:
+    """1ユーザー分の会話履歴とフィードバックの解析済み一覧"""
+
+    def __init__(self, username):
+        self.username = username
+        self.index = None      # 会話の索引（新しい順）
+        self.bodies = {}       # {索引の key: 本文}（開いたセッションのみ）
+        self.sources = {}      # 本文を取り出すために読み出した元の履歴（保存先の load_session が使い回す）
+        self.feedback = None   # {見出し: 評価本文}
+        self.scores = None     # 評価ごとの観点別スコア（古い順）
+        self.unparsed = {"eval": False}  # 中身はあるのに解析できなかったか
+
+    def load_index(self, list_sessions):
+        if self.index is None:
+            self.index = list_sessions(self.username)
+        return self.index
+
+    def load_body(self, load_session, entry):
+        key = entry["key"]
+        if key not in self.bodies:
+            self.bodies[key] = load_session(self.username, entry, self.sources)
+        return self.bodies[key]
+
+    def load_feedback(self, load_message):
+        if self.feedback is None:
+            message = load_message(self.username, "eval")
+            self.feedback = {title.strip(): body.strip() for title, body in parse_eval_blocks(message)}
+            self.unparsed["eval"] = bool(message) and not self.feedback
+        return self.feedback
+
+    def load_scores(self, load_scores):
+        if self.scores is None:
+            self.scores = load_scores(self.username)
+        return self.scores
+
+    def append(self, where, text, session_id=""):
+        """record_message で追記された内容を索引・本文・フィードバックに反映する"""
+        title, body = strip_title(text)
+        if where == "message":
+            self.sources.clear()  # 読み出した元の履歴は古くなったので、次に開くときに読み直す
+        if where == "message" and self.index is not None:
+            if title:
+                key = session_id or title
+                self.index.insert(0, new_entry(key, *split_title(title)))
+                self.bodies[key] = ""
+            else:
+                key = session_id or (self.index[0]["key"] if self.index else None)
+            entry = next((e for e in self.index if e["key"] == key), None)
+            if entry is None:
+                self.index = None  # どのセッションか分からない追記は次回まとめて読み直す
+                return
+            apply_turns(entry, split_turns(body))
+            if key in self.bodies:
+                self.bodies[key] = (self.bodies[key] + "\n" + body.strip()).strip()
+        elif where == "eval":
+            self.scores = None  # スコアは保存先で数値にしたものを次回読み直す
+            if self.index is not None and session_id:
+                entry = next((e for e in self.index if e["key"] == session_id), None)
+                if entry is not None:
+                    apply_eval(entry, body)
+            if self.feedback is not None:
+                if title:
+                    self.feedback[title] = body.strip()
+                else:
+                    self.feedback = None
+
+
+def get_history_cache(state, username):
+    """st.session_state に保持しているキャッシュを返す（ユーザーが変わったら作り直す）"""
+    cache = state.get("history_cache")
+    if cache is None or cache.username != username:
+        cache = HistoryCache(username)
+        state["history_cache"] = cache
+    return cache
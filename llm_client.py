@@ -0,0 +1,239 @@
+import logging
+import random
+import re
+import threading
+import time
+from model_routing import route
+
+logger = logging.getLogger(__name__)
+
+# --- モデル呼び出しの共通の窓口 ---
+# chat.completions.create はすべてここを通す。呼び出し箇所ごとの設定（model_routing.ROUTES）に加えて、
+# 1. 呼び出しごとのタイムアウト（ROUTES の timeout）
+# 2. レート制限（429）・サーバーエラー（5xx）・タイムアウト・接続エラーのときの、ジッター付き指数バックオフでの再試行
+#    （ROUTES の retries 回まで。Retry-After があればそれ以上待つ）。再試行し尽くしたら fallbacks のモデルに移る
+# 3. モデルごとのサーキットブレーカー（続けて失敗したモデルはしばらく呼ばずに、すぐ次のモデルに移る）
+# を行い、それでも失敗したら LLMError（何が・どのモデルで・何回試して失敗したか）にまとめて返す。
+# SDK 自身の再試行は、ここでの再試行と重ならないように切る。
+
+BASE_DELAY = 1.0       # 1回目の再試行までの待ち時間の上限（秒）。以後は倍々にする
+MAX_DELAY = 30.0       # 再試行までの待ち時間の上限（秒）
+FAILURE_THRESHOLD = 5  # 続けてこの回数失敗したモデルのブレーカーを開く
+COOLDOWN = 30.0        # ブレーカーを開いてから、試しに1回呼んでみるまでの時間（秒）
+
+RETRYABLE = ("timeout", "connection", "rate_limit", "server")
+# 応答の model は "gpt-4o-2024-08-06" のように日付の版が付くことがある
+SNAPSHOT_SUFFIX = re.compile(r"-\d{4}-\d{2}-\d{2}$")
+
+
+class LLMError(Exception):
+    """
+    再試行・代わりのモデルを使い切っても失敗した呼び出し。kind は
+    timeout / connection / rate_limit / server / circuit_open（どのモデルもブレーカーが開いていた）/ request（4xx など、再試行しても変わらないエラー）
+    """
+
+    def __init__(self, site, kind, model, attempts, cause=None):
+        super().__init__(f"{site}: {kind} (model={model}, attempts={attempts})")
+        self.site = site
+        self.kind = kind
+        self.model = model
+        self.attempts = attempts
+        self.cause = cause
+
+
+class LLMResult:
+    """complete() の結果。成功すれば text に応答、失敗すれば error に LLMError が入る"""
+
+    def __init__(self, site, text=None, error=None, model=None, elapsed=0.0):
+        self.site = site
+        self.text = text
+        self.error = error
+        self.model = model
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class CircuitBreaker:
+    """1つのモデルの連続失敗を数え、閾値を超えたら COOLDOWN の間は呼ばせない（その後は1回だけ試させる）"""
+
+    def __init__(self, model, threshold=FAILURE_THRESHOLD, cooldown=COOLDOWN):
+        self.model = model
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None  # ブレーカーを開いた時刻（閉じていれば None）
+        self.probing = False   # 開いた後の試しの1回を実行中か
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self.probing = True
+            return True
+
+    def success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info("circuit closed: model=%s", self.model)
+            self.failures, self.opened_at, self.probing = 0, None, False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.probing or (self.opened_at is None and self.failures >= self.threshold):
+                logger.warning("circuit opened: model=%s failures=%d", self.model, self.failures)
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+    def release(self):
+        """上流の状態と関係のない理由で呼び出しが終わったとき、試しの1回を取り消す"""
+        with self._lock:
+            self.probing = False
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(model):
+    """モデルごとの CircuitBreaker をプロセス内で共有する（セッション・スレッドをまたいで失敗を数える）"""
+    with _breakers_lock:
+        breaker = _breakers.get(model)
+        if breaker is None:
+            breaker = CircuitBreaker(model)
+            _breakers[model] = breaker
+        return breaker
+
+
+def _classify(error):
+    """(kind, Retry-After の秒数) を返す。OpenAI の API のエラーでなければ kind は None"""
+    import openai
+    if isinstance(error, openai.APITimeoutError):  # APIConnectionError の派生なので先に見る
+        return "timeout", None
+    if isinstance(error, openai.APIConnectionError):
+        return "connection", None
+    if isinstance(error, openai.APIStatusError):
+        retry_after = None
+        try:
+            retry_after = float(error.response.headers.get("retry-after"))
+        except (TypeError, ValueError, AttributeError):
+            pass
+        if error.status_code == 429:
+            return "rate_limit", retry_after
+        if error.status_code >= 500:
+            return "server", retry_after
+        return "request", None
+    if isinstance(error, openai.OpenAIError):
+        return "request", None
+    # ストリームを読んでいる途中の切断・読み取りのタイムアウトは、SDK でまとめられずに httpx の例外のまま届く
+    try:
+        import httpx
+    except ImportError:
+        return None, None
+    if isinstance(error, httpx.TimeoutException):
+        return "timeout", None
+    if isinstance(error, (httpx.TransportError, httpx.StreamError)):
+        return "connection", None
+    return None, None
+
+
+def _backoff(attempt, retry_after=None):
+    """attempt 回目（0 から）の失敗の後に待つ秒数。上限までの間で一様に散らす（フルジッター）"""
+    delay = random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+    if retry_after:
+        delay = max(delay, min(retry_after, MAX_DELAY))
+    return delay
+
+
+def create(client, site, messages, **overrides):
+    """
+    その呼び出し箇所の設定で chat.completions.create を呼び、応答（stream=True ならストリーム）を返す。
+    overrides（model, temperature, max_tokens, timeout, retries, stream, response_format など）は表の値より優先する
+    （model を上書きしても fallbacks はそのまま使う）。値が None の上書きは無視する。失敗したら LLMError を送出する。
+    ストリームは最初の応答が届いた時点で成功とみなし、途中で切れたものはやり直さない。
+    """
+    settings = route(site)
+    settings.update({key: value for key, value in overrides.items() if value is not None})
+    primary = settings.pop("model")
+    models = [primary] + [m for m in settings.pop("fallbacks") if m != primary]
+    retries = settings.pop("retries")
+    params = {key: value for key, value in settings.items() if value is not None}
+    client = client.with_options(max_retries=0)
+
+    attempts = 0
+    error = None
+    for model in models:
+        breaker = get_breaker(model)
+        for attempt in range(retries + 1):
+            if not breaker.allow():
+                if error is None or error.kind == "circuit_open":
+                    error = LLMError(site, "circuit_open", model, attempts)
+                break
+            attempts += 1
+            try:
+                response = client.chat.completions.create(model=model, messages=messages, **params)
+            except Exception as e:
+                kind, retry_after = _classify(e)
+                if kind is None:
+                    breaker.release()
+                    raise
+                if kind not in RETRYABLE:
+                    breaker.success()  # 上流は応答しているので、ブレーカーの失敗には数えない
+                    raise LLMError(site, kind, model, attempts, e) from e
+                breaker.failure()
+                error = LLMError(site, kind, model, attempts, e)
+                logger.warning("model call failed: site=%s model=%s attempt=%d error=%s",
+                               site, model, attempts, kind)
+                if attempt < retries:
+                    time.sleep(_backoff(attempt, retry_after))
+                continue
+            breaker.success()
+            if model != primary:
+                logger.warning("model call fell back: site=%s from=%s to=%s", site, primary, model)
+            return response
+    raise error
+
+
+def served_by(response_model, model):
+    """
+    応答の model（版付きの名前のこともある）が model のものか。代わりのモデルの応答を、
+    表のモデルの名前を含むキーでキャッシュしないために使う
+    """
+    return bool(response_model) and (response_model == model or SNAPSHOT_SUFFIX.sub("", response_model) == model)
+
+
+def read_stream(site, stream):
+    """
+    create(..., stream=True) のストリームの chunk を順に返す。読んでいる途中で切れたら LLMError にして送出する
+    （create() が受け持つのはストリームを開くところまでなので、途中のエラーは再試行しない）
+    """
+    model = None
+    chunks = 0
+    try:
+        for chunk in stream:
+            model = getattr(chunk, "model", None) or model
+            chunks += 1
+            yield chunk
+    except Exception as e:
+        kind, _ = _classify(e)
+        if kind is None:
+            raise
+        logger.warning("model stream broke: site=%s model=%s chunks=%d error=%s", site, model, chunks, kind)
+        raise LLMError(site, kind, model, 1, e) from e
+
+
+def complete(client, site, messages, **overrides):
+    """create() の応答の本文を LLMResult で返す（失敗しても例外にしない）"""
+    started = time.monotonic()
+    try:
+        response = create(client, site, messages, **overrides)
+    except LLMError as e:
+        return LLMResult(site, error=e, model=e.model, elapsed=time.monotonic() - started)
+    return LLMResult(site, text=response.choices[0].message.content, model=response.model,
+                     elapsed=time.monotonic() - started)
@@ -0,0 +1,180 @@
+import re
+import threading
+
+# --- 追記専用のメッセージログ ---
+# UserData シートの "message" / "eval" セルに全履歴を連結して保存する代わりに、
+# 1発言・1評価を1行として MessageLog シートに追記する。
+# 行の形式: username, chapter, session_id, timestamp, role, text
+# role は発言者の接頭辞（「ユーザー」「User」「AI」）か、評価結果の場合は "eval"。
+
+LOG_SHEET_TITLE = "MessageLog"
+LOG_HEADER = ["username", "chapter", "session_id", "timestamp", "role", "text"]
+
+# 「Chapter 1: 空港での手続き 2025/01/01 10:00」形式のセッション見出し
+SESSION_TITLE_PATTERN = re.compile(r"^(Chapter \d+: .*?)\s*(\d{4}/\d{2}/\d{2} \d{2}:\d{2})\s*$")
+SPEAKER_PATTERN = re.compile(r"^(ユーザー|User|AI)\s*[:：]\s?(.*)$")
+
+# 従来の連結形式から1セッションずつ取り出すパターン（履歴画面と同じもの）
+MESSAGE_BLOCK_PATTERN = r"(Chapter \d+: .*?\d{4}/\d{2}/\d{2} \d{2}:\d{2})(.*?)(?=Chapter \d+: |\Z)"
+EVAL_BLOCK_PATTERN = r"(Chapter \d+: .*?\d{4}/\d{2}/\d{2} \d{2}:\d{2})\n(.*?)(?=Chapter \d+: |\Z)"
+
+
+def split_turns(text):
+    """「ユーザー: ...」「AI: ...」形式のテキストを (role, 発言) のリストに分解する"""
+    turns = []
+    for line in text.split("\n"):
+        if SESSION_TITLE_PATTERN.match(line.strip()):
+            continue  # 見出しは chapter / timestamp 列で表すので行にしない
+        match = SPEAKER_PATTERN.match(line.strip())
+        if match:
+            turns.append([match.group(1), match.group(2)])
+        elif turns:
+            # 接頭辞のない行は直前の発言の続き（複数行の返答）
+            turns[-1][1] += "\n" + line
+    return [(role, body) for role, body in turns]
+
+
+def split_title(title):
+    """セッション見出しを (chapter, timestamp) に分ける"""
+    match = SESSION_TITLE_PATTERN.match(title.strip())
+    if not match:
+        return title.strip(), ""
+    return match.group(1), match.group(2)
+
+
+def parse_message_blocks(blob):
+    """従来の "message" セルの内容を (見出し, 本文) のリストに分解する"""
+    return re.findall(MESSAGE_BLOCK_PATTERN, blob, re.DOTALL)
+
+
+def parse_eval_blocks(blob):
+    """従来の "eval" セルの内容を (見出し, 評価本文) のリストに分解する"""
+    return re.findall(EVAL_BLOCK_PATTERN, blob, re.DOTALL)
+
+
+def open_log_sheet(spreadsheet, title=LOG_SHEET_TITLE, header=LOG_HEADER):
+    """追記専用のシート（既定は MessageLog）を開く。なければヘッダー付きで作成する"""
+    try:
+        return spreadsheet.worksheet(title)
+    except Exception:
+        worksheet = spreadsheet.add_worksheet(title=title, rows=1000, cols=len(header))
+        worksheet.append_row(header, value_input_option="RAW")
+        return worksheet
+
+
+def fetch_user_rows(worksheet, username, width):
+    """1列目（ユーザー名）だけを読み、そのユーザーの行だけを width 列分取得する"""
+    usernames = worksheet.col_values(1)
+    row_numbers = [i for i, name in enumerate(usernames[1:], start=2) if name == username]
+    if not row_numbers:
+        return []
+    last_col = chr(ord("A") + width - 1)
+    ranges = [f"A{start}:{last_col}{end}" for start, end in _contiguous_runs(row_numbers)]
+    rows = []
+    for value_range in worksheet.batch_get(ranges):
+        for row in value_range:
+            rows.append(list(row) + [""] * (width - len(row)))
+    return rows
+
+
+class MessageLog:
+    """MessageLog シートへの追記と、ユーザー単位の読み出し"""
+
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+
+    def rows_for(self, username, chapter, session_id, timestamp, where, text):
+        return to_log_rows(username, chapter, session_id, timestamp, where, text)
+
+    def append(self, username, chapter, session_id, timestamp, where, text):
+        self.append_rows(self.rows_for(username, chapter, session_id, timestamp, where, text))
+
+    def append_rows(self, rows):
+        if rows:
+            # 発言が「=」などで始まっても数式として解釈されないよう RAW で書き込む
+            self.worksheet.append_rows(rows, value_input_option="RAW")
+
+    def fetch_rows(self, username):
+        """ユーザー名の列だけを読み、そのユーザーの行だけを取得する"""
+        return fetch_user_rows(self.worksheet, username, len(LOG_HEADER))
+
+    def fetch_session_rows(self, username, key):
+        """fetch_rows と同じくそのユーザーの行だけを取得し、索引の key に対応するセッションの行に絞る"""
+        return [row for row in self.fetch_rows(username) if session_key(*row[1:4]) == key]
+
+    def load(self, username, item):
+        """従来の "message" / "eval" セルと同じ連結形式で履歴を返す"""
+        rows = self.fetch_rows(username)
+        if item == "eval":
+            return format_eval_rows(rows)
+        return format_message_rows(rows)
+
+
+def to_log_rows(username, chapter, session_id, timestamp, where, text):
+    """発言（where="message"）または評価（where="eval"）をログの行に変換する"""
+    if where == "eval":
+        _, body = strip_title(text)
+        return [[username, chapter, session_id, timestamp, "eval", body]]
+    return [[username, chapter, session_id, timestamp, role, body]
+            for role, body in split_turns(text)]
+
+
+def session_key(chapter, session_id, timestamp):
+    """ログの行が属するセッションの索引の key（セッションIDがなければ見出し）"""
+    return session_id or f"{chapter} {timestamp}"
+
+
+def format_session_rows(rows):
+    """1セッション分のログの行を「ユーザー: ...」「AI: ...」の行に戻す（評価は含めない）"""
+    return "\n".join(f"{role}: {text}" for _, _, _, _, role, text in rows if role != "eval")
+
+
+def format_eval_rows(rows):
+    """ログの評価行を「見出し + 評価本文」形式の文字列に戻す"""
+    return "\n".join(f"{chapter} {timestamp}\n{text}"
+                     for _, chapter, _, timestamp, role, text in rows if role == "eval")
+
+
+def format_message_rows(rows):
+    """ログの行をセッションごとの「見出し + 発言」形式の文字列に戻す"""
+    sessions = {}
+    for _, chapter, session_id, timestamp, role, text in rows:
+        if role == "eval":
+            continue
+        key = session_key(chapter, session_id, timestamp)
+        if key not in sessions:
+            sessions[key] = [f"{chapter} {timestamp}"]
+        sessions[key].append(f"{role}: {text}")
+    return "\n".join("\n".join(lines) for lines in sessions.values())
+
+
+def strip_title(text):
+    """先頭行がセッション見出しなら (見出し, 残り) に分ける。見出しがなければ ("", text)"""
+    first, _, rest = text.partition("\n")
+    if SESSION_TITLE_PATTERN.match(first.strip()):
+        return first.strip(), rest
+    return "", text
+
+
+def _contiguous_runs(numbers):
+    start = prev = numbers[0]
+    for n in numbers[1:]:
+        if n != prev + 1:
+            yield start, prev
+            start = n
+        prev = n
+    yield start, prev
+
+
+_logs = {}
+_lock = threading.Lock()
+
+
+def get_message_log(spreadsheet):
+    """スプレッドシートごとの MessageLog をプロセス内で共有する"""
+    with _lock:
+        log = _logs.get(spreadsheet.id)
+        if log is None:
+            log = MessageLog(open_log_sheet(spreadsheet))
+            _logs[spreadsheet.id] = log
+        return log
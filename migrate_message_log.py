@@ -0,0 +1,61 @@
+import sys
+import tomllib
+from resources import get_spreadsheet
+from message_log import (get_message_log, parse_message_blocks, parse_eval_blocks,
+                         split_title, split_turns)
+
+# --- 設定 ---
+# アプリと同じ secrets.toml からサービスアカウント情報を読み込む
+secrets_path = ".streamlit/secrets.toml"
+spreadsheet_name = "UserData"
+
+
+def build_rows(username, message_blob, eval_blob):
+    """1ユーザー分の "message" / "eval" セルを MessageLog の行に分解する"""
+    rows = []
+    for n, (title, content) in enumerate(parse_message_blocks(message_blob), start=1):
+        chapter, timestamp = split_title(title)
+        session_id = f"legacy-{username}-{n}"
+        for role, text in split_turns(content):
+            rows.append([username, chapter, session_id, timestamp, role, text])
+    for title, body in parse_eval_blocks(eval_blob):
+        chapter, timestamp = split_title(title)
+        # 旧形式の評価はどの会話のものか分からないため、セッションIDは空にしておく
+        rows.append([username, chapter, "", timestamp, "eval", body.strip()])
+    return rows
+
+
+def main():
+    """UserData の連結セルを MessageLog シートへ一度だけ移行する"""
+    dry_run = "--dry-run" in sys.argv
+
+    with open(secrets_path, "rb") as f:
+        secrets = tomllib.load(f)
+    spreadsheet = get_spreadsheet(secrets["gcp_service_account"], spreadsheet_name)
+
+    users = spreadsheet.sheet1.get_all_records()
+    log = get_message_log(spreadsheet)
+
+    # 既にログがあるユーザーは移行済みとみなしてスキップする（再実行しても重複しない）
+    migrated = set(log.worksheet.col_values(1)[1:])
+
+    total = 0
+    for user in users:
+        username = str(user["username"])
+        if username in migrated:
+            print(f"スキップ: {username}（移行済み）")
+            continue
+        rows = build_rows(username, str(user.get("message", "")), str(user.get("eval", "")))
+        if not rows:
+            continue
+        print(f"{username}: {len(rows)} 行")
+        if not dry_run:
+            log.append_rows(rows)
+        total += len(rows)
+
+    print(f"移行が完了しました。合計 {total} 行{'（dry-run のため書き込みなし）' if dry_run else ''}")
+    print("UserData の message / eval 列は残してあります。動作確認後に secrets の [storage] message_log = true を設定してください。")
+
+
+if __name__ == "__main__":
+    main()
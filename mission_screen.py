@@ -0,0 +1,177 @@
+import logging
+import random
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+# --- ミッション判定の事前チェック（ローカル） ---
+# 監視エージェントの判定は毎ターン API を1回呼び出すが、会話の序盤など、まだ達成しようがないターンが大半を占める。
+# 各章の[ミッション達成の条件]から「最低限必要なプレイヤーの発言数」と「会話に必ず現れるはずの手がかり」を
+# 規則として持ち、それを満たさないターンは判定を呼ばずに「継続」とする。
+# 規則は取りこぼし（達成できているのに呼ばない）を避けるため、広めのパターンにしている。
+#
+# cues: (話者, パターン) のリスト。話者は "player" / "ai" / "any"
+# need: list_need = "half"（mission_tracker と同じ設定）のとき、cues のうち、いくつ見つかればよいか
+#       （「〜」「〜」「〜」など、と例示された条件は一部でよい）。既定では判定と同じく cues がすべて必要
+# ordered: True の場合、cues は会話の中でこの順に現れる必要がある（説明の**後**に理解を示す、など）
+
+# 省いたターンのうち、確認のため判定を呼ぶ割合の既定値。0 にすると食い違い（取りこぼし）は
+# 会話AIが自分で「ミッション達成」と宣言した場合しか数えられない
+AUDIT_RATE = 0.05
+
+UNDERSTOOD = r"わかり|分かり|了解|なるほど|ありがとう|承知"
+
+SCREEN_RULES = {
+    1: {  # 「入国目的」「滞在期間」「宿泊先」など、入国カードに必要な情報を正しく伝えられたら達成
+        "min_turns": 1,
+        "cues": [("player", r"観光|旅行|仕事|出張|留学|ビジネス|目的|会議|訪問"),
+                 ("player", r"\d|[一二三四五六七八九十]|日|週間|か月|ヶ月|カ月|年|間"),
+                 ("player", r"ホテル|旅館|宿|泊|家|住|アパート|寮")],
+        "need": 2,
+    },
+    2: {  # 商品の場所などについて質問し、説明を理解したことを示す応答をすること
+        "min_turns": 2,
+        "cues": [("player", r"どこ|ありますか|探し|売り場|場所|置いて"),
+                 ("ai", r"売り場|コーナー|棚|階|右|左|奥|手前|隣|となり|入口|レジ|あちら|こちら|そちら"),
+                 ("player", UNDERSTOOD)],
+        "ordered": True,
+    },
+    3: {  # 次に会う約束を取り付けること（日時か場所の話が出るまでは達成しようがない）
+        "min_turns": 2,
+        "cues": [("any", r"曜日?|明日|あした|来週|今度|週末|今週|来月|[0-9０-９一二三四五六七八九十]+\s*[時日]|午前|午後|朝|昼|夜|"
+                         r"駅|カフェ|店|公園|映画|で会|待ち合わせ")],
+    },
+    4: {  # 「名前」「出身」「担当業務」などを含めた自己紹介を行い、良い印象のやり取りができたら達成
+        "min_turns": 1,
+        "cues": [("player", r"名前|申します|と言います|といいます|です"),
+                 ("player", r"出身|から来|生まれ|育ち"),
+                 ("player", r"担当|仕事|業務|部署|部|課|チーム|エンジニア|営業|開発|事務")],
+        "need": 2,
+    },
+    5: {  # 「症状の部位」「痛みの程度」「発症時期」などを日本語で説明できたら達成
+        "min_turns": 1,
+        "cues": [("player", r"頭|お腹|おなか|腹|胸|喉|のど|背中|腰|足|手|歯|目|耳|首|肩|膝|ひざ|熱|咳|せき"),
+                 ("player", r"痛|ひどい|すごく|少し|ちょっと|とても|かなり|ズキズキ|ずきずき|我慢|つらい|辛い"),
+                 ("player", r"昨日|きのう|今日|きょう|今朝|朝|夜|前から|日前|週間|先週|から")],
+        "need": 2,
+    },
+    6: {  # 会議中に自分の意見を一度以上発言し、相手と簡単な意見交換ができたら達成
+        "min_turns": 2,
+        "cues": [("player", r"思います|思う|考え|賛成|反対|意見|提案|べき|いいと|良いと|どうでしょう")],
+    },
+    7: {  # お祭りに興味を示し、あなたと一緒に行く約束をすること
+        "min_turns": 2,
+        "cues": [("player", r"行きたい|行きま|行こう|一緒に|いっしょに|いいですね|楽しみ|ぜひ|是非|参加")],
+    },
+    8: {  # 「手続き内容」を説明し、必要な書類や手順を理解できたら達成
+        "min_turns": 2,
+        "cues": [("player", r"住所|変更|在留|更新|転入|転出|届|登録|申請|手続|マイナンバー|保険|証明|引っ越|引越"),
+                 ("ai", r"書類|必要|持って|パスポート|在留カード|印鑑|用紙|記入|窓口|番号"),
+                 ("player", UNDERSTOOD)],
+        "ordered": True,
+    },
+    9: {  # 「目的地」や「予定時刻」を伝え、駅員の案内に沿って代替手段を理解・選択できたら達成
+        "min_turns": 2,
+        "cues": [("player", r"駅|行き|まで|時|分|向か|に行|空港|会社|学校"),
+                 ("ai", r"バス|タクシー|振替|振り替え|乗り換|別の|路線|線|迂回|運転再開"),
+                 ("player", UNDERSTOOD + r"|にします|乗ります|使います|そうします|行きます")],
+        "ordered": True,
+    },
+}
+
+CHAPTER_NUMBER = re.compile(r"Chapter\s*(\d+)")
+PLAYER_PREFIX = "ユーザー:"
+AI_PREFIX = "AI:"
+
+
+def chapter_number(label):
+    match = CHAPTER_NUMBER.search(label or "")
+    return int(match.group(1)) if match else None
+
+
+def split_history(chat_history):
+    """chat_history（"ユーザー: ..." / "AI: ..." の行）を (話者, 発言) のリストにする"""
+    turns = []
+    for line in chat_history:
+        if line.startswith(PLAYER_PREFIX):
+            turns.append(("player", line[len(PLAYER_PREFIX):]))
+        elif line.startswith(AI_PREFIX):
+            turns.append(("ai", line[len(AI_PREFIX):]))
+    return turns
+
+
+def find_cue(turns, speaker, pattern, start=0):
+    """start 以降で、話者とパターンが一致する最初の発言の位置（なければ None）"""
+    for i in range(start, len(turns)):
+        role, text = turns[i]
+        if speaker in ("any", role) and re.search(pattern, text):
+            return i
+    return None
+
+
+def plausible(chapter_label, chat_history, list_need="all"):
+    """このターンでミッション達成があり得るか。規則のない章は常に True（従来どおり判定を呼ぶ）"""
+    rule = SCREEN_RULES.get(chapter_number(chapter_label))
+    if rule is None:
+        return True
+    turns = split_history(chat_history)
+    if sum(1 for role, _ in turns if role == "player") < rule["min_turns"]:
+        return False
+    cues = rule["cues"]
+    if rule.get("ordered"):
+        position = 0
+        for speaker, pattern in cues:
+            found = find_cue(turns, speaker, pattern, position)
+            if found is None:
+                return False
+            position = found  # 同じ発言の中で続けて現れる場合もあるので、次の手がかりは同じ位置から探す
+        return True
+    found = sum(1 for speaker, pattern in cues if find_cue(turns, speaker, pattern) is not None)
+    need = rule.get("need", len(cues)) if list_need == "half" else len(cues)
+    return found >= need
+
+
+class ScreenStats:
+    """事前チェックで判定を省いた回数と、省いた判定と食い違った回数（プロセス全体で集計する）"""
+
+    LOG_EVERY = 20
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.screened = 0   # 事前チェックしたターン
+        self.skipped = 0    # 判定を呼ばなかったターン
+        self.audited = 0    # 省いてよいと判断したが、確認のため判定を呼んだターン
+        self.disagreed = 0  # 省いてよいと判断したのに、判定（または会話AI）が達成としたターン
+
+    def record(self, skipped, audited=False, disagreed=False):
+        with self._lock:
+            self.screened += 1
+            self.skipped += skipped
+            self.audited += audited
+            self.disagreed += disagreed
+            if disagreed or self.screened % self.LOG_EVERY == 0:
+                logger.info("mission screen: screened=%d skipped=%d audited=%d disagreed=%d",
+                            self.screened, self.skipped, self.audited, self.disagreed)
+
+
+stats = ScreenStats()
+
+
+def screen_turn(chapter_label, chat_history, judge, audit_rate=AUDIT_RATE, reply="", list_need="all"):
+    """
+    事前チェックを通ったターンだけ judge() を呼び、その結果（「達成」/「継続」）を返す。
+    省いたターンも audit_rate の割合で judge() を呼び、「達成」ならそれを返して食い違いとして記録する。
+    会話AIが自分で「ミッション達成」と宣言したのに省いた場合も、食い違いとして数える。
+    """
+    if plausible(chapter_label, chat_history, list_need):
+        stats.record(skipped=False)
+        return judge()
+    audited = audit_rate > 0 and random.random() < audit_rate
+    verdict = judge() if audited else "継続"
+    disagreed = "ミッション達成" in reply or verdict == "達成"
+    if disagreed:
+        logger.info("mission screen skipped a completed turn: chapter=%s last=%.200s",
+                    chapter_label, chat_history[-1] if chat_history else "")
+    stats.record(skipped=True, audited=audited, disagreed=disagreed)
+    return "達成" if verdict == "達成" else "継続"
@@ -0,0 +1,127 @@
+import json
+import logging
+import re
+from llm_client import create
+
+logger = logging.getLogger(__name__)
+
+# --- ミッション条件のチェックリスト ---
+# 従来の監視エージェントは、毎ターン agent_prompt 全体と会話全体を送り直して判定していたため、
+# 会話が長くなるほど判定の入力が増えていた。ここではシナリオの[ミッション達成の条件]を
+# セッションの開始時に一度だけ個々の条件に分解し、判定のたびに「前回の判定以降のやり取り」と「チェックリストの状態」
+# だけを送って、新たに満たされた条件を判定する。一度満たされた条件は満たされたままにする。
+# 「「入国目的」「滞在期間」「宿泊先」などを伝え」のように列挙された項目は、項目ごとの条件（動詞を付けて
+# 「「入国目的」を伝え」とする）にし、項目のまとまりを1つのグループとして「いくつ満たせばよいか」を持つ。
+# 従来の監視エージェント・TURN_JUDGE_PROMPT と同じく、既定では列挙された項目をすべて満たす必要がある
+# （完全一致の原則）。list_need = "half" の場合だけ、「など」「や」の列挙を例示とみなして半数以上（切り上げ）でよいとする。
+
+CONDITION_SECTION = re.compile(r"\[ミッション達成の条件\]\s*\n(.*?)(?:\n\s*\n|\n\s*\[|\Z)", re.DOTALL)
+# 「〜し、」「〜伝え、」「〜行い、」のような、動作の区切りになる読点で分ける
+CLAUSE_SPLIT = re.compile(r"(?<=[しえいて])、")
+# 「入国目的」「滞在期間」、「目的地」や「予定時刻」のように、かぎ括弧の項目が続いた部分
+ITEM_LIST = re.compile(r"「[^「」]+」(?:(?:や|、)?「[^「」]+」)*")
+QUOTED = re.compile(r"「([^「」]+)」")
+# 条件の中の「（例：「わかりました」）」「（例：住所変更など）」のような補足は条件として扱わない
+EXAMPLE_NOTE = re.compile(r"（例[:：][^（）]*）")
+CLAUSE_END = re.compile(r"(ら達成|こと)?。?$")
+
+
+def split_items(clause, list_need="all"):
+    """
+    条件の1節を ([条件], 満たす必要のある数) にする。かぎ括弧の列挙があれば項目ごとに述語を付けた条件にし、
+    全部を必要とする（list_need = "half" なら、「など」「や」の列挙は半数以上）
+    """
+    match = ITEM_LIST.search(clause)
+    items = QUOTED.findall(match.group(0)) if match else []
+    if not items:
+        return [CLAUSE_END.sub("", clause)], 1
+    head, tail = clause[:match.start()], clause[match.end():]
+    examples = tail.startswith("など") or "」や「" in match.group(0)
+    tail = tail[len("など"):] if tail.startswith("など") else tail
+    if tail.startswith("、"):
+        # 「〜など、入国カードに必要な情報を正しく伝えられたら達成」は、最後の「を」以降を各項目の述語にする
+        tail = tail[tail.rfind("を"):] if "を" in tail else tail[1:]
+    conditions = [CLAUSE_END.sub("", f"{head}「{item}」{tail}") for item in items]
+    need = (len(items) + 1) // 2 if examples and list_need == "half" else len(items)
+    return conditions, need
+
+
+def parse_conditions(story_prompt, list_need="all"):
+    """シナリオのプロンプトから (ミッションの文, [個々の条件], [(条件の番号のリスト, 満たす必要のある数)]) を取り出す"""
+    match = CONDITION_SECTION.search(story_prompt)
+    if not match:
+        return "", [], []
+    mission = " ".join(line.strip() for line in match.group(1).splitlines() if line.strip())
+    conditions, groups = [], []
+    for clause in CLAUSE_SPLIT.split(EXAMPLE_NOTE.sub("", mission)):
+        clause = re.sub(r"^プレイヤーが", "", clause.strip())
+        if not clause:
+            continue
+        items, need = split_items(clause, list_need)
+        groups.append((list(range(len(conditions), len(conditions) + len(items))), need))
+        conditions.extend(items)
+    return mission, conditions, groups
+
+
+class MissionTracker:
+    """1回のプレイのミッション条件と、満たされたかどうかの状態"""
+
+    def __init__(self, story_prompt, list_need="all"):
+        self.mission, self.conditions, self.groups = parse_conditions(story_prompt, list_need)
+        self.satisfied = [False] * len(self.conditions)
+        self.seen = 0  # 判定に送り終えた chat_history の行数
+
+    @property
+    def complete(self):
+        return bool(self.conditions) and all(sum(self.satisfied[i] for i in indexes) >= need
+                                             for indexes, need in self.groups)
+
+    def checker_prompt(self, exchange):
+        checklist = "\n".join(f"{i}. {condition}: {'満たされた' if done else '未'}"
+                              for i, (condition, done) in enumerate(zip(self.conditions, self.satisfied), start=1))
+        return f"""
+        あなたは日本語学習ゲームの「審判」です。
+        ミッション達成の条件の一覧のうち、[最新のやり取り]で新たに満たされたものを判定してください。
+
+        [ミッション]
+        {self.mission}
+
+        [条件の一覧]（番号. 条件: 状態）
+        {checklist}
+
+        [最新のやり取り]
+        {exchange}
+
+        [判定ルール]
+        1.  状態が「未」の条件のうち、[最新のやり取り]の中で**明確に**満たされたものの番号だけを選んでください。少しでも曖昧な場合は選ばないでください。
+        2.  **時系列の考慮**: 「AIの説明をプレイヤーが理解した」のような条件は、AIが説明した**後**にプレイヤーが理解を示した場合にのみ満たされます。
+        3.  出力はプログラムで自動処理されるため、{{"satisfied": [番号, ...]}} という形式の JSON だけを出力してください。
+        """
+
+    def pending_exchange(self, chat_history):
+        """
+        まだ判定に送っていないやり取り（と、その直前の AI の発言）。事前チェック（mission_screen）で判定を
+        省いたターンがあっても、次に判定するときにそれらのやり取りをまとめて送る
+        """
+        return "\n".join(chat_history[max(self.seen - 1, 0):])
+
+    def update(self, client, chat_history):
+        """前回の判定以降のやり取りでチェックリストを更新し、「達成」または「継続」を返す"""
+        exchange = self.pending_exchange(chat_history)
+        try:
+            response = create(
+                client, "checker",
+                [{"role": "system", "content": self.checker_prompt(exchange)}],
+                max_tokens=30, # 条件の番号の JSON に十分なトークン数
+                response_format={"type": "json_object"},
+            )
+            numbers = json.loads(response.choices[0].message.content).get("satisfied", [])
+            for number in numbers:
+                if isinstance(number, int) and 1 <= number <= len(self.conditions):
+                    self.satisfied[number - 1] = True
+            self.seen = len(chat_history)
+        except Exception:
+            # APIエラーや出力の乱れがあってもゲームを止めないよう、状態を変えずに「継続」とする
+            logger.warning("mission tracker update failed", exc_info=True)
+        return "達成" if self.complete else "継続"
+
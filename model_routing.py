@@ -0,0 +1,50 @@
+import copy
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# --- 呼び出し箇所ごとのモデルの割り当て ---
+# モデル名・temperature などを呼び出し箇所ごとに直接書いていたものを、この表にまとめる。
+# 各項目は model / temperature / max_tokens / timeout（秒。応答を待つ上限）/ retries（同じモデルで再試行する回数）/
+# fallbacks（再試行し尽くしたら順に試す代わりのモデル）。
+# アプリでは secrets の [models.<呼び出し箇所>] で項目ごとに上書きできる（例: [models.checker] model = "gpt-4o-mini"）。
+# 呼び出しそのもの（再試行・代わりのモデル・サーキットブレーカー）は llm_client で行う。
+
+ROUTES = {
+    # 会話AIの応答（最初の発言を含む）
+    "dialog": {"model": "gpt-4o", "temperature": 0.25, "max_tokens": None, "timeout": 30, "retries": 1, "fallbacks": ["gpt-4o-mini"]},
+    # 監視エージェントによるミッション達成判定
+    "checker": {"model": "gpt-3.5-turbo", "temperature": 0, "max_tokens": 5, "timeout": 10, "retries": 1, "fallbacks": ["gpt-4o-mini"]},
+    # 「言葉の意味を調べる」
+    "hint_word": {"model": "gpt-4o", "temperature": 0.25, "max_tokens": None, "timeout": 15, "retries": 1, "fallbacks": ["gpt-4o-mini"]},
+    # 「次の行動のヒント」
+    "hint_action": {"model": "gpt-4o", "temperature": 0.25, "max_tokens": None, "timeout": 15, "retries": 1, "fallbacks": ["gpt-4o-mini"]},
+    # プレイヤーの要約によるシナリオのパーソナライズ
+    "personalize": {"model": "gpt-4o", "temperature": 0, "max_tokens": None, "timeout": 60, "retries": 2, "fallbacks": []},
+    # ゲーム終了後の評価
+    "evaluate": {"model": "gpt-4o", "temperature": 0.25, "max_tokens": None, "timeout": 120, "retries": 2, "fallbacks": []},
+    # ゲーム終了後のプレイヤーの課題の要約
+    "summarize": {"model": "gpt-4o", "temperature": 0.25, "max_tokens": None, "timeout": 60, "retries": 2, "fallbacks": ["gpt-4o-mini"]},
+    # 長い会話の古い発言の要約（chat_context）
+    "context_summary": {"model": "gpt-3.5-turbo", "temperature": 0, "max_tokens": 300, "timeout": 20, "retries": 1, "fallbacks": ["gpt-4o-mini"]},
+    # 評価用スクリプトで学習者を演じるAI
+    "demo_player": {"model": "gpt-4o", "temperature": 0, "max_tokens": None, "timeout": 60, "retries": 2, "fallbacks": []},
+}
+
+_lock = threading.Lock()
+
+
+def configure(overrides):
+    """{呼び出し箇所: {項目: 値}} で表を上書きする（同じ内容で何度呼んでもよい）"""
+    with _lock:
+        for site, values in (overrides or {}).items():
+            if site not in ROUTES:
+                logger.warning("unknown model route: %s", site)
+                continue
+            ROUTES[site].update({key: (list(value) if key == "fallbacks" else value) for key, value in dict(values).items()})
+
+
+def route(site):
+    with _lock:
+        return copy.deepcopy(ROUTES[site])
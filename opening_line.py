@@ -0,0 +1,24 @@
+import functools
+import re
+from prompt_cache import prompt_key
+
+# --- AIの最初の発言 ---
+# 章を始めるたびに、最初の発言を temperature=0 で生成していた。しかし各シナリオの[最初の行動]には、
+# 話しかける言葉が「〜」と話しかけてください、の形でそのまま書かれている
+# （Chapter 7 は[会話の進め方]の「1. まず「〜」と話しかけてください」）。
+# パーソナライズしていないシナリオでは、その言葉をそのまま最初の発言にしてモデルを呼ばない。
+# パーソナライズしたシナリオでは、システムプロンプトのハッシュをキーにして生成した発言をキャッシュする。
+
+OPENING_PATTERN = re.compile(r"「(.+?)」と話しかけてください")
+
+
+@functools.lru_cache(maxsize=64)
+def extract_opening(story_prompt):
+    """シナリオに書かれている最初の発言（なければ None）"""
+    match = OPENING_PATTERN.search(story_prompt)
+    return match.group(1).strip() if match else None
+
+
+def opening_key(system_prompt, model="gpt-4o"):
+    """パーソナライズしたシナリオの最初の発言のキャッシュのキー"""
+    return prompt_key("opening", system_prompt, model)
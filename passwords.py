@@ -0,0 +1,35 @@
+import hashlib
+import hmac
+import os
+
+# --- パスワードのハッシュ化 ---
+# 保存形式: "pbkdf2_sha256$<反復回数>$<ソルト(16進)>$<ハッシュ(16進)>"
+# ハッシュだけを保存するので、資格情報の列をメモリにキャッシュしても平文のパスワードは残らない。
+# 以前の平文のパスワードも照合でき、ログイン成功時にハッシュへ置き換える。
+
+ALGORITHM = "pbkdf2_sha256"
+ITERATIONS = 200_000
+
+
+def hash_password(password, salt=None, iterations=ITERATIONS):
+    salt = salt or os.urandom(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+    return f"{ALGORITHM}${iterations}${salt.hex()}${digest.hex()}"
+
+
+def is_password_hash(value):
+    return isinstance(value, str) and value.startswith(ALGORITHM + "$")
+
+
+def verify_password(password, stored):
+    """入力されたパスワードが保存値（ハッシュまたは以前の平文）と一致するか"""
+    if not stored:
+        return False
+    if not is_password_hash(stored):
+        return hmac.compare_digest(str(stored).encode("utf-8"), password.encode("utf-8"))
+    try:
+        _, iterations, salt_hex, digest_hex = stored.split("$")
+        digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), bytes.fromhex(salt_hex), int(iterations))
+    except ValueError:
+        return False
+    return hmac.compare_digest(digest.hex(), digest_hex)
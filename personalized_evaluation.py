@@ -1,8 +1,9 @@
 import os
 from openai import OpenAI
-import re
+from llm_client import LLMError, create
 import time
 import csv
+from scores import SCORE_FIELDS, parse_scores
 
 # --- 初期設定 ---
 api_key = os.environ.get("OPENAI_API_KEY")
@@ -16,41 +17,36 @@ client = OpenAI(api_key=api_key)
 output_dir = r"C:\Users\salmi\web\evaluation_results_personalized"
 os.makedirs(output_dir, exist_ok=True)
 
+# 150 回近い会話を続けて回すので、アプリより多めに再試行する（1回の 429 で実行全体が止まらないように）
+HARNESS_RETRIES = 6
+# 結果を比べる実行なので、途中で別のモデルに切り替わらないよう代わりのモデルは使わない（失敗したらそこで止める）
+HARNESS_FALLBACKS = []
+
 # --- AIエージェント定義 ---
 def chat_with_gpt(messages):
-    completion = client.chat.completions.create(model="gpt-4o", messages=messages, temperature=0.7)
+    completion = create(client, "dialog", messages, temperature=0.7, retries=HARNESS_RETRIES, fallbacks=HARNESS_FALLBACKS)
     return completion.choices[0].message.content
 
 def demo_play(messages):
-    completion = client.chat.completions.create(model="gpt-4o", messages=messages, temperature=0)
+    completion = create(client, "demo_player", messages, temperature=0, retries=HARNESS_RETRIES, fallbacks=HARNESS_FALLBACKS)
     return completion.choices[0].message.content
 
 def evaluation_with_gpt(messages):
-    completion = client.chat.completions.create(model="gpt-4o", messages=messages, temperature=0)
+    completion = create(client, "evaluate", messages, temperature=0, retries=HARNESS_RETRIES, fallbacks=HARNESS_FALLBACKS)
     return completion.choices[0].message.content
 
 def extract_scores(evaluation_text):
     """
     評価テキストから3つのスコア（文法、表現の自然さ、論理性）と平均点を抽出する。
     """
-    # マークダウンの太字(**)を削除して、揺れを吸収しやすくする
-    cleaned_text = evaluation_text.replace('**', '')
-    
-    # コロンは全角・半角の両方を許容し、スペースの有無も考慮する
-    scores = re.findall(r"スコア\s*[:：]\s*(\d{1,3})/100", cleaned_text)
-    
-    if len(scores) == 3:
-        try:
-            grammar = int(scores[0])
-            naturalness = int(scores[1])
-            logic = int(scores[2])
-            average = (grammar + naturalness + logic) / 3
-            return grammar, naturalness, logic, f"{average:.2f}"
-        except (ValueError, IndexError):
-            # スコアの変換に失敗した場合
-            return 0, 0, 0, "0.00"
-    # スコアが3つ見つからなかった場合
-    return 0, 0, 0, "0.00"
+    # 観点別スコアの取り出しはアプリの評価保存時と同じ parse_scores を使う
+    scores = parse_scores(evaluation_text)
+    if None in scores.values():
+        # スコアが3つ見つからなかった場合
+        return 0, 0, 0, "0.00"
+    grammar, naturalness, logic = (scores[field] for field in SCORE_FIELDS)
+    average = (grammar + naturalness + logic) / 3
+    return grammar, naturalness, logic, f"{average:.2f}"
 
 # --- ★パーソナライズ機能関連の関数とプロンプト ---
 
@@ -99,13 +95,14 @@ def generate_player_summary(conversation_log):
     """会話ログからプレイヤーの言語的課題を要約する"""
     if not conversation_log.strip():
         return ""
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
+    response = create(
+        client, "summarize",
+        [
             {"role": "system", "content": summary_prompt},
             {"role": "user", "content": conversation_log}
         ],
-        temperature=0.25,
+        retries=HARNESS_RETRIES,
+        fallbacks=HARNESS_FALLBACKS,
     )
     return response.choices[0].message.content
 
@@ -116,11 +113,7 @@ def make_new_prompt(player_summary, base_scenario):
 
     making_prompt = making_prompt_template.format(base_scenario=base_scenario, player_summary=player_summary)
     
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[{"role": "system", "content": making_prompt}],
-        temperature=0
-    )
+    response = create(client, "personalize", [{"role": "system", "content": making_prompt}], retries=HARNESS_RETRIES, fallbacks=HARNESS_FALLBACKS)
     return response.choices[0].message.content
 
 
@@ -396,70 +389,75 @@ def run_evaluation_personalized():
 
             for test in range(ITERATION_COUNT):
                 print(f"\n--- 反復訓練（パーソナライズ版）: {test + 1}/{ITERATION_COUNT} ---")
-
-                # 1. プレイヤーの課題に基づき、動的にプロンプトを生成
-                print("プレイヤーの課題に基づき、シナリオを動的に生成しています...")
-                personalized_scenario = make_new_prompt(player_summary, base_scenario_prompt)
-                final_agent_prompt = base_prompt_prefix + personalized_scenario + end_prompt
-                messages1 = [{"role": "system", "content": final_agent_prompt}]
-
-                # 2. 会話シミュレーション
-                memory = ""
-                cnt = 0
-                while True:
-                    if cnt >= TURN_LIMIT: 
-                        print(f"会話が{TURN_LIMIT}ターンに達したため、強制的に終了します。")
-                        break
+                training_length = len(messages2_training)
+                try:
+                    # 1. プレイヤーの課題に基づき、動的にプロンプトを生成
+                    print("プレイヤーの課題に基づき、シナリオを動的に生成しています...")
+                    personalized_scenario = make_new_prompt(player_summary, base_scenario_prompt)
+                    final_agent_prompt = base_prompt_prefix + personalized_scenario + end_prompt
+                    messages1 = [{"role": "system", "content": final_agent_prompt}]
+
+                    # 2. 会話シミュレーション
+                    memory = ""
+                    cnt = 0
+                    while True:
+                        if cnt >= TURN_LIMIT: 
+                            print(f"会話が{TURN_LIMIT}ターンに達したため、強制的に終了します。")
+                            break
                     
-                    response2 = demo_play(messages2_training)
-                    print(f"仮想プレイヤー: {response2}\n")
-                    messages1.append({"role": "user", "content": response2})
-                    messages2_training.append({"role": "assistant", "content": response2})
-                    memory += f"プレイヤー：{response2}\n"
+                        response2 = demo_play(messages2_training)
+                        print(f"仮想プレイヤー: {response2}\n")
+                        messages1.append({"role": "user", "content": response2})
+                        messages2_training.append({"role": "assistant", "content": response2})
+                        memory += f"プレイヤー：{response2}\n"
                     
-                    response1 = chat_with_gpt(messages1)
-                    print(f"会話用エージェント: {response1}\n")
-                    messages1.append({"role": "assistant", "content": response1})
-                    messages2_training.append({"role": "user", "content": response1})
-                    memory += f"エージェント：{response1}\n"
-
-                    if "ミッション達成" in response1 or "ミッション失敗" in response1:
-                        print("ミッションが終了しました。評価に移行します。")
-                        break
+                        response1 = chat_with_gpt(messages1)
+                        print(f"会話用エージェント: {response1}\n")
+                        messages1.append({"role": "assistant", "content": response1})
+                        messages2_training.append({"role": "user", "content": response1})
+                        memory += f"エージェント：{response1}\n"
+
+                        if "ミッション達成" in response1 or "ミッション失敗" in response1:
+                            print("ミッションが終了しました。評価に移行します。")
+                            break
                     
-                    cnt += 1
+                        cnt += 1
                 
-                # 3. 会話の評価
-                eval_content = evaluation_prompt + f"\n**[評価対象の会話ログ]**\n{memory}"
-                response_feedback = evaluation_with_gpt([{"role": "system", "content": eval_content}])
+                    # 3. 会話の評価
+                    eval_content = evaluation_prompt + f"\n**[評価対象の会話ログ]**\n{memory}"
+                    response_feedback = evaluation_with_gpt([{"role": "system", "content": eval_content}])
                 
-                # 4. 評価結果をファイルに保存 (ファイル名を変更し、追記モードに)
-                output_filename = os.path.join(output_dir, f"{persona_id}_personalized_chapter{chapter}_iteration_{test + 1}.txt")
-                with open(output_filename, "a", encoding="utf-8") as f:
-                    summary_to_log = player_summary if player_summary.strip() else "（課題サマリーはありません。初回実行のため、ベースシナリオが使用されました）"
-                    f.write(f"--- Persona: {persona_id}, Chapter: {chapter}, Iteration: {test + 1} ---\n")
-                    f.write(f"[入力された課題サマリー (Player Summary)]\n{summary_to_log}\n\n---\n[上記サマリーを基に動的生成されたシナリオ]\n{personalized_scenario}\n\n---\n[会話ログ]\n{memory}\n---\n[評価・フィードバック]\n{response_feedback}\n\n")
-                print(f"評価結果を {output_filename} に保存しました。")
-
-                # --- スコアを抽出し、CSVに追記 ---
-                grammar, naturalness, logic, avg = extract_scores(response_feedback)
-                with open(summary_file_path, 'a', newline='', encoding='utf-8') as f:
-                    writer = csv.writer(f)
-                    writer.writerow([persona_id, chapter, test + 1, grammar, naturalness, logic, avg])
-
-                # 5. 次のループのために課題要約を更新
-                print("今回の会話ログから次回のパーソナライズに使うための課題を分析しています...")
-                new_summary = generate_player_summary(memory)
-                if new_summary.strip(): # 新しいサマリーが有効な場合のみ更新
-                    player_summary = new_summary
-                    print("課題サマリーを更新しました。")
-                else:
-                    print("（警告：有効な課題サマリーが生成されませんでした。前回のサマリーを引き続き使用します。）")
-
-                # 6. プレイヤーにフィードバックを与えて学習を促す
-                feedback_for_player = f"今回のシミュレーションは終了しました。以下のフィードバックをもとに改善してください。\nFB：{response_feedback}\nこの反省を活かして、もう一度最初から同じシチュエーションでの会話を始めてください。"
-                messages2_training.append({"role": "system", "content": feedback_for_player})
-            
+                    # 4. 評価結果をファイルに保存 (ファイル名を変更し、追記モードに)
+                    output_filename = os.path.join(output_dir, f"{persona_id}_personalized_chapter{chapter}_iteration_{test + 1}.txt")
+                    with open(output_filename, "a", encoding="utf-8") as f:
+                        summary_to_log = player_summary if player_summary.strip() else "（課題サマリーはありません。初回実行のため、ベースシナリオが使用されました）"
+                        f.write(f"--- Persona: {persona_id}, Chapter: {chapter}, Iteration: {test + 1} ---\n")
+                        f.write(f"[入力された課題サマリー (Player Summary)]\n{summary_to_log}\n\n---\n[上記サマリーを基に動的生成されたシナリオ]\n{personalized_scenario}\n\n---\n[会話ログ]\n{memory}\n---\n[評価・フィードバック]\n{response_feedback}\n\n")
+                    print(f"評価結果を {output_filename} に保存しました。")
+
+                    # --- スコアを抽出し、CSVに追記 ---
+                    grammar, naturalness, logic, avg = extract_scores(response_feedback)
+                    with open(summary_file_path, 'a', newline='', encoding='utf-8') as f:
+                        writer = csv.writer(f)
+                        writer.writerow([persona_id, chapter, test + 1, grammar, naturalness, logic, avg])
+
+                    # 5. 次のループのために課題要約を更新
+                    print("今回の会話ログから次回のパーソナライズに使うための課題を分析しています...")
+                    new_summary = generate_player_summary(memory)
+                    if new_summary.strip(): # 新しいサマリーが有効な場合のみ更新
+                        player_summary = new_summary
+                        print("課題サマリーを更新しました。")
+                    else:
+                        print("（警告：有効な課題サマリーが生成されませんでした。前回のサマリーを引き続き使用します。）")
+
+                    # 6. プレイヤーにフィードバックを与えて学習を促す
+                    feedback_for_player = f"今回のシミュレーションは終了しました。以下のフィードバックをもとに改善してください。\nFB：{response_feedback}\nこの反省を活かして、もう一度最初から同じシチュエーションでの会話を始めてください。"
+                    messages2_training.append({"role": "system", "content": feedback_for_player})
+                except LLMError as e:
+                    # 再試行しても応答が得られなかった回は記録せず、仮想プレイヤーの記憶も戻して次の回に進む
+                    del messages2_training[training_length:]
+                    print(f"エラー: {e.site} の呼び出しに失敗しました（{e.kind}, model={e.model}, {e.attempts}回試行）。この回をスキップします。")
+
             print(f"--- シチュエーション Chapter {chapter} のテストが完了 ---\n")
 
         print(f"--- ペルソナ '{persona_id}' のテストが完了 ---\n")
@@ -0,0 +1,103 @@
+import hashlib
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# --- パーソナライズしたシナリオのプロンプトのキャッシュ ---
+# make_new_prompt の生成（temperature=0）は、ベースのプロンプト・章のプロンプト・プレイヤーの要約・モデルで
+# 結果が決まる。これらのハッシュをキーにして生成結果をファイルに保存し、「最初からやり直す」や
+# 章の切り替えのたびに同じ生成を繰り返さないようにする。
+# ファイルは <キー>.txt として1つのディレクトリに置き、件数が上限を超えたら最終利用の古いものから消す。
+# 要約を保存するたびに全章分を先に生成する場合（prompt_precompute）は、1人あたり章の数だけ増えるので、
+# 上限は「最近使った人数 × 章の数」より十分に大きくしておく（小さいと、使う前に消されて生成し直しになる）。
+
+MAX_ENTRIES = 2000
+
+
+def prompt_key(*parts):
+    """入力の組み合わせから決まるキー（区切りを入れてから sha256 を取る）"""
+    digest = hashlib.sha256()
+    for part in parts:
+        data = (part or "").encode("utf-8")
+        digest.update(len(data).to_bytes(8, "big"))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+class PromptCache:
+    """生成済みプロンプトのディスクキャッシュ（最終利用時刻による LRU）"""
+
+    def __init__(self, directory, max_entries=MAX_ENTRIES):
+        self.directory = directory
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.txt")
+
+    def get(self, key):
+        path = self._path(key)
+        with self._lock:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    text = f.read()
+                os.utime(path)  # 最終利用時刻を更新する
+            except FileNotFoundError:
+                return None
+            except OSError:
+                logger.warning("prompt cache read failed: %s", path, exc_info=True)
+                return None
+        return text
+
+    def put(self, key, text):
+        path = self._path(key)
+        with self._lock:
+            try:
+                # 書きかけのファイルを読まないよう、一時ファイルに書いてから置き換える
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(text)
+                os.replace(tmp_path, path)
+                self._evict()
+            except OSError:
+                logger.warning("prompt cache write failed: %s", path, exc_info=True)
+
+    def get_or_create(self, key, create):
+        """
+        キャッシュにあればそれを返し、なければ create() の結果を返す。create() は (テキスト, 保存してよいか) を返し、
+        保存してよいとき（キーに含めたモデルで生成できたとき）だけ保存する
+        """
+        text = self.get(key)
+        if text is None:
+            text, cacheable = create()
+            if cacheable:
+                self.put(key, text)
+        return text
+
+    def _evict(self):
+        entries = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".txt")]
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort(key=os.path.getmtime)
+        for path in entries[:len(entries) - self.max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_prompt_cache(directory, max_entries=MAX_ENTRIES):
+    """ディレクトリごとの PromptCache をプロセス内で共有する"""
+    with _caches_lock:
+        cache = _caches.get(directory)
+        if cache is None:
+            cache = PromptCache(directory, max_entries)
+            _caches[directory] = cache
+        return cache
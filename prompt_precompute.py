@@ -0,0 +1,80 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# --- パーソナライズしたプロンプトの事前生成 ---
+# プレイヤーの要約（player_summary）が更新されると、次に章を始めるときに make_new_prompt の生成を待つことになる。
+# 要約を保存した時点で全章分の生成を裏で始め、結果を PromptCache に入れておく。
+# ワーカーの数は固定し、同じユーザーの新しい要約が届いたら、まだ始まっていない古い要約の生成は取り消す。
+
+
+class PromptPrecomputer:
+    """ユーザーごとの事前生成の予定と、生成中のジョブ（キャッシュのキー単位）"""
+
+    def __init__(self, cache, max_workers=2):
+        self.cache = cache
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prompt-precompute")
+        # 取り消したジョブの完了コールバックは schedule の中（ロックを持ったまま）で呼ばれるので、再入可能にする
+        self._lock = threading.RLock()
+        self._generation = {}  # {username: 最新の要約の番号}
+        self._futures = {}     # {username: [Future]}
+        self._inflight = {}    # {key: Future}
+
+    def schedule(self, username, jobs):
+        """jobs は (キー, 生成する関数) のリスト。生成する関数は (テキスト, 保存してよいか) を返す。そのユーザーの以前の予定は取り消して置き換える"""
+        with self._lock:
+            generation = self._generation.get(username, 0) + 1
+            self._generation[username] = generation
+            for future in self._futures.pop(username, []):
+                future.cancel()  # 実行中のものは止められないが、結果はキーに対して正しいのでそのまま保存される
+            futures = []
+            for key, create in jobs:
+                if key in self._inflight or self.cache.get(key) is not None:
+                    continue
+                future = self._executor.submit(self._run, username, generation, key, create)
+                self._inflight[key] = future
+                future.add_done_callback(lambda _, key=key: self._done(key))
+                futures.append(future)
+            self._futures[username] = futures
+        logger.info("prompt precompute scheduled: user=%s jobs=%d", username, len(futures))
+
+    def _run(self, username, generation, key, create):
+        with self._lock:
+            if self._generation.get(username) != generation:
+                return None  # 始まる前に新しい要約が届いた
+        text, cacheable = create()  # 代わりのモデルで生成したものは、キーのモデルのものとして保存しない
+        if cacheable:
+            self.cache.put(key, text)
+        return text
+
+    def _done(self, key):
+        with self._lock:
+            self._inflight.pop(key, None)
+
+    def wait(self, key, timeout=None):
+        """そのキーを生成中なら終わるまで待つ（失敗・取り消し・生成中でない場合は None）"""
+        with self._lock:
+            future = self._inflight.get(key)
+        if future is None:
+            return None
+        try:
+            return future.result(timeout)
+        except Exception:
+            logger.warning("prompt precompute failed: %s", key, exc_info=True)
+            return None
+
+
+_precomputers = {}
+_precomputers_lock = threading.Lock()
+
+
+def get_prompt_precomputer(cache, max_workers=2):
+    """PromptCache ごとの PromptPrecomputer をプロセス内で共有する"""
+    with _precomputers_lock:
+        precomputer = _precomputers.get(id(cache))
+        if precomputer is None:
+            precomputer = PromptPrecomputer(cache, max_workers)
+            _precomputers[id(cache)] = precomputer
+        return precomputer
@@ -0,0 +1,76 @@
+import threading
+
+# --- 外部サービスのクライアント（プロセス内で共有） ---
+# Streamlit は操作のたびにアプリのスクリプトを先頭から実行し直すが、import したモジュールは
+# プロセス内に残る。認証済みクライアントをここに保持して、再実行やセッションをまたいで使い回す。
+# （HTTP の接続プールも使い回されるので、毎回の TLS 接続確立も不要になる）
+
+GOOGLE_SCOPES = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+
+_lock = threading.Lock()
+_openai_clients = {}
+_google = {}
+
+
+def get_openai_client(api_key):
+    """API キーごとに OpenAI クライアントを1つだけ作る"""
+    with _lock:
+        client = _openai_clients.get(api_key)
+        if client is None:
+            from openai import OpenAI
+            client = OpenAI(api_key=api_key)
+            _openai_clients[api_key] = client
+        return client
+
+
+class _GoogleResources:
+    """サービスアカウントごとの gspread クライアントと、開いたスプレッドシート"""
+
+    def __init__(self, service_account_info):
+        import gspread
+        from google.oauth2.service_account import Credentials
+
+        self.credentials = Credentials.from_service_account_info(dict(service_account_info), scopes=GOOGLE_SCOPES)
+        self.client = gspread.authorize(self.credentials)
+        self.spreadsheets = {}
+        self.worksheets = {}
+
+    def ensure_token(self):
+        # アクセストークンの期限が切れていたら、次のリクエストの前にここで取り直す
+        if not self.credentials.valid:
+            from google.auth.transport.requests import Request
+            self.credentials.refresh(Request())
+
+
+def _google_resources(service_account_info):
+    key = service_account_info["client_email"]
+    resources = _google.get(key)
+    if resources is None:
+        resources = _GoogleResources(service_account_info)
+        _google[key] = resources
+    return resources
+
+
+def get_spreadsheet(service_account_info, name):
+    """スプレッドシートを一度だけ開いて共有する"""
+    with _lock:
+        resources = _google_resources(service_account_info)
+        resources.ensure_token()
+        spreadsheet = resources.spreadsheets.get(name)
+        if spreadsheet is None:
+            spreadsheet = resources.client.open(name)
+            resources.spreadsheets[name] = spreadsheet
+        return spreadsheet
+
+
+def get_first_worksheet(service_account_info, name):
+    """スプレッドシートの1枚目のワークシート（sheet1 は参照のたびに通信するためキャッシュする）"""
+    spreadsheet = get_spreadsheet(service_account_info, name)
+    with _lock:
+        resources = _google_resources(service_account_info)
+        worksheet = resources.worksheets.get(name)
+        if worksheet is None:
+            worksheet = spreadsheet.sheet1
+            resources.worksheets[name] = worksheet
+        return worksheet
+
@@ -0,0 +1,95 @@
+import re
+import threading
+from message_log import open_log_sheet, fetch_user_rows, split_title, strip_title
+
+# --- 評価スコアの構造化 ---
+# 評価結果（Markdown）の観点別スコアを、評価を生成して保存する時点で一度だけ数値に変換し、
+# 評価本文とは別に保存する。スコアの推移や一覧は保存した数値から作り、本文を解析し直さない。
+# 行の形式: username, session_id, chapter, timestamp, grammar, naturalness, fluency
+
+SCORE_FIELDS = ("grammar", "naturalness", "fluency")
+SCORE_SHEET_TITLE = "Scores"
+SCORE_HEADER = ["username", "session_id", "chapter", "timestamp"] + list(SCORE_FIELDS)
+
+# 「### 1. 文法と語彙の正確さ」のような番号付きの観点の見出し
+SECTION_PATTERN = re.compile(r"^#+\s*([1-3])\s*\.", re.MULTILINE)
+# 「スコア: XX/100」（英語版の評価は「点数: XX/100」）。太字の ** は取り除いてから照合する
+SCORE_PATTERN = re.compile(r"(?:スコア|点数|Score)\s*[:：]\s*(\d{1,3})\s*/\s*100")
+
+
+def parse_scores(text):
+    """評価本文から {grammar, naturalness, fluency} の点数を取り出す（見つからない観点は None）"""
+    cleaned = text.replace("**", "")
+    scores = dict.fromkeys(SCORE_FIELDS)
+    sections = SECTION_PATTERN.split(cleaned)  # [前置き, 番号, 本文, 番号, 本文, ...]
+    for number, body in zip(sections[1::2], sections[2::2]):
+        field = SCORE_FIELDS[int(number) - 1]
+        match = SCORE_PATTERN.search(body)
+        if match and scores[field] is None:
+            scores[field] = int(match.group(1))
+    if all(value is None for value in scores.values()):
+        # 見出しのない評価は、スコアがちょうど3つあれば出現順に割り当てる
+        found = SCORE_PATTERN.findall(cleaned)
+        if len(found) == len(SCORE_FIELDS):
+            scores = dict(zip(SCORE_FIELDS, map(int, found)))
+    return scores
+
+
+def average_score(scores):
+    """観点別スコア（parse_scores の結果またはスコアのレコード）の平均。整数に丸め、スコアがなければ None"""
+    values = [scores[field] for field in SCORE_FIELDS if scores.get(field) is not None]
+    return round(sum(values) / len(values)) if values else None
+
+
+def to_score_record(session_id, chapter, timestamp, eval_text):
+    """評価（見出し付きでもよい）を保存用のスコアのレコードに変換する"""
+    title, body = strip_title(eval_text)
+    if title and not (chapter and timestamp):
+        chapter, timestamp = split_title(title)
+    record = {"session_id": session_id, "chapter": chapter, "timestamp": timestamp}
+    record.update(parse_scores(body))
+    return record
+
+
+def score_title(record):
+    """フィードバックの見出し（「章 日時」）と同じ形式のキー"""
+    return f"{record['chapter']} {record['timestamp']}"
+
+
+class ScoreLog:
+    """Scores シートへのスコアの追記と、ユーザー単位の読み出し"""
+
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+
+    def row_for(self, username, record):
+        return [username, record["session_id"], record["chapter"], record["timestamp"]] + \
+               ["" if record[field] is None else record[field] for field in SCORE_FIELDS]
+
+    def append_rows(self, rows):
+        if rows:
+            self.worksheet.append_rows(rows, value_input_option="RAW")
+
+    def fetch(self, username):
+        """そのユーザーのスコアのレコード（古い順）"""
+        records = []
+        for _, session_id, chapter, timestamp, *values in fetch_user_rows(self.worksheet, username, len(SCORE_HEADER)):
+            record = {"session_id": session_id, "chapter": chapter, "timestamp": timestamp}
+            record.update({field: int(value) if str(value).strip() else None
+                           for field, value in zip(SCORE_FIELDS, values)})
+            records.append(record)
+        return records
+
+
+_logs = {}
+_lock = threading.Lock()
+
+
+def get_score_log(spreadsheet):
+    """スプレッドシートごとの ScoreLog をプロセス内で共有する"""
+    with _lock:
+        log = _logs.get(spreadsheet.id)
+        if log is None:
+            log = ScoreLog(open_log_sheet(spreadsheet, SCORE_SHEET_TITLE, SCORE_HEADER))
+            _logs[spreadsheet.id] = log
+        return log
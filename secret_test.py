@@ -1,76 +1,198 @@
 import streamlit as st
 import streamlit.components.v1 as components
-from openai import OpenAI
-import gspread
-from google.oauth2.service_account import Credentials
+import logging
 import time
 import re
 from datetime import datetime, timezone, timedelta
 import html
+import uuid
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from user_store import SheetsUserStore, get_sqlite_store
+from resources import get_openai_client, get_spreadsheet, get_first_worksheet
+from history_cache import get_history_cache
+from session_index import filter_sessions, page_count, page_of
+from scores import SCORE_FIELDS, score_title
+from prompt_cache import MAX_ENTRIES, get_prompt_cache, prompt_key
+from prompt_precompute import get_prompt_precomputer
+from word_lookup import get_word_lookup
+from hint_prefetch import get_hint_prefetch
+from model_routing import configure, route
+from llm_client import LLMError, create, read_stream, served_by
+from opening_line import extract_opening, opening_key
+from analysis_jobs import get_analysis_jobs
+from chat_context import get_chat_context
+from message_log import strip_title
+from turn_judge import TURN_JUDGE_PROMPT, stream_turn, log_verdicts
+from mission_tracker import MissionTracker
+from mission_screen import AUDIT_RATE, screen_turn
+
+logger = logging.getLogger(__name__)
 
 # --- 日本時間(JST)設定 ---
 JST = timezone(timedelta(hours=+9), 'JST')
 
-# --- Google Sheets 認証 ---
-scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-creds_dict = st.secrets["gcp_service_account"]
-credentials = Credentials.from_service_account_info(creds_dict, scopes=scope)
-gs_client = gspread.authorize(credentials)
-sheet = gs_client.open("UserData").sheet1
+# --- 保存先の選択 ---
+# secrets の [storage] backend で "sheets"（既定）か "sqlite" を選ぶ。
+# sqlite の場合は Google の認証情報なしで動く（負荷試験・CI 用）
+storage_config = st.secrets.get("storage", {})
+if storage_config.get("backend", "sheets") == "sqlite":
+    store = get_sqlite_store(storage_config.get("sqlite_path", "userdata.db"))
+else:
+    from message_log import get_message_log
+    from scores import get_score_log
+    from session_index import get_session_log
+    from write_behind import WriteBehindQueue, SheetsBatchWriter, get_write_behind, spool_path_for
+
+    # --- Google Sheets 認証 ---
+    # 認証済みクライアントと開いたシートはプロセス内で共有され、再実行のたびには作り直さない
+    spreadsheet = get_spreadsheet(st.secrets["gcp_service_account"], "UserData")
+    sheet = get_first_worksheet(st.secrets["gcp_service_account"], "UserData")
+
+    # --- 会話ログの保存方式 ---
+    # [storage] で message_log = true の場合、会話と評価は
+    # UserData のセルに連結せず、MessageLog シートに1発言1行で追記する
+    message_log = get_message_log(spreadsheet) if storage_config.get("message_log", False) else None
+
+    # --- 評価スコアの保存 ---
+    # [storage] で score_log = true の場合、評価の観点別スコアを評価時に数値に変換し、
+    # Scores シートに保存する（スコアの推移などは評価本文を解析せずに表示できる）
+    score_log = get_score_log(spreadsheet) if storage_config.get("score_log", False) else None
+
+    # --- 会話の索引の保存 ---
+    # [storage] で session_index = true の場合、記録のたびに章・時刻・ターン数・結果・スコアだけの小さな行を
+    # SessionIndex シートに追記し、履歴画面の一覧はその行だけから作る（本文は開いた会話の分だけ読み出す）
+    session_log = get_session_log(spreadsheet) if storage_config.get("session_index", False) else None
+
+    # --- 書き込みの遅延反映 ---
+    # [storage] で write_behind = true の場合、record_message はキューに積んですぐに戻り、
+    # バックグラウンドのスレッドが一定間隔・一定件数ごとにまとめてシートへ反映する
+    # スプールファイルは既定でアプリとスプレッドシートごとに分ける（spool_path で明示もできる）
+    write_queue = get_write_behind(spreadsheet.id, lambda: WriteBehindQueue(
+        SheetsBatchWriter(sheet, message_log, score_log, session_log),
+        spool_path=storage_config.get("spool_path", spool_path_for("ja", spreadsheet.id)),
+        interval=storage_config.get("flush_interval", 2.0),
+        max_pending=storage_config.get("flush_max_pending", 20),
+    )) if storage_config.get("write_behind", False) else None
+
+    store = SheetsUserStore(sheet, message_log, write_queue, score_log, session_log)
+
+# --- パーソナライズしたプロンプトのキャッシュ ---
+# [storage] で prompt_cache = true の場合、make_new_prompt の生成結果を入力のハッシュをキーにして
+# prompt_cache_dir に保存し、同じ章・同じ要約でのやり直しではモデルを呼ばない
+prompt_cache = get_prompt_cache(
+    storage_config.get("prompt_cache_dir", "prompt_cache"),
+    max_entries=storage_config.get("prompt_cache_max_entries", MAX_ENTRIES),
+) if storage_config.get("prompt_cache", False) else None
+# prompt_precompute = true の場合（prompt_cache が必要）、要約を保存した時点で全章分の生成を裏で始める
+# prompt_cache_max_entries は、先に生成する場合は1人あたり章の数（len(story_prompt)）ずつ増えるので、
+# 既定（prompt_cache.MAX_ENTRIES）は数百人分を保てる大きさにしている
+prompt_precomputer = get_prompt_precomputer(
+    prompt_cache, max_workers=storage_config.get("prompt_precompute_workers", 2),
+) if prompt_cache is not None and storage_config.get("prompt_precompute", False) else None
+
+# --- 「言葉の意味を調べる」の検索 ---
+# secrets の [hints] で word_lookup = true の場合、同梱の辞書 → 過去の回答のキャッシュ → モデルの順に引く
+hint_config = st.secrets.get("hints", {})
+word_lookup = get_word_lookup(
+    hint_config.get("word_dictionary", "dictionary/ja_en.tsv"),
+    get_prompt_cache(hint_config.get("word_cache_dir", "word_cache"),
+                     max_entries=hint_config.get("word_cache_max_entries", 2000)),
+) if hint_config.get("word_lookup", False) else None
+# action_prefetch = true の場合、AIの発言のたびに「次の行動のヒント」を安いモデルで裏で生成しておく
+# （1回のプレイで action_prefetch_budget 回まで）
+action_prefetch = hint_config.get("action_prefetch", False)
+action_prefetch_budget = hint_config.get("action_prefetch_budget", 20)
+action_prefetch_model = hint_config.get("action_prefetch_model", "gpt-4o-mini")
+
+# --- 呼び出し箇所ごとのモデル ---
+# model_routing.ROUTES の既定値を、secrets の [models.<呼び出し箇所>] で上書きする
+configure(st.secrets.get("models", {}))
+
+# --- 1ターンの処理方式 ---
+# secrets の [game] turn_mode で選ぶ。
+# "two_call"（既定）: 会話AIの応答のあとに、監視エージェントが会話全体を読み直して判定する従来方式
+# "merged": 1回の呼び出しで応答と判定（達成・継続・失敗、満たした条件）を JSON で受け取る
+# "compare": merged の判定を使いつつ従来の判定も行い、両者をログに記録して精度を比べる
+game_config = st.secrets.get("game", {})
+turn_mode = game_config.get("turn_mode", "two_call")
+
+# --- 監視エージェントの判定方式 ---
+# [game] mission_checker = "tracker" の場合、ミッション条件をチェックリストにして、
+# 毎ターン最新のやり取りだけで判定する（既定の "full_log" は会話全体を毎回送り直す従来方式）
+mission_checker = game_config.get("mission_checker", "full_log")
+# 「「入国目的」「滞在期間」「宿泊先」など」のような列挙は、既定（"all"）では従来の判定と同じくすべて満たす必要がある。
+# [game] mission_list_need = "half" の場合だけ、チェックリスト方式で半数以上（切り上げ）を満たせば達成とする
+mission_list_need = game_config.get("mission_list_need", "all")
+# [game] mission_screen = true の場合、章ごとの規則で達成があり得ないターンは判定を呼ばない。
+# screen_audit_rate（0〜1、既定は mission_screen.AUDIT_RATE）の割合で省いたターンも判定し、食い違いをログに記録する
+# （0 にすると、省いたターンの取りこぼしは会話AIが「ミッション達成」と宣言した場合しか数えられない）。
+# 確認のための判定が「達成」なら、その判定を使う。事前チェックの規則も判定と同じく列挙をすべて必要とする
+# （チェックリスト方式で mission_list_need = "half" の場合だけ一部でよい）。
+# 監視エージェントがチェックリスト方式の場合、省いたターンのやり取りは次に判定するときにまとめて送る
+mission_screen = game_config.get("mission_screen", False)
+screen_audit_rate = float(game_config.get("screen_audit_rate", AUDIT_RATE))
+
+# --- ゲーム終了後の分析の実行方式 ---
+# [game] analysis_mode = "background" の場合、評価と要約をワーカーで実行し、クリア・失敗画面はすぐに表示する。
+# 評価は完成しだい画面に表示し、ホームに戻っても「過去のフィードバック」に追加される（既定の "inline" は画面で待つ）
+analysis_mode = game_config.get("analysis_mode", "inline")
+analysis_jobs = get_analysis_jobs(game_config.get("analysis_workers", 4)) if analysis_mode == "background" else None
+
+# --- 会話AIに送る文脈 ---
+# [game] context_window = true の場合、直近 context_keep_exchanges 往復だけをそのまま送り、
+# それより前は context_summary_tokens 以内の要約にまとめて送る（既定では会話全体を毎回送る）
+context_window = game_config.get("context_window", False)
+context_keep_exchanges = game_config.get("context_keep_exchanges", 6)
+context_summary_tokens = game_config.get("context_summary_tokens", 300)
 
 # --- ユーザーが存在するかチェック ---
 def user_exists(username):
-    users = sheet.col_values(1)
-    return username in users
+    return store.user_exists(username)
 
 # --- パスワード一致をチェック ---
 def check_password(username, password):
-    users = sheet.get_all_records()
-    for user in users:
-        if user["username"] == username and user["password"] == password:
-            return True
-    return False
+    return store.check_password(username, password)
 
 # --- 新規登録 ---
 def register_user(username, password):
-    if user_exists(username):
-        return False
-    # ヘッダーに合わせて5列分のデータを持つ行を追加する
-    sheet.append_row([username, password, "", "", ""])
-    return True
+    return store.register_user(username, password)
 
 # --- メッセージを追記 ---
-def record_message(username, new_message, where):
-    all_users = sheet.get_all_records()
-    # 列のマッピングを辞書で管理
-    col_map = {"message": 3, "eval": 4, "player_summary": 5}
-    col_index = col_map.get(where)
-    if not col_index:
-        return # 対象の列がなければ何もしない
-
-    for i, user in enumerate(all_users, start=2):
-        if user["username"] == username:
-            # player_summaryは追記ではなく、常に新しい内容で上書きする
-            if where == 'player_summary':
-                combined = new_message
-            else: # messageとevalは従来通り追記
-                old_message = user.get(where, "")
-                combined = old_message + "\n" + new_message if old_message else new_message
-            
-            sheet.update_cell(i, col_index, combined)
-            break
-
+def record_message(username, new_message, where, chapter="", session_id=""):
+    now = datetime.now(JST).strftime('%Y/%m/%d %H:%M')
+    store.record_message(username, new_message, where, chapter, session_id, now)
+    # 履歴画面用の解析済み一覧にもその場で反映する
+    get_history_cache(st.session_state, username).append(where, new_message, session_id)
 
 # --- メッセージ履歴を取得 ---
 def load_message(username,item):
-    all_users = sheet.get_all_records()
-    for user in all_users:
-        if user["username"] == username:
-            return user.get(item, "")
-    return ""
+    return store.load_message(username, item)
+
+# --- 会話履歴の索引と本文を取得 ---
+def list_sessions(username):
+    return store.list_sessions(username)
+
+def load_session(username, entry, memo=None):
+    return store.load_session(username, entry, memo)
+
+# --- 評価の観点別スコアを取得 ---
+def load_scores(username):
+    return store.load_scores(username)
+
+SCORE_LABELS = {"grammar": "文法・語彙", "naturalness": "表現の自然さ", "fluency": "論理性・流暢さ"}
+
+# --- 会話履歴の索引の表示名 ---
+OUTCOME_LABELS = {"cleared": "達成", "failed": "失敗"}
+
+def session_label(entry):
+    score = f"{entry['score']}点" if entry["score"] is not None else "評価なし"
+    outcome = OUTCOME_LABELS.get(entry["outcome"], "未完了")
+    return f"{entry['chapter']} {entry['timestamp']}｜{entry['turns']}ターン｜{outcome}｜{score}"
 
 # --- 動的プロンプト生成機能 (Game.pyから移植・改造) ---
-def make_new_prompt(username, base_prompt_text, selected_prompt_text):
+def personalize_job(base_prompt_text, selected_prompt_text, persona):
+    """要約でパーソナライズする生成の (キャッシュのキー, client を受け取って生成する関数) を返す"""
     making_prompt = '''
         あなたには、私が作成する「日本語学習者支援ゲーム」のシステムの一部である、**動的プロンプト生成機能**を担当してもらいます。
         このゲームは、日本語学習中の外国人プレイヤーが、架空の日本での生活をシミュレーションしながらリアルな会話を通じて日本語力を向上させることを目的としています。
@@ -100,30 +222,57 @@ def make_new_prompt(username, base_prompt_text, selected_prompt_text):
         *   ゲーム内容が不自然になってはいけません。また、「目標達成」はゲームクリアのキーワードなので注意してください。
     '''
     
+    persona_text = "」プレイヤーの言語的課題リスト" + persona
+    
+    # 動的プロンプト生成のためのAPI呼び出し
+    model = route("personalize")["model"]
+
+    def generate(client):
+        messages = [{
+            "role": "system", 
+            "content": making_prompt + base_prompt_text + selected_prompt_text + persona_text + making_prompt_end
+        }]
+        
+        completion = create(client, "personalize", messages)
+        return completion.choices[0].message.content, served_by(completion.model, model)
+
+    return prompt_key(making_prompt + making_prompt_end, base_prompt_text, selected_prompt_text, persona, model), generate
+
+# --- 章の開始時のプロンプト（要約があればパーソナライズする） ---
+def make_new_prompt(username, base_prompt_text, selected_prompt_text):
     # Googleスプレッドシートからプレイヤーの要約データを読み込む
     persona = load_message(username, "player_summary")
     if not persona:
         # 要約データがない場合は、パーソナライズせず元のプロンプトを返す
         return base_prompt_text + selected_prompt_text
 
-    persona_text = "」プレイヤーの言語的課題リスト" + persona
-    
-    # 動的プロンプト生成のためのAPI呼び出し
-    client = OpenAI(api_key=st.secrets["openai"]["api_key"])
-    messages = [{
-        "role": "system", 
-        "content": making_prompt + base_prompt_text + selected_prompt_text + persona_text + making_prompt_end
-    }]
-    
-    completion = client.chat.completions.create(
-        model="gpt-4o",
-        messages=messages,
-        temperature=0
-    )
-    return completion.choices[0].message.content
+    key, generate = personalize_job(base_prompt_text, selected_prompt_text, persona)
+    client = get_openai_client(st.secrets["openai"]["api_key"])
+    try:
+        if prompt_cache is None:
+            return generate(client)[0]
+        if prompt_precomputer is not None:
+            prompt_precomputer.wait(key)  # 裏で同じプロンプトを生成中なら、重ねて呼ばずに終わるのを待つ
+        return prompt_cache.get_or_create(key, lambda: generate(client))
+    except LLMError:
+        # パーソナライズに失敗しても章は始められるように、元のプロンプトで進める
+        return base_prompt_text + selected_prompt_text
+
+# --- 全章分のパーソナライズしたプロンプトを裏で生成する ---
+def precompute_prompts(username, persona, client=None):
+    if prompt_precomputer is None or not persona:
+        return
+    if client is None:
+        client = get_openai_client(st.secrets["openai"]["api_key"])
+    jobs = []
+    for chapter_prompt in story_prompt:
+        key, generate = personalize_job(base_prompt, chapter_prompt[0], persona)
+        jobs.append((key, functools.partial(generate, client)))
+    prompt_precomputer.schedule(username, jobs)
 
 # --- ヒント生成機能 ---
-def generate_hint(hint_type, user_input=None):
+def hint_prompt(hint_type, user_input=None):
+    """ヒントの (system_content, hint_instruction)。作れない場合は None"""
     # 現在のゲーム状況をプロンプトに含める
     game_prompt = st.session_state.get("agent_prompt", "")
     conversation_log = "\n".join(st.session_state.chat_history)
@@ -164,19 +313,65 @@ def generate_hint(hint_type, user_input=None):
         system_content = "You are a Japanese dictionary."
 
     else:
-        return "Could not generate a hint."
-
+        return None
+    return system_content, hint_instruction
 
-    client = OpenAI(api_key=st.secrets["openai"]["api_key"])
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
+def hint_response(client, site, system_content, hint_instruction, model=None):
+    return create(
+        client, site,
+        [
             {"role": "system", "content": system_content},
             {"role": "user", "content": hint_instruction}
         ],
-        temperature=0.25,
+        model=model,
     )
-    return response.choices[0].message.content
+
+def ask_hint_model(client, site, system_content, hint_instruction, model=None):
+    return hint_response(client, site, system_content, hint_instruction, model).choices[0].message.content
+
+def generate_hint(hint_type, user_input=None):
+    prompt = hint_prompt(hint_type, user_input)
+    if prompt is None:
+        return "Could not generate a hint."
+    system_content, hint_instruction = prompt
+
+    if hint_type == "action" and action_prefetch:
+        # このターンのヒントを先読みしてあれば、それを返す（生成中なら少し待ち、まだ始まっていなければその場で生成する）
+        prefetch = get_hint_prefetch(st.session_state, st.session_state.session_id, action_prefetch_budget)
+        hint = prefetch.take(len(st.session_state.chat_history))
+        if hint:
+            return hint
+
+    site = "hint_" + hint_type
+    model = route(site)["model"]
+    client = get_openai_client(st.secrets["openai"]["api_key"])
+    ask_model = functools.partial(ask_hint_model, client, site, system_content, hint_instruction)
+
+    def ask_word_model():
+        # 代わりのモデルの回答は、表のモデルのキーで保存しない
+        response = hint_response(client, site, system_content, hint_instruction)
+        return response.choices[0].message.content, served_by(response.model, model)
+
+    try:
+        if hint_type == "word" and word_lookup is not None:
+            # 単語の意味のプロンプトは単語だけで決まるので、辞書・過去の回答にあればモデルを呼ばない
+            return word_lookup.lookup(user_input, prompt_key(system_content, hint_instruction, model), ask_word_model)
+        return ask_model()
+    except LLMError:
+        return "Could not generate a hint."
+
+# --- 「次の行動のヒント」の先読み（AIの発言が表示されるたびに呼ぶ。同じターンでは一度だけ） ---
+def prefetch_action_hint():
+    if not action_prefetch:
+        return
+    prefetch = get_hint_prefetch(st.session_state, st.session_state.session_id, action_prefetch_budget)
+    turn = len(st.session_state.chat_history)
+    if not prefetch.wants(turn):
+        return
+    system_content, hint_instruction = hint_prompt("action")
+    client = get_openai_client(st.secrets["openai"]["api_key"])
+    prefetch.start(turn, functools.partial(ask_hint_model, client, "hint_action", system_content, hint_instruction,
+                                             action_prefetch_model))
 
 def display_evaluation_result(evaluation_result):
     """評価結果のテキストを解析し、整形してStreamlitに表示する（完全版）"""
@@ -266,6 +461,36 @@ def display_evaluation_result(evaluation_result):
         st.warning(f"評価結果の解析に失敗しました: {e}")
         st.markdown(evaluation_result)
 
+# --- 会話の吹き出し ---
+def user_bubble(text):
+    # ユーザー → 右寄せ（グリーン）
+    return ("<div style='display: flex; justify-content: flex-end; margin: 4px 0'>"
+            "<div style='background-color: #DCF8C6; padding: 8px 12px; border-radius: 8px; max-width: 80%; "
+            "word-wrap: break-word; text-align: left; font-size: 16px; color:black;'>"
+            f"{text}</div></div>")
+
+def ai_bubble(text):
+    # AI → 左寄せ（グレー）
+    return ("<div style='display: flex; justify-content: flex-start; margin: 4px 0'>"
+            "<div style='background-color: #E6E6EA; padding: 8px 12px; border-radius: 8px; max-width: 80%; "
+            "word-wrap: break-word; text-align: left; font-size: 16px; color:black;'>"
+            f"{text}</div></div>")
+
+# --- 会話AIの応答をストリーミングで表示 ---
+def stream_reply(client, messages, placeholder, temperature=None):
+    """応答をトークンごとに placeholder の吹き出しへ表示しながら受け取り、(完成した応答, 応答したモデル) を返す（途中で切れたら LLMError）"""
+    stream = create(client, "dialog", messages, temperature=temperature, stream=True)
+    reply = ""
+    model = None
+    for chunk in read_stream("dialog", stream):
+        model = getattr(chunk, "model", None) or model
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            reply += delta
+            placeholder.markdown(ai_bubble(reply + "▌"), unsafe_allow_html=True)
+    placeholder.markdown(ai_bubble(reply), unsafe_allow_html=True)
+    return reply, model
+
 # --- 監視エージェントによるミッション達成判定 ---
 def check_mission_status(conversation_log, agent_prompt):
     """
@@ -296,17 +521,11 @@ def check_mission_status(conversation_log, agent_prompt):
         正しい判定: AIが場所を説明し、その後にプレイヤーが理解していそうな応答をするまで「継続」とする。
     """
 
-    client = OpenAI(api_key=st.secrets["openai"]["api_key"])
+    client = get_openai_client(st.secrets["openai"]["api_key"])
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo", # 応答速度を優先
-            messages=[
-                {"role": "system", "content": checker_prompt}
-            ],
-            temperature=0, # 判定の安定性を高める
-            max_tokens=5 # 「達成」または「継続」の出力に十分なトークン数
-        )
+        # 応答速度を優先したモデル・判定が安定する temperature=0・「達成」「継続」に十分な max_tokens（model_routing の "checker"）
+        response = create(client, "checker", [{"role": "system", "content": checker_prompt}])
         result = response.choices[0].message.content.strip()
         
         # 「達成」という文字が含まれていれば「達成」と判断
@@ -406,45 +625,164 @@ AI: ピッチャーなんだ！すごいね。試合のときは緊張する？
     '''
     
     conversation_log = "\n".join(st.session_state.chat_history)
-    client = OpenAI(api_key=st.secrets["openai"]["api_key"])
+    client = get_openai_client(st.secrets["openai"]["api_key"])
 
-    # --- 評価を生成 ---
+    # --- 評価の入力 ---
     scenario_title = st.session_state.style_label
     # chapter_descriptions はグローバルスコープにある想定
     scenario_description = chapter_descriptions.get(scenario_title, "")
     eval_user_content = f"""**[評価対象の状況]**\nシナリオ: {scenario_title}\n状況設定: {scenario_description}\n\n**[会話ログ]**\n{conversation_log}"""
 
-    evaluation_response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": evaluation_prompt},
-            {"role": "user", "content": eval_user_content}
-        ],
-        temperature=0.25,
-    )
-    evaluation_result = evaluation_response.choices[0].message.content
+    # --- バックグラウンドで分析する場合は、ジョブを始めて（または既存のジョブの）状態を表示するだけ ---
+    if analysis_jobs is not None:
+        show_analysis_job(start_analysis_job(client, evaluation_prompt, summary_prompt, eval_user_content, conversation_log))
+        return
+
+    # --- 同じプレイの分析は一度だけ行う ---
+    # クリア・失敗画面では、ボタンを押すたびに再実行される。評価・要約の結果はセッションIDごとに保持し、
+    # 2回目以降は保持した評価を表示するだけにする（失敗した手順だけを次の再実行でやり直す）
+    session_id = st.session_state.session_id
+    post_game = st.session_state.post_game
+    if post_game is None or post_game["session_id"] != session_id:
+        post_game = {"session_id": session_id, "evaluation": None, "summary": None}
+        st.session_state.post_game = post_game
+    if post_game["evaluation"] is not None and post_game["summary"] is not None:
+        st.markdown("### Conversation Evaluation")
+        display_evaluation_result(post_game["evaluation"])
+        return
+
+    # --- 行動履歴の要約を生成して記録 ---
+    # 要約は会話ログだけで決まるので、評価の生成・表示・記録と並行して別スレッドで行う
+    summary_future = None
+    if post_game["summary"] is None:
+        username = st.session_state.username
+
+        def summarize():
+            summary_response = create(
+                client, "summarize",
+                [
+                    {"role": "system", "content": summary_prompt},
+                    {"role": "user", "content": conversation_log}
+                ],
+            )
+            summary_result = summary_response.choices[0].message.content
+            # 別スレッドからは st.session_state を使えないので、保存先に直接書き込む
+            store.record_message(username, summary_result, 'player_summary', "", "",
+                                 datetime.now(JST).strftime('%Y/%m/%d %H:%M'))
+            return summary_result
 
-    # --- 結果をパースして表示 ---
-    st.markdown("### Conversation Evaluation")
-    display_evaluation_result(evaluation_result)
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="post-game-summary")
+        summary_future = executor.submit(summarize)
+        executor.shutdown(wait=False)
+
+    # --- 評価を生成 ---
+    evaluation_result = post_game["evaluation"]
+    if evaluation_result is None:
+        try:
+            evaluation_response = create(
+                client, "evaluate",
+                [
+                    {"role": "system", "content": evaluation_prompt},
+                    {"role": "user", "content": eval_user_content}
+                ],
+            )
+            evaluation_result = evaluation_response.choices[0].message.content
+        except LLMError:
+            # 評価は保持しないので、次にこの画面を開いたときにやり直す
+            st.error("評価を作成できませんでした。時間をおいてもう一度お試しください。")
+
+    # --- 結果をパースして表示（届いたらすぐに表示し、記録はその後に行う） ---
+    if evaluation_result is not None:
+        st.markdown("### Conversation Evaluation")
+        display_evaluation_result(evaluation_result)
 
     # --- 結果をDBに記録 ---
-    now_str = datetime.now(JST).strftime('%Y/%m/%d %H:%M\n')
-    record_message(st.session_state.username, st.session_state["style_label"] + " " + now_str + evaluation_result, "eval")
+    if post_game["evaluation"] is None and evaluation_result is not None:
+        now_str = datetime.now(JST).strftime('%Y/%m/%d %H:%M\n')
+        record_message(st.session_state.username, st.session_state["style_label"] + " " + now_str + evaluation_result, "eval",
+                       chapter=st.session_state["style_label"], session_id=session_id)
+        post_game["evaluation"] = evaluation_result
 
-    # --- 行動履歴の要約を生成して記録 ---
-    summary_response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": summary_prompt},
-            {"role": "user", "content": conversation_log}
-        ],
-        temperature=0.25,
-    )
-    summary_result = summary_response.choices[0].message.content
-    record_message(st.session_state.username, summary_result, 'player_summary')
+    if summary_future is not None:
+        try:
+            summary_result = summary_future.result()
+        except LLMError:
+            return  # 要約も次の再実行でやり直す
+        except Exception:
+            # 要約の保存（スプレッドシート・SQLite）の失敗で、表示済みの評価の画面を壊さない。次の再実行でやり直す
+            logger.warning("saving the player summary failed", exc_info=True)
+            return
+        precompute_prompts(st.session_state.username, summary_result)
+        post_game["summary"] = summary_result
+
+
+
+
+# --- ゲーム終了後の分析をバックグラウンドのジョブとして始める ---
+def start_analysis_job(client, evaluation_prompt, summary_prompt, eval_user_content, conversation_log):
+    """同じプレイのジョブがあればそれを返す。ワーカーからは st.session_state を使えないので、必要な値は先に取り出す"""
+    username = st.session_state.username
+    chapter = st.session_state["style_label"]
+    session_id = st.session_state.session_id
+
+    def evaluate():
+        evaluation_response = create(
+            client, "evaluate",
+            [
+                {"role": "system", "content": evaluation_prompt},
+                {"role": "user", "content": eval_user_content}
+            ],
+        )
+        now = datetime.now(JST).strftime('%Y/%m/%d %H:%M')
+        eval_text = chapter + " " + now + "\n" + evaluation_response.choices[0].message.content
+        store.record_message(username, eval_text, "eval", chapter, session_id, now)
+        return eval_text
+
+    def summarize():
+        summary_response = create(
+            client, "summarize",
+            [
+                {"role": "system", "content": summary_prompt},
+                {"role": "user", "content": conversation_log}
+            ],
+        )
+        summary_result = summary_response.choices[0].message.content
+        store.record_message(username, summary_result, 'player_summary', "", "",
+                             datetime.now(JST).strftime('%Y/%m/%d %H:%M'))
+        precompute_prompts(username, summary_result, client)
+        return summary_result
+
+    return analysis_jobs.submit(username, session_id, chapter, {"evaluation": evaluate, "summary": summarize})
+
+# --- 分析ジョブの状態と、完成した評価の表示（作成中は2秒ごとにこの部分だけ再実行する） ---
+def show_analysis_job(job):
+    polling = job.status == "running"
+
+    @st.fragment(run_every=2 if polling else None)
+    def analysis_status():
+        if polling and job.status != "running":
+            # run_every は定義した時点で決まるので、ジョブが終わったらアプリ全体を一度だけ再実行して
+            # 更新を止め、サイドバー（作成中の件数）も更新する
+            st.rerun()
+        if "evaluation" in job.results:
+            st.markdown("### Conversation Evaluation")
+            display_evaluation_result(strip_title(job.results["evaluation"])[1])
+        elif "evaluation" not in job.errors:
+            st.info("評価を作成しています…。ホームに戻ったり別の章を始めたりしても、完成した評価は「過去のフィードバック」で確認できます。")
+        if job.errors and not job.running:
+            st.error("フィードバックの作成に失敗しました。")
+            if st.button("🔄 もう一度作成する"):
+                analysis_jobs.submit(job.username, job.session_id, job.chapter, job.steps)
+                st.rerun()
 
+    analysis_status()
 
+# --- 完成した評価を履歴のキャッシュに反映し、作成中のジョブの数を返す ---
+def collect_analysis_jobs(username):
+    for job in analysis_jobs.take_results(username, "evaluation"):
+        get_history_cache(st.session_state, username).append("eval", job.results["evaluation"], job.session_id)
+        st.toast(f"フィードバックが完成しました：{job.chapter}")
+    return sum(1 for job in analysis_jobs.for_user(username) if job.status == "running")
 
 
 # --- セッション管理初期化 ---
@@ -459,8 +797,12 @@ st.session_state.setdefault("chat",False)
 st.session_state.setdefault("first_session",True)
 st.session_state.setdefault("style_label", "ホーム") # 初期値を設定
 st.session_state.setdefault("eval",False)
+st.session_state.setdefault("session_id", "") # 1回のプレイ（章の開始から終了まで）を識別するID
 st.session_state.setdefault("hint_mode", "chat") # ヒント機能のモード管理（chat, select, ask_word, show_hint）
 st.session_state.setdefault("hint_message", "") # 表示するヒントメッセージ
+st.session_state.setdefault("satisfied_conditions", []) # turn_mode が merged / compare のとき、判定で満たされた条件
+st.session_state.setdefault("mission_tracker", None) # mission_checker が tracker のとき、今回のプレイのミッション条件の状態
+st.session_state.setdefault("post_game", None) # クリア・失敗後の分析結果（session_id, evaluation, summary）
 
 # --- ログイン前のUI ---
 if not st.session_state.logged_in:
@@ -532,6 +874,11 @@ if st.session_state.logged_in:
     with st.sidebar:
         st.title("OPTION")
 
+        if analysis_jobs is not None:
+            running_jobs = collect_analysis_jobs(st.session_state.username)
+            if running_jobs:
+                st.caption(f"⏳ フィードバックを作成中（{running_jobs}件）")
+
         # --- Game.pyから移植したプロンプト設定 ---
         base_prompt = '''
             あなたには、私が作成する「日本語学習者支援ゲーム」の登場人物を演じてもらいます。
@@ -764,7 +1111,12 @@ if st.session_state.logged_in:
 
         # ログアウト
         if st.button("🚪 ログアウト"):
-        
+            # キューに残っている書き込みをログアウト前に反映しておく（失敗してもキューとスプールに残り、後で再試行される）
+            try:
+                store.flush(st.session_state.username)
+            except Exception:
+                logger.warning("flushing queued writes on logout failed", exc_info=True)
+
             st.session_state["show_history"] = False
             st.session_state["home"] = True
             st.session_state["logged_in"] = False
@@ -777,6 +1129,7 @@ if st.session_state.logged_in:
             #st.session_state["username"] = False
             st.session_state.chat_history = []
             st.session_state["style_label"] = "ホーム"
+            st.session_state.pop("history_cache", None)
             st.rerun()
 
     if st.session_state["home"]:
@@ -825,7 +1178,7 @@ if st.session_state.logged_in:
 
         # --- AIが会話を始める処理 ---
         if st.session_state.first_session and st.session_state.chat:
-            client = OpenAI(api_key=st.secrets["openai"]["api_key"])
+            client = get_openai_client(st.secrets["openai"]["api_key"])
 
             # --- ★動的プロンプト生成をここで行う --- #
             # 1. 現在の章の基本プロンプトを取得
@@ -845,22 +1198,43 @@ if st.session_state.logged_in:
             # --- ★動的プロンプト生成ここまで --- #
 
             # AIが最初の発言をする
-            messages = [
-                {"role": "system", "content": final_system_prompt}
-            ]
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=messages,
-                temperature=0, # 最初の発言は固定なので、ランダム性をなくす
-            )
-            reply = response.choices[0].message.content
+            # パーソナライズしていなければシナリオに書かれた言葉をそのまま使い、
+            # パーソナライズしていれば、同じプロンプトで生成済みの発言を使う（どちらもモデルを呼ばない）
+            if personalized_prompt == base_prompt + selected_story_prompt:
+                reply = extract_opening(selected_story_prompt)
+            else:
+                reply = prompt_cache.get(opening_key(final_system_prompt, route("dialog")["model"])) if prompt_cache is not None else None
+            if reply is None:
+                messages = [
+                    {"role": "system", "content": final_system_prompt}
+                ]
+                # 生成中の発言はその場で吹き出しに流し、完成したら下の履歴表示に任せる
+                opening_placeholder = st.empty()
+                try:
+                    reply, reply_model = stream_reply(client, messages, opening_placeholder,
+                                                      temperature=0) # 最初の発言は固定なので、ランダム性をなくす
+                except LLMError:
+                    # first_session のままなので、次の再実行で最初の発言からやり直す
+                    opening_placeholder.empty()
+                    st.error("AIの応答を取得できませんでした。しばらくしてからページを再読み込みしてください。")
+                    st.stop()
+                opening_placeholder.empty()
+                # 代わりのモデルが生成した発言は、表のモデルのキーで保存しない
+                if prompt_cache is not None and served_by(reply_model, route("dialog")["model"]):
+                    prompt_cache.put(opening_key(final_system_prompt, route("dialog")["model"]), reply)
             
             st.session_state.chat_history.append(f"AI: {reply}")
             st.session_state.first_session = False # AIが話したので、次はユーザーの番
+            st.session_state.satisfied_conditions = []
+            # ミッション条件はプレイの開始時に一度だけチェックリストにする（条件が読み取れなければ従来の判定）
+            tracker = MissionTracker(selected_story_prompt, mission_list_need) if mission_checker == "tracker" else None
+            st.session_state.mission_tracker = tracker if tracker and tracker.conditions else None
+            st.session_state.session_id = uuid.uuid4().hex
 
             now = datetime.now(JST).strftime('%Y/%m/%d %H:%M')            
             full_message = st.session_state["style_label"] + " " + now + "\n" + f"AI: {reply}"
-            record_message(st.session_state.username, full_message, "message")
+            record_message(st.session_state.username, full_message, "message",
+                           chapter=st.session_state["style_label"], session_id=st.session_state.session_id)
             
     if st.session_state["clear_screen"]:
         st.success("ミッション達成！おめでとうございます！")
@@ -882,34 +1256,18 @@ if st.session_state.logged_in:
     if st.session_state.chat_history and not st.session_state["clear_screen"] and not st.session_state["home"] and not st.session_state["Failed_screen"]:
         for msg in st.session_state.chat_history:
             if msg.startswith("ユーザー:"):
-                # ユーザー → 右寄せ（グリーン）
-                st.markdown(
-                    f"""
-                    <div style='display: flex; justify-content: flex-end; margin: 4px 0'>
-                        <div style='background-color: #DCF8C6; padding: 8px 12px; border-radius: 8px; max-width: 80%; word-wrap: break-word; text-align: left; font-size: 16px; color:black;'>
-                            {msg.replace("ユーザー:", "")}
-                        </div>
-                    </div>
-                    """,
-                    unsafe_allow_html=True
-                )
-
+                st.markdown(user_bubble(msg.replace("ユーザー:", "")), unsafe_allow_html=True)
             elif msg.startswith("AI:"):
-                # AI → 左寄せ（グレー）
-                st.markdown(
-                    f"""
-                    <div style='display: flex; justify-content: flex-start; margin: 4px 0'>
-                        <div style='background-color: #E6E6EA; padding: 8px 12px; border-radius: 8px; max-width: 80%; word-wrap: break-word; text-align: left; font-size: 16px; color:black;'>
-                            {msg.replace("AI:", "")}
-                        </div>
-                    </div>
-                    """,
-                    unsafe_allow_html=True
-                )
+                st.markdown(ai_bubble(msg.replace("AI:", "")), unsafe_allow_html=True)
+
+    # 送信したメッセージとストリーミング中の応答は、履歴の直後（入力フォームの上）に表示する
+    live_area = st.empty()
 
 
     # --- 入力フォーム ---
     if st.session_state["chat"] and not st.session_state.first_session:
+        prefetch_action_hint()  # 直前のAIの発言に対するヒントを裏で用意しておく
+
         # --- ヒントメッセージがセッションにあれば表示し、その後クリアする ---
         if st.session_state.get("hint_message"):
             st.info(st.session_state.hint_message)
@@ -975,7 +1333,7 @@ if st.session_state.logged_in:
 
             if submit_button and user_input.strip():
                 # (既存の送信処理)
-                client = OpenAI(api_key=st.secrets["openai"]["api_key"])
+                client = get_openai_client(st.secrets["openai"]["api_key"])
                 system_prompt = st.session_state.get("agent_prompt", "あなたは親切な日本語学習の先生です。")
                 
                 # 履歴を準備
@@ -988,10 +1346,34 @@ if st.session_state.logged_in:
                 
                 # 今回のユーザー入力を追加
                 messages.append({"role": "user", "content": user_input})
+
+                # 古い発言は要約にまとめ、直近の往復だけをそのまま送る
+                if context_window:
+                    chat_context = get_chat_context(st.session_state, st.session_state.session_id,
+                                                    context_keep_exchanges, context_summary_tokens)
+                    messages, _ = chat_context.fit(client, messages)
                 
-                # 会話AIからの応答を取得
-                response = client.chat.completions.create(model="gpt-4o", messages=messages, temperature=0.25)
-                reply = response.choices[0].message.content
+                # 会話AIからの応答をストリーミングで表示しながら取得
+                verdict = None
+                try:
+                    with live_area.container():
+                        st.markdown(user_bubble(user_input), unsafe_allow_html=True)
+                        reply_placeholder = st.empty()
+                        if turn_mode == "two_call":
+                            reply, _ = stream_reply(client, messages, reply_placeholder)
+                        else:
+                            # 応答と判定を1回の呼び出しで受け取る（判定の指示はシステムプロンプトの末尾に追加）
+                            messages[0] = {"role": "system", "content": system_prompt + TURN_JUDGE_PROMPT}
+                            turn = stream_turn(client, messages,
+                                               lambda text: reply_placeholder.markdown(ai_bubble(text + "▌"), unsafe_allow_html=True))
+                            reply_placeholder.markdown(ai_bubble(turn["reply"]), unsafe_allow_html=True)
+                            reply, verdict = turn["reply"], turn["verdict"]
+                            st.session_state.satisfied_conditions = turn["satisfied_conditions"]
+                except LLMError:
+                    # 応答が得られなかったターンは履歴にも記録にも残さない
+                    live_area.empty()
+                    st.error(f"AIの応答を取得できませんでした。もう一度送信してください。（送信した内容：{user_input}）")
+                    st.stop()
                 
                 # 会話履歴を更新
                 st.session_state.chat_history.append(f"ユーザー: {user_input}")
@@ -999,19 +1381,36 @@ if st.session_state.logged_in:
 
                 # DBに会話を記録
                 full_message = f"ユーザー: {user_input}\nAI: {reply}"
-                record_message(st.session_state.username, full_message,"message")
+                record_message(st.session_state.username, full_message,"message",
+                               chapter=st.session_state["style_label"], session_id=st.session_state.session_id)
                 
                 # --- ミッション達成判定 ---
-                # 1. 監視エージェントによる判定
-                conversation_log_for_check = "\n".join(st.session_state.chat_history)
-                agent_prompt_for_check = st.session_state.get("agent_prompt", "")
-                status_check_result = check_mission_status(conversation_log_for_check, agent_prompt_for_check)
-
-                # 2. 会話AIの応答と監視エージェントの判定結果を総合的に判断
-                if "ミッション達成" in reply or status_check_result == "達成":
+                # 1. 監視エージェントによる判定（merged では応答と一緒に受け取った判定を使う）
+                def run_checker():
+                    if st.session_state.mission_tracker is not None:
+                        # 前回の判定以降のやり取り（事前チェックで省いたターンを含む）だけをチェックリストと一緒に送る
+                        return st.session_state.mission_tracker.update(client, st.session_state.chat_history)
+                    conversation_log_for_check = "\n".join(st.session_state.chat_history)
+                    agent_prompt_for_check = st.session_state.get("agent_prompt", "")
+                    return check_mission_status(conversation_log_for_check, agent_prompt_for_check)
+
+                if turn_mode != "merged":
+                    if mission_screen:
+                        status_check_result = screen_turn(st.session_state["style_label"], st.session_state.chat_history,
+                                                          run_checker, screen_audit_rate, reply,
+                                                          mission_list_need if mission_checker == "tracker" else "all")
+                    else:
+                        status_check_result = run_checker()
+                    if verdict is None:
+                        verdict = status_check_result
+                    else:
+                        log_verdicts(verdict, status_check_result)
+
+                # 2. 会話AIの応答と判定結果を総合的に判断
+                if "ミッション達成" in reply or verdict == "達成":
                     st.session_state.clear_screen = True
                     st.session_state.chat = False
-                elif "ミッション失敗" in reply: # 会話AIが明示的に失敗を宣言した場合
+                elif "ミッション失敗" in reply or verdict == "失敗": # 会話AIが明示的に失敗を宣言した場合
                     st.session_state.Failed_screen = True
                     st.session_state.chat = False
                 
@@ -1022,28 +1421,33 @@ if st.session_state.logged_in:
     elif st.session_state.show_history:
         st.markdown("### 📜 会話履歴")
 
-        history = load_message(st.session_state.username, "message")
+        # 会話の索引（章・日時・ターン数・結果・スコア）はセッション内でキャッシュし、記録のたびに更新される
+        history_cache = get_history_cache(st.session_state, st.session_state.username)
+        sessions = history_cache.load_index(list_sessions)
 
-        if not history.strip():
+        if not sessions:
             st.info("（会話履歴はまだありません）")
         else:
-            # 「Chapter + 日付」ごとのブロックを抽出
-            pattern = r"(Chapter \d+: .*?\d{4}/\d{2}/\d{2} \d{2}:\d{2})(.*?)(?=Chapter \d+: |\Z)"
-            matches = re.findall(pattern, history, re.DOTALL)
+            # 章・日付の絞り込みとページ送りは索引だけで行う（本文は読まない）
+            col1, col2 = st.columns(2)
+            with col1:
+                chapter = st.selectbox("章で絞り込む", ["すべて"] + sorted({e["chapter"] for e in sessions}))
+            with col2:
+                date = st.selectbox("日付で絞り込む", ["すべて"] + sorted({e["timestamp"][:10] for e in sessions}, reverse=True))
+            filtered = filter_sessions(sessions, "" if chapter == "すべて" else chapter, "" if date == "すべて" else date)
 
-            if not matches:
-                st.warning("履歴の解析に失敗しました。")
+            if not filtered:
+                st.warning("条件に合う会話がありません。")
             else:
-                # タイトルだけをリスト化（選択肢）
-                options = [title.strip() for title, _ in matches]
-                selected = st.selectbox("表示する会話を選んでください", options[::-1])  # 新しい順
+                pages = page_count(filtered)
+                page = st.number_input(f"ページ（全{pages}ページ）", min_value=1, max_value=pages, value=1, step=1)
+                selected = st.selectbox("表示する会話を選んでください", page_of(filtered, page), format_func=session_label)  # 新しい順
 
-                # 選ばれたタイトルのブロックのみ表示
-                selected_block = next(((t, c) for t, c in matches if t.strip() == selected), None)
+                # 選ばれた会話の本文だけを読み出して表示
+                content = history_cache.load_body(load_session, selected)
 
-                if selected_block:
-                    title, content = selected_block
-                    st.markdown(f"#### {title.strip()}")
+                if content:
+                    st.markdown(f"#### {selected['chapter']} {selected['timestamp']}")
 
                     lines = content.strip().split("\n")
                     for line in lines:
@@ -1078,27 +1482,36 @@ if st.session_state.logged_in:
 
     elif st.session_state["eval"]:
         st.title("🎩過去のフィードバック")
+        if analysis_jobs is not None and any(job.status == "running" for job in analysis_jobs.for_user(st.session_state["username"])):
+            st.info("作成中のフィードバックがあります。完成すると一覧に追加されます。")
 
-        # メッセージ取得（load_messageは既存関数）
-        message = load_message(st.session_state["username"], "eval")
+        # 解析済みのフィードバック一覧はセッション内でキャッシュし、記録のたびに追記される
+        history_cache = get_history_cache(st.session_state, st.session_state["username"])
+        feedback_dict = history_cache.load_feedback(load_message)
 
-        if not message:
+        if not feedback_dict and not history_cache.unparsed["eval"]:
             st.info("フィードバックはまだ登録されていません。")
         else:
 
-            # 「Chapter X: ○○YYYY/MM/DD hh:mm」ごとにフィードバックを抽出
-            pattern = r"(Chapter \d+: .*?\d{4}/\d{2}/\d{2} \d{2}:\d{2})\n(.*?)(?=Chapter \d+: |\Z)"
-            matches = re.findall(pattern, message, re.DOTALL)
-
-            if not matches:
+            if not feedback_dict:
                 st.warning("フィードバックが解析できませんでした。")
             else:
-                # セレクトボックスの選択肢用にタイトルだけ使用
-                feedback_dict = {title.strip(): body.strip() for title, body in matches}
+
+                # スコアの推移（保存済みの数値から描画し、評価本文は解析しない）
+                score_records = history_cache.load_scores(load_scores)
+                if len(score_records) >= 2:
+                    st.markdown("### スコアの推移")
+                    st.line_chart({SCORE_LABELS[field]: [r[field] for r in score_records] for field in SCORE_FIELDS})
 
                 # セレクトボックスでフィードバック選択
                 selected_title = st.selectbox("表示するフィードバックを選んでください", sorted(feedback_dict.keys(), reverse=True))
 
+                # 選んだフィードバックの観点別スコア
+                record = next((r for r in reversed(score_records) if score_title(r) == selected_title), None)
+                if record:
+                    for col, field in zip(st.columns(len(SCORE_FIELDS)), SCORE_FIELDS):
+                        col.metric(SCORE_LABELS[field], "-" if record[field] is None else record[field])
+
                 # 表示（タイトルは非表示）
                 st.markdown("### フィードバック内容")
                 selected_body = feedback_dict[selected_title]
@@ -1,74 +1,155 @@
 import streamlit as st
 import streamlit.components.v1 as components
-from openai import OpenAI
-import gspread
-from google.oauth2.service_account import Credentials
+import logging
 import time
-import re
 from datetime import datetime, timezone, timedelta
+import uuid
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from user_store import SheetsUserStore, get_sqlite_store
+from resources import get_openai_client, get_spreadsheet, get_first_worksheet
+from history_cache import get_history_cache
+from session_index import filter_sessions, page_count, page_of
+from scores import SCORE_FIELDS, score_title
+from prompt_cache import MAX_ENTRIES, get_prompt_cache, prompt_key
+from prompt_precompute import get_prompt_precomputer
+from word_lookup import get_word_lookup
+from hint_prefetch import get_hint_prefetch
+from model_routing import configure, route
+from llm_client import LLMError, create, read_stream, served_by
+from opening_line import opening_key
+
+logger = logging.getLogger(__name__)
 
 # --- UTC timezone setting ---
 UTC = timezone.utc
 
-# --- Google Sheets Authentication ---
-scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-creds_dict = st.secrets["gcp_service_account"]
-credentials = Credentials.from_service_account_info(creds_dict, scopes=scope)
-gs_client = gspread.authorize(credentials)
-sheet = gs_client.open("UserData").sheet1 # Assuming the same sheet is used for user data
+# --- Storage backend selection ---
+# Choose "sheets" (default) or "sqlite" with backend under [storage] in secrets.
+# The sqlite backend runs without Google credentials (load tests and CI)
+storage_config = st.secrets.get("storage", {})
+if storage_config.get("backend", "sheets") == "sqlite":
+    store = get_sqlite_store(storage_config.get("sqlite_path", "userdata.db"))
+else:
+    from message_log import get_message_log
+    from scores import get_score_log
+    from session_index import get_session_log
+    from write_behind import WriteBehindQueue, SheetsBatchWriter, get_write_behind, spool_path_for
+
+    # --- Google Sheets Authentication ---
+    # The authorized client and opened sheets are shared process-wide, not rebuilt on every rerun
+    spreadsheet = get_spreadsheet(st.secrets["gcp_service_account"], "UserData")
+    sheet = get_first_worksheet(st.secrets["gcp_service_account"], "UserData") # Assuming the same sheet is used for user data
+
+    # --- Message log storage mode ---
+    # With message_log = true under [storage], chat turns and evaluations are
+    # appended one row each to the MessageLog worksheet instead of growing a UserData cell
+    message_log = get_message_log(spreadsheet) if storage_config.get("message_log", False) else None
+
+    # --- Score storage ---
+    # With score_log = true under [storage], per-criterion scores are extracted once when an
+    # evaluation is recorded and stored as numbers in the Scores worksheet
+    score_log = get_score_log(spreadsheet) if storage_config.get("score_log", False) else None
+
+    # --- Session index storage ---
+    # With session_index = true under [storage], every record also appends a small row (chapter, time,
+    # turns, outcome, score) to the SessionIndex worksheet, and the history list is built from those rows
+    # alone (a conversation's body is read only when it is opened)
+    session_log = get_session_log(spreadsheet) if storage_config.get("session_index", False) else None
+
+    # --- Write-behind queue ---
+    # With write_behind = true under [storage], record_message only enqueues the write and
+    # a background thread flushes queued writes to the sheet in batches
+    # The spool file is separate per app and spreadsheet by default (spool_path overrides it)
+    write_queue = get_write_behind(spreadsheet.id, lambda: WriteBehindQueue(
+        SheetsBatchWriter(sheet, message_log, score_log, session_log),
+        spool_path=storage_config.get("spool_path", spool_path_for("en", spreadsheet.id)),
+        interval=storage_config.get("flush_interval", 2.0),
+        max_pending=storage_config.get("flush_max_pending", 20),
+    )) if storage_config.get("write_behind", False) else None
+
+    store = SheetsUserStore(sheet, message_log, write_queue, score_log, session_log)
+
+# --- Cache of personalized prompts ---
+# With prompt_cache = true under [storage], make_new_prompt results are saved in prompt_cache_dir
+# keyed by a hash of their inputs, so restarting a chapter with the same summary skips the model call
+prompt_cache = get_prompt_cache(
+    storage_config.get("prompt_cache_dir", "prompt_cache"),
+    max_entries=storage_config.get("prompt_cache_max_entries", MAX_ENTRIES),
+) if storage_config.get("prompt_cache", False) else None
+# With prompt_precompute = true (requires prompt_cache), saving a summary starts generating every chapter's prompt in the background
+# prompt_cache_max_entries grows by one entry per chapter (len(story_prompt)) per user when precomputing,
+# so the default (prompt_cache.MAX_ENTRIES) is large enough to keep a few hundred users' prompts
+prompt_precomputer = get_prompt_precomputer(
+    prompt_cache, max_workers=storage_config.get("prompt_precompute_workers", 2),
+) if prompt_cache is not None and storage_config.get("prompt_precompute", False) else None
+
+# --- Word meaning lookup ---
+# With word_lookup = true under [hints] in secrets, look words up in the bundled dictionary, then in
+# the cache of previous answers, and only then ask the model
+hint_config = st.secrets.get("hints", {})
+word_lookup = get_word_lookup(
+    hint_config.get("word_dictionary", "dictionary/en_ja.tsv"),
+    get_prompt_cache(hint_config.get("word_cache_dir", "word_cache"),
+                     max_entries=hint_config.get("word_cache_max_entries", 2000)),
+) if hint_config.get("word_lookup", False) else None
+# With action_prefetch = true, generate the next-action hint in the background with a cheaper model
+# after every AI reply (at most action_prefetch_budget times per play)
+action_prefetch = hint_config.get("action_prefetch", False)
+action_prefetch_budget = hint_config.get("action_prefetch_budget", 20)
+action_prefetch_model = hint_config.get("action_prefetch_model", "gpt-4o-mini")
+
+# --- Models per call site ---
+# Override the defaults in model_routing.ROUTES with [models.<call site>] in secrets
+configure(st.secrets.get("models", {}))
 
 # --- Check if user exists ---
 def user_exists(username):
-    users = sheet.col_values(1)
-    return username in users
+    return store.user_exists(username)
 
 # --- Check if password matches ---
 def check_password(username, password):
-    users = sheet.get_all_records()
-    for user in users:
-        if user["username"] == username and user["password"] == password:
-            return True
-    return False
+    return store.check_password(username, password)
 
 # --- Register new user ---
 def register_user(username, password):
-    if user_exists(username):
-        return False
-    # Add a row with 5 columns to match the header
-    sheet.append_row([username, password, "", "", ""])
-    return True
+    return store.register_user(username, password)
 
 # --- Append message ---
-def record_message(username, new_message, where):
-    all_users = sheet.get_all_records()
-    # Manage column mapping with a dictionary
-    col_map = {"message": 3, "eval": 4, "player_summary": 5}
-    col_index = col_map.get(where)
-    if not col_index:
-        return # Do nothing if the target column doesn't exist
-
-    for i, user in enumerate(all_users, start=2):
-        if user["username"] == username:
-            # For player_summary, always overwrite with new content
-            if where == 'player_summary':
-                combined = new_message
-            else: # For message and eval, append as before
-                old_message = user.get(where, "")
-                combined = old_message + "\n" + new_message if old_message else new_message
-            
-            sheet.update_cell(i, col_index, combined)
-            break
+def record_message(username, new_message, where, chapter="", session_id=""):
+    now = datetime.now(UTC).strftime('%Y/%m/%d %H:%M')
+    store.record_message(username, new_message, where, chapter, session_id, now)
+    # Apply the write to the parsed lists used by the history views as well
+    get_history_cache(st.session_state, username).append(where, new_message, session_id)
 
 # --- Load message history ---
 def load_message(username, item):
-    all_users = sheet.get_all_records()
-    for user in all_users:
-        if user["username"] == username:
-            return user.get(item, "")
-    return ""
+    return store.load_message(username, item)
+
+# --- Load the session index and session bodies ---
+def list_sessions(username):
+    return store.list_sessions(username)
+
+def load_session(username, entry, memo=None):
+    return store.load_session(username, entry, memo)
+
+# --- Load per-criterion evaluation scores ---
+def load_scores(username):
+    return store.load_scores(username)
+
+SCORE_LABELS = {"grammar": "Grammar & vocabulary", "naturalness": "TPO & politeness", "fluency": "Conversation flow"}
+
+# --- Display name of a session index entry ---
+OUTCOME_LABELS = {"cleared": "Cleared", "failed": "Failed"}
+
+def session_label(entry):
+    score = f"score {entry['score']}" if entry["score"] is not None else "not evaluated"
+    outcome = OUTCOME_LABELS.get(entry["outcome"], "Unfinished")
+    return f"{entry['chapter']} {entry['timestamp']} | {entry['turns']} turns | {outcome} | {score}"
 
 # --- Dynamic Prompt Generation ---
-def make_new_prompt(username, base_prompt_text, selected_prompt_text):
+def personalize_job(base_prompt_text, selected_prompt_text, persona):
+    """Return (cache key, function taking a client that generates the prompt) for personalizing with a summary"""
     making_prompt = '''
         You are responsible for the **dynamic prompt generation feature** of an "English Language Learning Support Game" that I am creating.
         This game aims to help non-native English speakers improve their English skills through realistic conversations while simulating life in the United States.
@@ -98,30 +179,56 @@ def make_new_prompt(username, base_prompt_text, selected_prompt_text):
         *   The game content must not become unnatural. Also, be careful with the phrase "Mission Accomplished" as it is a keyword for clearing the game.
     '''
     
+    persona_text = "\"List of Player's Linguistic Challenges" + persona
+    
+    # API call for dynamic prompt generation
+    model = route("personalize")["model"]
+
+    def generate(client):
+        messages = [{
+            "role": "system", 
+            "content": making_prompt + base_prompt_text + selected_prompt_text + persona_text + making_prompt_end
+        }]
+        
+        completion = create(client, "personalize", messages)
+        return completion.choices[0].message.content, served_by(completion.model, model)
+
+    return prompt_key(making_prompt + making_prompt_end, base_prompt_text, selected_prompt_text, persona, model), generate
+
+# --- Prompt for a chapter start (personalized when a summary exists) ---
+def make_new_prompt(username, base_prompt_text, selected_prompt_text):
     # Load player summary data from Google Spreadsheet
     persona = load_message(username, "player_summary")
     if not persona:
         # If there is no summary data, return the original prompt without personalization
         return base_prompt_text + selected_prompt_text
 
-    persona_text = "\"List of Player's Linguistic Challenges" + persona
-    
-    # API call for dynamic prompt generation
-    client = OpenAI(api_key=st.secrets["openai"]["api_key"])
-    messages = [{
-        "role": "system", 
-        "content": making_prompt + base_prompt_text + selected_prompt_text + persona_text + making_prompt_end
-    }]
-    
-    completion = client.chat.completions.create(
-        model="gpt-4o",
-        messages=messages,
-        temperature=0
-    )
-    return completion.choices[0].message.content
+    key, generate = personalize_job(base_prompt_text, selected_prompt_text, persona)
+    client = get_openai_client(st.secrets["openai"]["api_key"])
+    try:
+        if prompt_cache is None:
+            return generate(client)[0]
+        if prompt_precomputer is not None:
+            prompt_precomputer.wait(key)  # If the same prompt is being generated in the background, wait for it instead
+        return prompt_cache.get_or_create(key, lambda: generate(client))
+    except LLMError:
+        # If personalization fails, start the chapter with the original prompt
+        return base_prompt_text + selected_prompt_text
+
+# --- Generate personalized prompts for every chapter in the background ---
+def precompute_prompts(username, persona):
+    if prompt_precomputer is None or not persona:
+        return
+    client = get_openai_client(st.secrets["openai"]["api_key"])
+    jobs = []
+    for chapter_prompt in story_prompt:
+        key, generate = personalize_job(base_prompt, chapter_prompt[0], persona)
+        jobs.append((key, functools.partial(generate, client)))
+    prompt_precomputer.schedule(username, jobs)
 
 # --- Hint Generation Function ---
-def generate_hint(hint_type, user_input=None):
+def hint_prompt(hint_type, user_input=None):
+    """(system_content, hint_instruction) for a hint, or None if it cannot be made"""
     # Include current game situation in the prompt
     game_prompt = st.session_state.get("agent_prompt", "")
     conversation_log = "\n".join(st.session_state.chat_history)
@@ -162,19 +269,95 @@ def generate_hint(hint_type, user_input=None):
         system_content = "あなたは日本語辞書です。"
 
     else:
-        return "ヒントを生成できませんでした。"
-
+        return None
+    return system_content, hint_instruction
 
-    client = OpenAI(api_key=st.secrets["openai"]["api_key"])
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
+def hint_response(client, site, system_content, hint_instruction, model=None):
+    return create(
+        client, site,
+        [
             {"role": "system", "content": system_content},
             {"role": "user", "content": hint_instruction}
         ],
-        temperature=0.25,
+        model=model,
     )
-    return response.choices[0].message.content
+
+def ask_hint_model(client, site, system_content, hint_instruction, model=None):
+    return hint_response(client, site, system_content, hint_instruction, model).choices[0].message.content
+
+def generate_hint(hint_type, user_input=None):
+    prompt = hint_prompt(hint_type, user_input)
+    if prompt is None:
+        return "ヒントを生成できませんでした。"
+    system_content, hint_instruction = prompt
+
+    if hint_type == "action" and action_prefetch:
+        # Return this turn's prefetched hint if there is one (waiting briefly if it is running, generating it here if it has not started)
+        prefetch = get_hint_prefetch(st.session_state, st.session_state.session_id, action_prefetch_budget)
+        hint = prefetch.take(len(st.session_state.chat_history))
+        if hint:
+            return hint
+
+    site = "hint_" + hint_type
+    model = route(site)["model"]
+    client = get_openai_client(st.secrets["openai"]["api_key"])
+    ask_model = functools.partial(ask_hint_model, client, site, system_content, hint_instruction)
+
+    def ask_word_model():
+        # An answer from a fallback model is not cached under the routed model's key
+        response = hint_response(client, site, system_content, hint_instruction)
+        return response.choices[0].message.content, served_by(response.model, model)
+
+    try:
+        if hint_type == "word" and word_lookup is not None:
+            # The word prompt depends only on the word, so answer from the dictionary or a previous answer when possible
+            return word_lookup.lookup(user_input, prompt_key(system_content, hint_instruction, model), ask_word_model)
+        return ask_model()
+    except LLMError:
+        return "ヒントを生成できませんでした。"
+
+# --- Prefetch the next-action hint (called whenever an AI reply is shown; once per turn) ---
+def prefetch_action_hint():
+    if not action_prefetch:
+        return
+    prefetch = get_hint_prefetch(st.session_state, st.session_state.session_id, action_prefetch_budget)
+    turn = len(st.session_state.chat_history)
+    if not prefetch.wants(turn):
+        return
+    system_content, hint_instruction = hint_prompt("action")
+    client = get_openai_client(st.secrets["openai"]["api_key"])
+    prefetch.start(turn, functools.partial(ask_hint_model, client, "hint_action", system_content, hint_instruction,
+                                             action_prefetch_model))
+
+# --- Chat bubbles ---
+def user_bubble(text):
+    # User -> right-aligned (green)
+    return ("<div style='display: flex; justify-content: flex-end; margin: 4px 0'>"
+            "<div style='background-color: #DCF8C6; padding: 8px 12px; border-radius: 8px; max-width: 80%; "
+            "word-wrap: break-word; text-align: left; font-size: 16px; color:black;'>"
+            f"{text}</div></div>")
+
+def ai_bubble(text):
+    # AI -> left-aligned (gray)
+    return ("<div style='display: flex; justify-content: flex-start; margin: 4px 0'>"
+            "<div style='background-color: #E6E6EA; padding: 8px 12px; border-radius: 8px; max-width: 80%; "
+            "word-wrap: break-word; text-align: left; font-size: 16px; color:black;'>"
+            f"{text}</div></div>")
+
+# --- Stream the dialog reply ---
+def stream_reply(client, messages, placeholder, temperature=None):
+    """Render the reply token by token into a bubble in placeholder and return (full reply, model that answered) (LLMError if the stream breaks)"""
+    stream = create(client, "dialog", messages, temperature=temperature, stream=True)
+    reply = ""
+    model = None
+    for chunk in read_stream("dialog", stream):
+        model = getattr(chunk, "model", None) or model
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            reply += delta
+            placeholder.markdown(ai_bubble(reply + "▌"), unsafe_allow_html=True)
+    placeholder.markdown(ai_bubble(reply), unsafe_allow_html=True)
+    return reply, model
 
 # --- Session State Initialization ---
 st.session_state.setdefault("logged_in", False)
@@ -187,8 +370,10 @@ st.session_state.setdefault("chat", False)
 st.session_state.setdefault("first_session", True)
 st.session_state.setdefault("style_label", "Select Situation") # Set initial value
 st.session_state.setdefault("eval", False)
+st.session_state.setdefault("session_id", "") # Identifies one play-through of a chapter
 st.session_state.setdefault("hint_mode", "chat") # Hint mode management (chat, select, ask_word, show_hint)
 st.session_state.setdefault("hint_message", "") # Hint message to display
+st.session_state.setdefault("post_game", None) # Post-game analysis results (session_id, evaluation, summary)
 st.session_state.setdefault("Failed_screen",False)
 
 # --- UI Before Login ---
@@ -446,6 +631,11 @@ if st.session_state.logged_in:
                     st.rerun()
 
         if st.button("🚪 Logout"):
+            # Flush this user's queued writes before logging out (on failure they stay queued and spooled for a later retry)
+            try:
+                store.flush(st.session_state.username)
+            except Exception:
+                logger.warning("flushing queued writes on logout failed", exc_info=True)
             st.session_state["show_history"] = False
             st.session_state["home"] = True
             st.session_state["logged_in"] = False
@@ -456,6 +646,7 @@ if st.session_state.logged_in:
             st.session_state.username = ""
             st.session_state.chat_history = []
             st.session_state["style_label"] = "Select Situation"
+            st.session_state.pop("history_cache", None)
             st.rerun()
 
     if st.session_state["home"]:
@@ -496,7 +687,7 @@ if st.session_state.logged_in:
 
     if not st.session_state["home"] and not st.session_state["show_history"] and not st.session_state["eval"]:
         if st.session_state.first_session and st.session_state.chat:
-            client = OpenAI(api_key=st.secrets["openai"]["api_key"])
+            client = get_openai_client(st.secrets["openai"]["api_key"])
 
             chapter_index = stories.index(st.session_state.style_label) - 1
             selected_story_prompt = story_prompt[chapter_index][0]
@@ -510,22 +701,35 @@ if st.session_state.logged_in:
             final_system_prompt = personalized_prompt + end_prompt
             st.session_state.agent_prompt = final_system_prompt
 
-            messages = [
-                {"role": "system", "content": final_system_prompt}
-            ]
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=messages,
-                temperature=0,
-            )
-            reply = response.choices[0].message.content
+            # The opening line is generated at temperature 0, so reuse the line generated earlier for the
+            # same system prompt (the scenarios here only describe the opening, so it cannot be taken from them)
+            reply = prompt_cache.get(opening_key(final_system_prompt, route("dialog")["model"])) if prompt_cache is not None else None
+            if reply is None:
+                messages = [
+                    {"role": "system", "content": final_system_prompt}
+                ]
+                # Stream the line into a bubble, then leave it to the history display below
+                opening_placeholder = st.empty()
+                try:
+                    reply, reply_model = stream_reply(client, messages, opening_placeholder, temperature=0)
+                except LLMError:
+                    # first_session is still set, so the next rerun starts over from the opening line
+                    opening_placeholder.empty()
+                    st.error("AIの応答を取得できませんでした。しばらくしてからページを再読み込みしてください。")
+                    st.stop()
+                opening_placeholder.empty()
+                # A line generated by a fallback model is not cached under the routed model's key
+                if prompt_cache is not None and served_by(reply_model, route("dialog")["model"]):
+                    prompt_cache.put(opening_key(final_system_prompt, route("dialog")["model"]), reply)
             
             st.session_state.chat_history.append(f"AI: {reply}")
             st.session_state.first_session = False
+            st.session_state.session_id = uuid.uuid4().hex
 
             now = datetime.now(UTC).strftime('%Y/%m/%d %H:%M')            
             full_message = st.session_state["style_label"] + " " + now + "\n" + f"AI: {reply}"
-            record_message(st.session_state.username, full_message, "message")
+            record_message(st.session_state.username, full_message, "message",
+                           chapter=st.session_state["style_label"], session_id=st.session_state.session_id)
             
     if st.session_state["clear_screen"]:
         st.success("Mission Accomplished! Congratulations!")
@@ -607,34 +811,78 @@ if st.session_state.logged_in:
             以下の会話履歴を分析し、上記の観点から課題のみを箇条書きで出力してください。
         '''
         
-        conversation_log = "\n".join(st.session_state.chat_history)
-        client = OpenAI(api_key=st.secrets["openai"]["api_key"])
-
+        # This screen reruns on every click. Run the analysis once per play (session id) and keep the
+        # results, so later reruns only re-render the evaluation (a failed step is retried on the next rerun)
+        session_id = st.session_state.session_id
+        post_game = st.session_state.post_game
+        if post_game is None or post_game["session_id"] != session_id:
+            post_game = {"session_id": session_id, "evaluation": None, "summary": None}
+            st.session_state.post_game = post_game
 
-        evaluation_response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": evaluation_prompt},
-                {"role": "user", "content": conversation_log}
-            ],
-            temperature=0.25,
-        )
-        evaluation_result = evaluation_response.choices[0].message.content
-        st.markdown("### 会話の評価")
-        st.markdown(evaluation_result)
-        now_str = datetime.now(UTC).strftime('%Y/%m/%d %H:%M\n')
-        record_message(st.session_state.username, st.session_state["style_label"] + " " + now_str + evaluation_result, "eval")
-
-        summary_response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": summary_prompt},
-                {"role": "user", "content": conversation_log}
-            ],
-            temperature=0.25,
-        )
-        summary_result = summary_response.choices[0].message.content
-        record_message(st.session_state.username, summary_result, 'player_summary')
+        conversation_log = "\n".join(st.session_state.chat_history)
+        client = get_openai_client(st.secrets["openai"]["api_key"])
+
+
+        # The summary depends only on the conversation log, so generate and save it in another
+        # thread while the evaluation is generated, shown and saved
+        summary_future = None
+        if post_game["summary"] is None:
+            username = st.session_state.username
+
+            def summarize():
+                summary_response = create(
+                    client, "summarize",
+                    [
+                        {"role": "system", "content": summary_prompt},
+                        {"role": "user", "content": conversation_log}
+                    ],
+                )
+                summary_result = summary_response.choices[0].message.content
+                # st.session_state is not available from other threads, so write to the store directly
+                store.record_message(username, summary_result, 'player_summary', "", "",
+                                     datetime.now(UTC).strftime('%Y/%m/%d %H:%M'))
+                return summary_result
+
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="post-game-summary")
+            summary_future = executor.submit(summarize)
+            executor.shutdown(wait=False)
+
+        evaluation_result = post_game["evaluation"]
+        if evaluation_result is None:
+            try:
+                evaluation_response = create(
+                    client, "evaluate",
+                    [
+                        {"role": "system", "content": evaluation_prompt},
+                        {"role": "user", "content": conversation_log}
+                    ],
+                )
+                evaluation_result = evaluation_response.choices[0].message.content
+            except LLMError:
+                # Nothing is kept, so the evaluation is retried the next time this screen runs
+                st.error("評価を作成できませんでした。時間をおいてもう一度お試しください。")
+        # Show the evaluation as soon as it arrives, then save it
+        if evaluation_result is not None:
+            st.markdown("### 会話の評価")
+            st.markdown(evaluation_result)
+        if post_game["evaluation"] is None and evaluation_result is not None:
+            now_str = datetime.now(UTC).strftime('%Y/%m/%d %H:%M\n')
+            record_message(st.session_state.username, st.session_state["style_label"] + " " + now_str + evaluation_result, "eval",
+                           chapter=st.session_state["style_label"], session_id=session_id)
+            post_game["evaluation"] = evaluation_result
+
+        summary_result = None
+        if summary_future is not None:
+            try:
+                summary_result = summary_future.result()
+            except LLMError:
+                pass  # The summary is retried on the next rerun as well
+            except Exception:
+                # A failed save of the summary (Sheets / SQLite) must not break the evaluation already shown; retried on the next rerun
+                logger.warning("saving the player summary failed", exc_info=True)
+        if summary_result is not None:
+            precompute_prompts(st.session_state.username, summary_result)
+            post_game["summary"] = summary_result
 
         if st.button("🔁 Try Again"):
             st.session_state.chat_history = []
@@ -649,47 +897,16 @@ if st.session_state.logged_in:
     if st.session_state.chat_history and not st.session_state["clear_screen"] and not st.session_state["home"]:
         for msg in st.session_state.chat_history:
             if msg.startswith("User:"):
-                st.markdown(
-                    f'''
-                    <div style='display: flex; justify-content: flex-end; margin: 4px 0'>
-                        <div style='
-                            background-color: #DCF8C6;
-                            padding: 8px 12px;
-                            border-radius: 8px;
-                            max-width: 80%;
-                            word-wrap: break-word;
-                            text-align: left;
-                            font-size: 16px;
-                            color:black;
-                        '>
-                            {msg.replace("User:", "")}
-                        </div>
-                    </div>
-                    ''',
-                    unsafe_allow_html=True
-                )
+                st.markdown(user_bubble(msg.replace("User:", "")), unsafe_allow_html=True)
             elif msg.startswith("AI:"):
-                st.markdown(
-                    f'''
-                    <div style='display: flex; justify-content: flex-start; margin: 4px 0'>
-                        <div style='
-                            background-color: #E6E6EA;
-                            padding: 8px 12px;
-                            border-radius: 8px;
-                            max-width: 80%;
-                            word-wrap: break-word;
-                            text-align: left;
-                            font-size: 16px;
-                            color:black;
-                        '>
-                            {msg.replace("AI:", "")}
-                        </div>
-                    </div>
-                    ''',
-                    unsafe_allow_html=True
-                )
+                st.markdown(ai_bubble(msg.replace("AI:", "")), unsafe_allow_html=True)
+
+    # The submitted message and the streaming reply go right after the history (above the input form)
+    live_area = st.empty()
 
     if st.session_state["chat"] and not st.session_state.first_session:
+        prefetch_action_hint()  # Prepare the hint for the latest AI reply in the background
+
         # --- ヒントメッセージがセッションにあれば表示し、その後クリアする ---
         if st.session_state.get("hint_message"):
             st.info(st.session_state.hint_message)
@@ -741,7 +958,7 @@ if st.session_state.logged_in:
 
             if submit_button and user_input.strip():
                 # (既存の送信処理)
-                client = OpenAI(api_key=st.secrets["openai"]["api_key"])
+                client = get_openai_client(st.secrets["openai"]["api_key"])
                 system_prompt = st.session_state.get("agent_prompt", "You are a kind English learning teacher.")
                 messages = [{"role": "system", "content": system_prompt}]
                 for msg in st.session_state.get("chat_history", []):
@@ -750,12 +967,21 @@ if st.session_state.logged_in:
                     elif msg.startswith("AI:"):
                         messages.append({"role": "assistant", "content": msg.replace("AI:", "").strip()})
                 messages.append({"role": "user", "content": user_input})
-                response = client.chat.completions.create(model="gpt-4o", messages=messages, temperature=0.25)
-                reply = response.choices[0].message.content
+                # Stream the reply into the chat while it is generated
+                try:
+                    with live_area.container():
+                        st.markdown(user_bubble(user_input), unsafe_allow_html=True)
+                        reply, _ = stream_reply(client, messages, st.empty())
+                except LLMError:
+                    # A turn without a reply is neither added to the history nor saved
+                    live_area.empty()
+                    st.error(f"AIの応答を取得できませんでした。もう一度送信してください。（送信した内容：{user_input}）")
+                    st.stop()
                 st.session_state.chat_history.append(f"User: {user_input}")
                 st.session_state.chat_history.append(f"AI: {reply}")
                 full_message = f"User: {user_input}\nAI: {reply}"
-                record_message(st.session_state.username, full_message,"message")
+                record_message(st.session_state.username, full_message,"message",
+                               chapter=st.session_state["style_label"], session_id=st.session_state.session_id)
                 
                 if "Mission Accomplished" in reply:
                     st.session_state.clear_screen = True
@@ -767,25 +993,33 @@ if st.session_state.logged_in:
             
     elif st.session_state.show_history:
         st.markdown("### 📜 Chat History")
-        history = load_message(st.session_state.username, "message")
+        # The session index (chapter, time, turns, outcome, score) is cached per session and updated on every record
+        history_cache = get_history_cache(st.session_state, st.session_state.username)
+        sessions = history_cache.load_index(list_sessions)
 
-        if not history.strip():
+        if not sessions:
             st.info("(No chat history yet)")
         else:
-            pattern = r"(Chapter \d+: .*?\d{4}/\d{2}/\d{2} \d{2}:\d{2})(.*?)(?=Chapter \d+: |\Z)"
-            matches = re.findall(pattern, history, re.DOTALL)
+            # Filters and paging are served from the index alone (no message bodies are read)
+            col1, col2 = st.columns(2)
+            with col1:
+                chapter = st.selectbox("Filter by chapter", ["All"] + sorted({e["chapter"] for e in sessions}))
+            with col2:
+                date = st.selectbox("Filter by date", ["All"] + sorted({e["timestamp"][:10] for e in sessions}, reverse=True))
+            filtered = filter_sessions(sessions, "" if chapter == "All" else chapter, "" if date == "All" else date)
 
-            if not matches:
-                st.warning("Failed to parse history.")
+            if not filtered:
+                st.warning("No conversations match the filters.")
             else:
-                options = [title.strip() for title, _ in matches]
-                selected = st.selectbox("Select a conversation to display", options[::-1])
+                pages = page_count(filtered)
+                page = st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, value=1, step=1)
+                selected = st.selectbox("Select a conversation to display", page_of(filtered, page), format_func=session_label)
 
-                selected_block = next(((t, c) for t, c in matches if t.strip() == selected), None)
+                # Load only the body of the selected conversation
+                content = history_cache.load_body(load_session, selected)
 
-                if selected_block:
-                    title, content = selected_block
-                    st.markdown(f"#### {title.strip()}")
+                if content:
+                    st.markdown(f"#### {selected['chapter']} {selected['timestamp']}")
 
                     lines = content.strip().split("\n")
                     for line in lines:
@@ -837,19 +1071,28 @@ if st.session_state.logged_in:
 
     elif st.session_state["eval"]:
         st.title("🎩 Past Feedback")
-        message = load_message(st.session_state["username"], "eval")
+        # Parsed feedback is cached per session and appended to on every record
+        history_cache = get_history_cache(st.session_state, st.session_state["username"])
+        feedback_dict = history_cache.load_feedback(load_message)
 
-        if not message:
+        if not feedback_dict and not history_cache.unparsed["eval"]:
             st.info("No feedback has been registered yet.")
         else:
-            pattern = r"(Chapter \d+: .*?\d{4}/\d{2}/\d{2} \d{2}:\d{2})\n(.*?)(?=Chapter \d+: |\Z)"
-            matches = re.findall(pattern, message, re.DOTALL)
-
-            if not matches:
+            if not feedback_dict:
                 st.warning("Could not parse feedback.")
             else:
-                feedback_dict = {title.strip(): body.strip() for title, body in matches}
+                # Score trend, drawn from the stored numbers without parsing evaluation text
+                score_records = history_cache.load_scores(load_scores)
+                if len(score_records) >= 2:
+                    st.markdown("### Score Trend")
+                    st.line_chart({SCORE_LABELS[field]: [r[field] for r in score_records] for field in SCORE_FIELDS})
+
                 selected_title = st.selectbox("Select feedback to display", sorted(feedback_dict.keys(), reverse=True))
+
+                record = next((r for r in reversed(score_records) if score_title(r) == selected_title), None)
+                if record:
+                    for col, field in zip(st.columns(len(SCORE_FIELDS)), SCORE_FIELDS):
+                        col.metric(SCORE_LABELS[field], "-" if record[field] is None else record[field])
                 st.markdown("### Feedback Content")
                 selected_body = feedback_dict[selected_title]
                 for para in selected_body.split("\n\n"):
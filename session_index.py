@@ -0,0 +1,197 @@
+import math
+import threading
+from message_log import (parse_message_blocks, parse_eval_blocks, split_title, split_turns, strip_title,
+                         session_key, open_log_sheet, fetch_user_rows)
+from scores import parse_scores, average_score
+
+# --- 会話履歴の索引 ---
+# 1回のプレイ（セッション）ごとに、章・開始時刻・ターン数・結果・スコアだけを持つ軽い一覧。
+# 履歴画面はこの一覧を新しい順にページ送りし、章・日付の絞り込みも一覧だけで行う。
+# 会話の本文は、一覧から選んだセッションを開いたときに初めて読み出す。
+
+PAGE_SIZE = 10
+USER_ROLES = ("ユーザー", "User")
+FAILED_MARKERS = ("ミッション失敗", "Mission Failed")
+
+
+def new_entry(key, chapter, timestamp, turns=0, outcome="", score=None):
+    """索引の1件。key はセッションID（なければ見出し）、outcome は "cleared" / "failed" / ""（未完了）"""
+    return {"key": key, "chapter": chapter, "timestamp": timestamp,
+            "turns": turns, "outcome": outcome, "score": score}
+
+
+def turn_stats(turns):
+    """(role, 発言) のリストから、プレイヤーの発言数と失敗宣言の有無を求める"""
+    user_turns = sum(1 for role, _ in turns if role in USER_ROLES)
+    failed = any(role == "AI" and any(m in text for m in FAILED_MARKERS) for role, text in turns)
+    return user_turns, failed
+
+
+def apply_turns(entry, turns):
+    user_turns, failed = turn_stats(turns)
+    entry["turns"] += user_turns
+    if failed:
+        entry["outcome"] = "failed"
+
+
+def apply_eval(entry, eval_text, scores=None):
+    # 評価はミッション達成・失敗のどちらでも行われるので、失敗でなければ達成とみなす
+    entry["score"] = average_score(scores if scores is not None else parse_scores(eval_text))
+    if entry["outcome"] != "failed":
+        entry["outcome"] = "cleared"
+
+
+def newest_first(entries):
+    # 同じ時刻のものは後から記録された方を先にする
+    return sorted(reversed(list(entries)), key=lambda e: e["timestamp"], reverse=True)
+
+
+def index_rows(rows):
+    """MessageLog 形式の行（username, chapter, session_id, timestamp, role, text）から索引を作る"""
+    entries = {}
+    for _, chapter, session_id, timestamp, role, text in rows:
+        if role == "eval":
+            if session_id in entries:
+                apply_eval(entries[session_id], text)
+            continue
+        key = session_key(chapter, session_id, timestamp)
+        if key not in entries:
+            entries[key] = new_entry(key, chapter, timestamp)
+        apply_turns(entries[key], [(role, text)])
+    return newest_first(entries.values())
+
+
+def index_blobs(message_blob, eval_blob):
+    """従来の連結形式の "message" / "eval" から索引を作る（key は見出し）"""
+    entries = []
+    for title, content in parse_message_blocks(message_blob):
+        entry = new_entry(title.strip(), *split_title(title))
+        apply_turns(entry, split_turns(content))
+        entries.append(entry)
+    # 連結形式の評価にはセッションIDがないので、同じ章で評価より前に始まった
+    # 最も新しい未評価のセッションに対応付ける
+    evaluated = set()
+    for title, body in parse_eval_blocks(eval_blob):
+        chapter, timestamp = split_title(title)
+        for i in range(len(entries) - 1, -1, -1):
+            entry = entries[i]
+            if i not in evaluated and entry["chapter"] == chapter and entry["timestamp"] <= timestamp:
+                apply_eval(entry, body)
+                evaluated.add(i)
+                break
+    return newest_first(entries)
+
+
+def session_title(entry):
+    """索引の1件に対応するセッション見出し（連結形式の履歴での見出し）"""
+    return f"{entry['chapter']} {entry['timestamp']}"
+
+
+def session_body(message_blob, title):
+    """連結形式の "message" から、見出しが title のセッションの本文を取り出す"""
+    for block_title, content in parse_message_blocks(message_blob):
+        if block_title.strip() == title:
+            return content.strip()
+    return ""
+
+
+def filter_sessions(entries, chapter="", date=""):
+    """章（完全一致）と日付（"YYYY/MM/DD"）で絞り込む。空の条件は無視する"""
+    return [e for e in entries
+            if (not chapter or e["chapter"] == chapter) and (not date or e["timestamp"].startswith(date))]
+
+
+def page_count(entries, page_size=PAGE_SIZE):
+    return max(1, math.ceil(len(entries) / page_size))
+
+
+def page_of(entries, page, page_size=PAGE_SIZE):
+    """1始まりのページ番号に対応する部分を返す"""
+    page = min(max(1, page), page_count(entries, page_size))
+    return entries[(page - 1) * page_size: page * page_size]
+
+
+# --- Google Sheets での索引（SessionIndex シート） ---
+# Sheets では会話の本文が UserData のセル（または MessageLog の行）にしかなく、索引を作るには全履歴を読む必要があった。
+# record_message のたびに本文を含まない小さな行を SessionIndex シートに追記し、索引はその行だけから作る。
+# 行の形式: username, key, chapter, timestamp, turns, event, score
+# key はセッションID（なければ見出し）、turns はその書き込みで増えたプレイヤーの発言数、
+# event は ""（発言）/ "failed"（失敗宣言）/ "cleared"（評価。score に平均点）/ "backfilled"（下記）。
+# シートを使い始める前の履歴は、ユーザーごとに一度だけ従来の方法で索引を作って行として書き込み、
+# 書き込み済みの印に event="backfilled" の行を追加する。
+
+SESSION_SHEET_TITLE = "SessionIndex"
+SESSION_HEADER = ["username", "key", "chapter", "timestamp", "turns", "event", "score"]
+BACKFILLED = "backfilled"
+
+
+class SessionLog:
+    """SessionIndex シートへの索引の行の追記と、ユーザー単位の索引の組み立て"""
+
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+
+    def rows_for(self, username, chapter, session_id, timestamp, where, text):
+        """record_message の1回の書き込みを索引の行に変換する（索引に関係のない書き込みは空）"""
+        if where not in ("message", "eval"):
+            return []
+        title, body = strip_title(text)
+        if title:
+            chapter, timestamp = split_title(title)  # 見出しと同じ時刻にして、本文を見出しで探せるようにする
+        key = session_key(chapter, session_id, timestamp)
+        if where == "eval":
+            score = average_score(parse_scores(body))
+            return [[username, key, chapter, timestamp, 0, "cleared", "" if score is None else score]]
+        user_turns, failed = turn_stats(split_turns(body))
+        return [[username, key, chapter, timestamp, user_turns, "failed" if failed else "", ""]]
+
+    def backfill_rows(self, username, entries):
+        """従来の方法で作った索引を行にし、書き込み済みの印の行を加える"""
+        rows = [[username, e["key"], e["chapter"], e["timestamp"], e["turns"], e["outcome"],
+                 "" if e["score"] is None else e["score"]] for e in entries]
+        return rows + [[username, "", "", "", 0, BACKFILLED, ""]]
+
+    def append_rows(self, rows):
+        if rows:
+            self.worksheet.append_rows(rows, value_input_option="RAW")
+
+    def fetch_rows(self, username):
+        return fetch_user_rows(self.worksheet, username, len(SESSION_HEADER))
+
+
+def is_backfilled(rows):
+    return any(row[5] == BACKFILLED for row in rows)
+
+
+def index_log_rows(rows):
+    """SessionIndex の行から索引を作る"""
+    entries = {}
+    for _, key, chapter, timestamp, turns, event, score in rows:
+        if event == BACKFILLED:
+            continue
+        if key not in entries:
+            entries[key] = new_entry(key, chapter, timestamp)
+        entry = entries[key]
+        entry["turns"] += int(turns or 0)
+        if event == "failed":
+            entry["outcome"] = "failed"
+        elif event == "cleared":
+            if str(score).strip():
+                entry["score"] = int(float(score))
+            if entry["outcome"] != "failed":
+                entry["outcome"] = "cleared"
+    return newest_first(entries.values())
+
+
+_logs = {}
+_lock = threading.Lock()
+
+
+def get_session_log(spreadsheet):
+    """スプレッドシートごとの SessionLog をプロセス内で共有する"""
+    with _lock:
+        log = _logs.get(spreadsheet.id)
+        if log is None:
+            log = SessionLog(open_log_sheet(spreadsheet, SESSION_SHEET_TITLE, SESSION_HEADER))
+            _logs[spreadsheet.id] = log
+        return log
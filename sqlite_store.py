@@ -0,0 +1,195 @@
+import sqlite3
+import threading
+from message_log import to_log_rows, format_message_rows, format_eval_rows
+from passwords import hash_password, is_password_hash, verify_password
+from session_index import new_entry, index_rows, turn_stats
+from scores import SCORE_FIELDS, to_score_record, average_score
+from user_store import UserStore
+
+# --- SQLite の保存先 ---
+# Google の認証情報やネットワークなしで動く保存先。単一ノードでの運用、負荷試験、CI 向け。
+# WAL モードで開くので、書き込み中でも他のスレッド（Streamlit のセッション）は読み出しできる。
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    password TEXT NOT NULL,
+    player_summary TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL,
+    chapter TEXT NOT NULL DEFAULT '',
+    session_id TEXT NOT NULL DEFAULT '',
+    timestamp TEXT NOT NULL DEFAULT '',
+    role TEXT NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_user ON messages (username, role, id);
+CREATE INDEX IF NOT EXISTS idx_messages_session ON messages (username, session_id, id);
+CREATE TABLE IF NOT EXISTS sessions (
+    username TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    chapter TEXT NOT NULL DEFAULT '',
+    timestamp TEXT NOT NULL DEFAULT '',
+    turns INTEGER NOT NULL DEFAULT 0,
+    outcome TEXT NOT NULL DEFAULT '',
+    score INTEGER,
+    PRIMARY KEY (username, session_id)
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions (username, timestamp);
+CREATE TABLE IF NOT EXISTS scores (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL,
+    session_id TEXT NOT NULL DEFAULT '',
+    chapter TEXT NOT NULL DEFAULT '',
+    timestamp TEXT NOT NULL DEFAULT '',
+    grammar INTEGER,
+    naturalness INTEGER,
+    fluency INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_scores_user ON scores (username, id);
+"""
+
+INSERT_SCORE = "INSERT INTO scores (username, session_id, chapter, timestamp, grammar, naturalness, fluency) " \
+               "VALUES (?, ?, ?, ?, ?, ?, ?)"
+
+
+def _score_params(username, record):
+    return (username, record["session_id"], record["chapter"], record["timestamp"]) + \
+           tuple(record[field] for field in SCORE_FIELDS)
+
+
+class SQLiteUserStore(UserStore):
+    """SQLite データベースを使う保存先（会話は MessageLog と同じ1発言1行の形式）"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            self._backfill_sessions(conn)
+            self._backfill_scores(conn)
+
+    def _backfill_sessions(self, conn):
+        # 索引のテーブルがなかった頃のデータベースは、既存の会話から一度だけ索引を作る
+        if conn.execute("SELECT 1 FROM sessions LIMIT 1").fetchone():
+            return
+        rows = conn.execute("SELECT username, chapter, session_id, timestamp, role, text FROM messages "
+                            "WHERE session_id != '' ORDER BY id").fetchall()
+        by_user = {}
+        for row in rows:
+            by_user.setdefault(row[0], []).append(row)
+        conn.executemany(
+            "INSERT OR IGNORE INTO sessions (username, session_id, chapter, timestamp, turns, outcome, score) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(username, e["key"], e["chapter"], e["timestamp"], e["turns"], e["outcome"], e["score"])
+             for username, user_rows in by_user.items() for e in index_rows(user_rows)])
+
+    def _backfill_scores(self, conn):
+        # スコアのテーブルがなかった頃の評価は、一度だけ本文からスコアを取り出しておく
+        if conn.execute("SELECT 1 FROM scores LIMIT 1").fetchone():
+            return
+        rows = conn.execute("SELECT username, session_id, chapter, timestamp, text FROM messages "
+                            "WHERE role = 'eval' ORDER BY id").fetchall()
+        conn.executemany(INSERT_SCORE,
+                         [_score_params(row[0], to_score_record(*row[1:])) for row in rows])
+
+    def _connect(self):
+        # sqlite3 の接続はスレッドをまたげないので、スレッドごとに1本ずつ持つ
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def user_exists(self, username):
+        row = self._connect().execute(
+            "SELECT 1 FROM users WHERE username = ?", (username,)).fetchone()
+        return row is not None
+
+    def check_password(self, username, password):
+        row = self._connect().execute(
+            "SELECT password FROM users WHERE username = ?", (username,)).fetchone()
+        if row is None or not verify_password(password, row[0]):
+            return False
+        # 以前の平文パスワードはログイン成功時にハッシュへ置き換える
+        if not is_password_hash(row[0]):
+            with self._connect() as conn:
+                conn.execute("UPDATE users SET password = ? WHERE username = ?", (hash_password(password), username))
+        return True
+
+    def register_user(self, username, password):
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO users (username, password) VALUES (?, ?)", (username, hash_password(password)))
+        return cursor.rowcount == 1
+
+    def record_message(self, username, new_message, where, chapter="", session_id="", timestamp=""):
+        if where == "player_summary":
+            with self._connect() as conn:
+                conn.execute("UPDATE users SET player_summary = ? WHERE username = ?", (new_message, username))
+            return
+        if where not in ("message", "eval"):
+            return
+        rows = to_log_rows(username, chapter, session_id, timestamp, where, new_message)
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT INTO messages (username, chapter, session_id, timestamp, role, text) "
+                "VALUES (?, ?, ?, ?, ?, ?)", rows)
+            # 評価のスコアは、ここで一度だけ本文から取り出して数値で保存する
+            if where == "eval":
+                record = to_score_record(session_id, chapter, timestamp, new_message)
+                conn.execute(INSERT_SCORE, _score_params(username, record))
+            # 索引は同じトランザクションで更新する（セッションIDのない書き込みは索引に載せない）
+            if not session_id:
+                return
+            if where == "eval":
+                conn.execute(
+                    "UPDATE sessions SET score = ?, outcome = CASE WHEN outcome = 'failed' THEN outcome "
+                    "ELSE 'cleared' END WHERE username = ? AND session_id = ?",
+                    (average_score(record), username, session_id))
+                return
+            user_turns, failed = turn_stats([(row[4], row[5]) for row in rows])
+            conn.execute(
+                "INSERT OR IGNORE INTO sessions (username, session_id, chapter, timestamp) VALUES (?, ?, ?, ?)",
+                (username, session_id, chapter, timestamp))
+            conn.execute(
+                "UPDATE sessions SET turns = turns + ?, outcome = CASE WHEN ? THEN 'failed' ELSE outcome END "
+                "WHERE username = ? AND session_id = ?",
+                (user_turns, failed, username, session_id))
+
+    def load_message(self, username, item):
+        conn = self._connect()
+        if item == "player_summary":
+            row = conn.execute("SELECT player_summary FROM users WHERE username = ?", (username,)).fetchone()
+            return row[0] if row else ""
+        if item == "eval":
+            query = "SELECT username, chapter, session_id, timestamp, role, text FROM messages " \
+                    "WHERE username = ? AND role = 'eval' ORDER BY id"
+            return format_eval_rows(conn.execute(query, (username,)).fetchall())
+        if item == "message":
+            query = "SELECT username, chapter, session_id, timestamp, role, text FROM messages " \
+                    "WHERE username = ? AND role != 'eval' ORDER BY id"
+            return format_message_rows(conn.execute(query, (username,)).fetchall())
+        return ""
+
+    def list_sessions(self, username):
+        rows = self._connect().execute(
+            "SELECT session_id, chapter, timestamp, turns, outcome, score FROM sessions "
+            "WHERE username = ? ORDER BY timestamp DESC, rowid DESC", (username,)).fetchall()
+        return [new_entry(*row) for row in rows]
+
+    def load_session(self, username, entry, memo=None):
+        rows = self._connect().execute(
+            "SELECT role, text FROM messages WHERE username = ? AND session_id = ? AND role != 'eval' "
+            "ORDER BY id", (username, entry["key"])).fetchall()
+        return "\n".join(f"{role}: {text}" for role, text in rows)
+
+    def load_scores(self, username):
+        rows = self._connect().execute(
+            "SELECT session_id, chapter, timestamp, grammar, naturalness, fluency FROM scores "
+            "WHERE username = ? ORDER BY id", (username,)).fetchall()
+        return [dict(zip(("session_id", "chapter", "timestamp") + SCORE_FIELDS, row)) for row in rows]
@@ -0,0 +1,36 @@
+from message_log import LOG_HEADER, MessageLog, session_key
+
+
+class FakeWorksheet:
+    """MessageLog シートの代わり。読んだ範囲を記録する"""
+
+    def __init__(self, rows):
+        self.rows = [LOG_HEADER] + rows
+        self.reads = []
+
+    def col_values(self, col):
+        self.reads.append(f"col {col}")
+        return [row[col - 1] for row in self.rows]
+
+    def batch_get(self, ranges):
+        self.reads.extend(ranges)
+        values = []
+        for a1 in ranges:
+            start, end = a1.split(":")
+            values.append([list(row) for row in self.rows[int(start[1:]) - 1:int(end[1:])]])
+        return values
+
+    def get(self, a1):
+        raise AssertionError(f"シート全体を読んでいる: {a1}")
+
+
+def test_fetch_session_rows_reads_only_the_users_rows():
+    worksheet = FakeWorksheet([
+        ["alice", "Chapter 1: 空港", "s1", "2025/01/01 10:00", "AI", "こんにちは"],
+        ["bob", "Chapter 1: 空港", "s2", "2025/01/01 10:01", "AI", "こんにちは"],
+        ["alice", "Chapter 1: 空港", "s1", "2025/01/01 10:00", "ユーザー", "はい"],
+        ["alice", "Chapter 2: スーパー", "s3", "2025/01/02 10:00", "AI", "いらっしゃいませ"],
+    ])
+    rows = MessageLog(worksheet).fetch_session_rows("alice", session_key("Chapter 1: 空港", "s1", "2025/01/01 10:00"))
+    assert [row[5] for row in rows] == ["こんにちは", "はい"]
+    assert worksheet.reads == ["col 1", "A2:F2", "A4:F5"]
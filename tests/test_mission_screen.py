@@ -0,0 +1,27 @@
+import mission_screen
+from mission_screen import plausible, screen_turn
+
+CH1 = "Chapter 1: 空港での手続き"
+
+
+def test_listed_cues_all_needed_by_default():
+    history = ["AI: ようこそ", "ユーザー: 観光で来ました。ホテルに泊まります。"]
+    assert not plausible(CH1, history)
+    assert plausible(CH1, history, list_need="half")
+    assert plausible(CH1, history[:1] + ["ユーザー: 観光で3日間、ホテルに泊まります。"])
+
+
+def test_audited_completion_is_returned(monkeypatch):
+    monkeypatch.setattr(mission_screen.random, "random", lambda: 0.0)
+    history = ["AI: ようこそ", "ユーザー: こんにちは"]
+    before = mission_screen.stats.disagreed
+    assert screen_turn(CH1, history, lambda: "達成", audit_rate=1.0) == "達成"
+    assert mission_screen.stats.disagreed == before + 1
+    assert screen_turn(CH1, history, lambda: "継続", audit_rate=1.0) == "継続"
+
+
+def test_skipped_turn_without_audit_continues(monkeypatch):
+    monkeypatch.setattr(mission_screen.random, "random", lambda: 0.99)
+    calls = []
+    assert screen_turn(CH1, ["AI: ようこそ"], lambda: calls.append(1) or "達成", audit_rate=0.5) == "継続"
+    assert not calls
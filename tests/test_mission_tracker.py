@@ -0,0 +1,64 @@
+import ast
+import os
+
+import pytest
+
+from mission_tracker import MissionTracker, parse_conditions
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "secret_test.py")
+
+
+def load_story_prompts():
+    """secret_test.py の story_prompt（章ごとのシナリオ）を、アプリを起動せずにソースから読む"""
+    with open(APP, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign) and any(getattr(t, "id", None) == "story_prompt" for t in node.targets):
+            return [chapter[0] for chapter in ast.literal_eval(node.value)]
+    raise AssertionError("story_prompt が見つかりません")
+
+
+STORY_PROMPTS = load_story_prompts()
+
+# 章ごとに期待する (条件の一覧, 各グループの「満たす必要のある数/項目数」)。既定（list_need = "all"）のもの
+EXPECTED = {
+    1: (["「入国目的」を正しく伝えられた", "「滞在期間」を正しく伝えられた", "「宿泊先」を正しく伝えられた"], ["3/3"]),
+    2: (["探している商品の場所などについて質問し", "あなたの説明をプレイヤーが理解したことを示す応答をする"], ["1/1", "1/1"]),
+    3: (["次に会う約束を取り付ける"], ["1/1"]),
+    4: (["「名前」を含めた自己紹介を行い", "「出身」を含めた自己紹介を行い", "「担当業務」を含めた自己紹介を行い",
+         "同僚と良い印象のやり取りができた"], ["3/3", "1/1"]),
+    5: (["「症状の部位」を日本語で説明できた", "「痛みの程度」を日本語で説明できた", "「発症時期」を日本語で説明できた"], ["3/3"]),
+    6: (["会議中に自分の意見を一度以上発言し", "相手と簡単な意見交換ができた"], ["1/1", "1/1"]),
+    7: (["お祭りに興味を示し", "あなたと一緒に行く約束をする"], ["1/1", "1/1"]),
+    8: (["「手続き内容」を説明し", "必要な書類や手順を理解できた"], ["1/1", "1/1"]),
+    9: (["「目的地」を伝え", "「予定時刻」を伝え", "駅員の案内に沿って代替手段を理解・選択できた"], ["2/2", "1/1"]),
+}
+
+
+def needs(groups):
+    return [f"{need}/{len(indexes)}" for indexes, need in groups]
+
+
+def test_every_chapter_is_covered():
+    assert len(STORY_PROMPTS) == len(EXPECTED)
+
+
+@pytest.mark.parametrize("chapter", sorted(EXPECTED))
+def test_parse_conditions(chapter):
+    _, conditions, groups = parse_conditions(STORY_PROMPTS[chapter - 1])
+    assert (conditions, needs(groups)) == EXPECTED[chapter]
+
+
+def test_half_lists_only_when_requested():
+    _, _, groups = parse_conditions(STORY_PROMPTS[0], list_need="half")
+    assert needs(groups) == ["2/3"]
+    _, _, groups = parse_conditions(STORY_PROMPTS[8], list_need="half")
+    assert needs(groups) == ["1/2", "1/1"]
+
+
+def test_complete_needs_every_listed_item_by_default():
+    tracker = MissionTracker(STORY_PROMPTS[0])
+    tracker.satisfied = [True, True, False]
+    assert not tracker.complete
+    tracker.satisfied = [True, True, True]
+    assert tracker.complete
@@ -0,0 +1,26 @@
+from llm_client import served_by
+from prompt_cache import PromptCache
+from word_lookup import WordLookup
+
+
+def test_served_by_accepts_dated_snapshots_only():
+    assert served_by("gpt-4o-2024-08-06", "gpt-4o")
+    assert served_by("gpt-4o", "gpt-4o")
+    assert not served_by("gpt-4o-mini", "gpt-4o")
+    assert not served_by("gpt-4o-mini-2024-07-18", "gpt-4o")
+    assert not served_by(None, "gpt-4o")
+
+
+def test_get_or_create_skips_fallback_answers(tmp_path):
+    cache = PromptCache(str(tmp_path))
+    assert cache.get_or_create("k", lambda: ("fallback", False)) == "fallback"
+    assert cache.get("k") is None
+    assert cache.get_or_create("k", lambda: ("primary", True)) == "primary"
+    assert cache.get("k") == "primary"
+
+
+def test_word_lookup_skips_fallback_answers(tmp_path):
+    lookup = WordLookup({}, PromptCache(str(tmp_path)))
+    assert lookup.lookup("本", "k", lambda: ("fallback", False)) == "fallback"
+    assert lookup.lookup("本", "k", lambda: ("primary", True)) == "primary"
+    assert lookup.lookup("本", "k", lambda: ("again", True)) == "primary"
@@ -0,0 +1,74 @@
+import pytest
+
+pytest.importorskip("gspread")
+from gspread.utils import a1_to_rowcol
+
+import user_store
+from user_store import write_cells
+
+
+class FakeSheet:
+    """UserData シートの代わり。セルを dict で持ち、batch_get の直後に割り込みの処理を1回だけ差し込める"""
+
+    def __init__(self, header, rows):
+        self.id = 0
+        self.spreadsheet = type("Spreadsheet", (), {"id": "fake"})()
+        self.cells = {}
+        for r, values in enumerate([header] + rows, start=1):
+            for c, value in enumerate(values, start=1):
+                self.cells[(r, c)] = value
+        self.after_read = None
+
+    def row_values(self, row):
+        width = max(c for _, c in self.cells)
+        return [self.cells.get((row, c), "") for c in range(1, width + 1)]
+
+    def col_values(self, col):
+        height = max(r for r, _ in self.cells)
+        return [self.cells.get((r, col), "") for r in range(1, height + 1)]
+
+    def batch_get(self, ranges):
+        values = [[[self.cells[a1_to_rowcol(a1)]]] if self.cells.get(a1_to_rowcol(a1)) else [] for a1 in ranges]
+        hook, self.after_read = self.after_read, None
+        if hook:
+            hook()
+        return values
+
+    def batch_update(self, updates, value_input_option=None):
+        for update in updates:
+            self.cells[a1_to_rowcol(update["range"])] = update["values"][0][0]
+
+
+@pytest.fixture
+def sheet(monkeypatch):
+    monkeypatch.setattr(user_store.time, "sleep", lambda seconds: None)
+    user_store.invalidate_user_index()
+    yield FakeSheet(["username", "password", "message", "version"], [["alice", "", "old", "v0"]])
+    user_store.invalidate_user_index()
+
+
+def test_append_without_conflict(sheet):
+    write_cells(sheet, {(2, 3): ["A-turn"]})
+    assert sheet.cells[(2, 3)] == "old\nA-turn"
+
+
+def test_append_read_before_another_write_is_merged(sheet):
+    # B がセルを読んだ後、B が書く前に A が追記を書き終える（A 自身の確認は通る）。
+    # B は読んだ時点の版と書く直前の版が違うことに気づき、読み直して A の追記の後に追記する
+    sheet.after_read = lambda: write_cells(sheet, {(2, 3): ["A-turn"]})
+    write_cells(sheet, {(2, 3): ["B-turn"]})
+    assert sheet.cells[(2, 3)] == "old\nA-turn\nB-turn"
+
+
+def test_append_overwritten_after_write_is_merged(sheet):
+    # A が書いた直後、A の確認の前に、A より前に読んだ値をもとにした書き込み（B）で上書きされる
+    original = sheet.batch_update
+
+    def batch_update(updates, value_input_option=None):
+        original(updates, value_input_option)
+        sheet.batch_update = original
+        original([{"range": "C2", "values": [["old\nB-turn"]]}, {"range": "D2", "values": [["vB"]]}])
+
+    sheet.batch_update = batch_update
+    write_cells(sheet, {(2, 3): ["A-turn"]})
+    assert sheet.cells[(2, 3)] == "old\nB-turn\nA-turn"
@@ -0,0 +1,112 @@
+import json
+import logging
+import re
+from llm_client import create, read_stream
+
+logger = logging.getLogger(__name__)
+
+# --- 会話AIの応答とミッション判定をまとめて受け取る1回の呼び出し ---
+# 従来は1ターンごとに「会話AIの応答」と「監視エージェントによる判定」（会話全体を再送）の2回呼び出していた。
+# turn_mode = "merged" では、会話AIに応答と判定を JSON（json_schema）で同時に返させる。
+# 応答部分は生成途中の JSON から読み出して、ストリーミングで吹き出しに表示する。
+
+VERDICTS = ("達成", "継続", "失敗")
+
+TURN_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "turn",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "reply": {"type": "string"},
+                "verdict": {"type": "string", "enum": list(VERDICTS)},
+                "satisfied_conditions": {"type": "array", "items": {"type": "string"}},
+            },
+            "required": ["reply", "verdict", "satisfied_conditions"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+# 会話AIのシステムプロンプトの末尾に追加する指示（判定ルールは監視エージェントと同じもの）
+TURN_JUDGE_PROMPT = """
+
+        [出力形式]
+        あなたの出力はプログラムで自動処理されるため、次の3つの項目を持つ JSON だけを出力してください。
+        - reply: プレイヤーへの返答。これまでどおり登場人物として話してください（「ミッション達成」「ミッション失敗」の合言葉もここに書きます）。
+        - verdict: この返答の時点でのミッションの判定。「達成」「継続」「失敗」のいずれか。
+        - satisfied_conditions: [ミッション達成の条件]の項目のうち、会話の中ですでに明確に満たされたもの。
+
+        [判定ルール]
+        1.  **完全一致の原則**: 「ミッション達成の条件」の**すべての項目が、会話の中で明確に満たされている**場合にのみ「達成」とします。一つでも欠けている場合は「継続」です。
+        2.  **時系列の考慮**: 条件は会話の自然な流れに沿って満たされるべきです。例えば、「AIの説明をプレイヤーが理解した」という条件は、AIが何かを説明した**後**にのみ成立します。
+        3.  **厳密な判定**: 少しでも達成条件を満たしているか曖昧な場合は、安全策として「継続」と判断してください。
+        4.  reply で「ミッション失敗」と出力した場合は「失敗」とします。
+"""
+
+REPLY_START = re.compile(r'"reply"\s*:\s*"')
+
+
+def partial_reply(buffer):
+    """生成途中の JSON から "reply" の文字列のうち、読めたところまでを返す"""
+    match = REPLY_START.search(buffer)
+    if not match:
+        return ""
+    chars = []
+    i = match.end()
+    while i < len(buffer):
+        c = buffer[i]
+        if c == '"':
+            break
+        if c == "\\":
+            # エスケープの途中で途切れている場合は、そこまでで止める
+            width = 6 if buffer[i + 1:i + 2] == "u" else 2
+            if i + width > len(buffer):
+                break
+            chars.append(buffer[i:i + width])
+            i += width
+            continue
+        chars.append(c)
+        i += 1
+    try:
+        return json.loads('"' + "".join(chars) + '"')
+    except ValueError:
+        return ""
+
+
+def parse_turn(buffer):
+    """完成した JSON を {reply, verdict, satisfied_conditions} にする。壊れていれば判定は「継続」"""
+    try:
+        turn = json.loads(buffer)
+        verdict = turn.get("verdict") if turn.get("verdict") in VERDICTS else "継続"
+        return {"reply": str(turn.get("reply", "")), "verdict": verdict,
+                "satisfied_conditions": list(turn.get("satisfied_conditions") or [])}
+    except (ValueError, AttributeError):
+        logger.warning("could not parse merged turn output: %.200s", buffer)
+        return {"reply": partial_reply(buffer) or buffer, "verdict": "継続", "satisfied_conditions": []}
+
+
+def stream_turn(client, messages, on_reply):
+    """応答と判定を1回の呼び出しで受け取る。応答は読めたところまでを on_reply に渡していく（途中で切れたら LLMError）"""
+    stream = create(client, "dialog", messages, response_format=TURN_RESPONSE_FORMAT, stream=True)
+    buffer = ""
+    shown = ""
+    for chunk in read_stream("dialog", stream):
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            buffer += delta
+            reply = partial_reply(buffer)
+            if reply != shown:
+                shown = reply
+                on_reply(reply)
+    return parse_turn(buffer)
+
+
+def log_verdicts(merged_verdict, legacy_verdict):
+    """turn_mode = "compare" のとき、まとめた判定と従来の監視エージェントの判定を記録する"""
+    # 従来の監視エージェントは「達成」「継続」しか返さないので、「失敗」は「継続」として比べる
+    agree = (merged_verdict if merged_verdict != "失敗" else "継続") == legacy_verdict
+    logger.info("mission verdict merged=%s legacy=%s agree=%s", merged_verdict, legacy_verdict, agree)
+    return agree
@@ -0,0 +1,394 @@
+import logging
+import random
+import threading
+import time
+import uuid
+from gspread.utils import rowcol_to_a1
+from passwords import hash_password, is_password_hash, verify_password
+from message_log import parse_eval_blocks, split_title, session_key, to_log_rows, format_session_rows
+from session_index import index_blobs, index_rows, index_log_rows, is_backfilled, session_body, session_title
+from scores import to_score_record
+
+# --- UserData シートのユーザー行インデックス ---
+# get_all_records() でシート全体（全ユーザーの会話履歴を含む）を毎回ダウンロードしないよう、
+# 「ユーザー名 → 行番号」と「列名 → 列番号」の対応表をプロセス内で共有する。
+# UserData の行は追記のみで削除・並べ替えはしない前提なので、一度求めた行番号は変わらない。
+
+
+class UserIndex:
+    """UserData シートのユーザー名と行番号、列名と列番号の対応表"""
+
+    def __init__(self, sheet):
+        self.sheet = sheet
+        self.columns = {}
+        self.rows = {}
+        self.refresh(header=True)
+
+    def refresh(self, header=False):
+        """1列目（ユーザー名）だけを読み直して行番号を更新する"""
+        if header or not self.columns:
+            header_row = self.sheet.row_values(1)
+            self.columns = {name: i for i, name in enumerate(header_row, start=1) if name}
+        usernames = self.sheet.col_values(1)
+        rows = {}
+        for i, name in enumerate(usernames[1:], start=2):  # 1行目はヘッダー
+            if name and name not in rows:
+                rows[name] = i
+        self.rows = rows
+
+    def row_of(self, username):
+        return self.rows.get(username)
+
+    def col_of(self, column):
+        return self.columns.get(column)
+
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def _sheet_key(sheet):
+    return (sheet.spreadsheet.id, sheet.id)
+
+
+def get_user_index(sheet):
+    """シートごとのユーザーインデックスを返す（プロセス内で一度だけ構築）"""
+    key = _sheet_key(sheet)
+    with _lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = UserIndex(sheet)
+            _indexes[key] = index
+        else:
+            # Streamlit の再実行ごとに作り直されるワークシートを差し替えておく
+            index.sheet = sheet
+        return index
+
+
+def find_user_row(sheet, username):
+    """ユーザーの行番号を返す。見つからない場合は一度だけインデックスを読み直す"""
+    index = get_user_index(sheet)
+    row = index.row_of(username)
+    if row is None:
+        # 別プロセスで登録されたユーザーかもしれないので、1列目だけ取り直す
+        with _lock:
+            index.refresh()
+            row = index.row_of(username)
+    return row
+
+
+# --- 資格情報（パスワードのハッシュ）のキャッシュ ---
+# ハッシュ化済みの値だけを保持するので、メモリに置いても平文のパスワードは漏れない
+_credentials = {}
+
+
+def cached_credential(sheet, username):
+    return _credentials.get((_sheet_key(sheet), username))
+
+
+def cache_credential(sheet, username, stored):
+    if is_password_hash(stored):
+        _credentials[(_sheet_key(sheet), username)] = stored
+
+
+def invalidate_user_index(sheet=None):
+    """新規登録などで行が増えたときにインデックスを破棄する"""
+    with _lock:
+        if sheet is None:
+            _indexes.clear()
+        else:
+            _indexes.pop(_sheet_key(sheet), None)
+
+
+# --- セルへの追記の楽観的な同時実行制御 ---
+# 従来方式の "message" / "eval" セルは「読む → 連結する → 書く」ので、同じユーザーの2つのタブや
+# 複数のワーカーが同時に書くと、後から書いた方が先の追記を上書きして消してしまう。
+# UserData に "version" 列があれば、セルと一緒にその行の版を読み、書き込む直前に版を読み直して
+# 変わっていなければ書く（変わっていれば、読んでから書くまでの間に別の書き込みがあったので読み直してやり直す）。
+# 書き込みと同時にその行へ新しい版（ランダムな値）を書き、書き込み後にも版を読み直す。自分の版のままなら
+# 割り込みはない。別の書き込みに割り込まれていたらセルを読み直し、自分の追記が消えていれば最新の内容に
+# 追記し直す（上書きではなくマージする）。
+# 書く直前の確認と書き込みの間の短い隙間は残るので、多くのワーカーが同じユーザーに書く構成では
+# 追記のみの MessageLog（[storage] message_log）か SQLite を使う。
+
+logger = logging.getLogger(__name__)
+WRITE_ATTEMPTS = 5
+
+
+def _read_cells(sheet, keys):
+    value_ranges = sheet.batch_get([rowcol_to_a1(row, col) for row, col in keys])
+    return {key: value_range[0][0] if value_range and value_range[0] else ""
+            for key, value_range in zip(keys, value_ranges)}
+
+
+def write_cells(sheet, appends, overwrites=None):
+    """appends（{(行, 列): [追記するテキスト]}）を追記し、overwrites（{(行, 列): 値}）で上書きする"""
+    overwrites = dict(overwrites or {})
+    version_col = get_user_index(sheet).col_of("version")
+    pending = {key: texts for key, texts in appends.items() if texts}
+    for attempt in range(WRITE_ATTEMPTS):
+        rows = sorted({row for row, _ in list(pending) + list(overwrites)})
+        version_keys = [(row, version_col) for row in rows] if version_col and pending else []
+        current = _read_cells(sheet, list(pending) + version_keys) if pending else {}
+        version = uuid.uuid4().hex[:12]
+        written = {key: "\n".join(([current[key]] if current[key] else []) + texts) for key, texts in pending.items()}
+        updates = [{"range": rowcol_to_a1(*key), "values": [[value]]} for key, value in written.items()]
+        updates += [{"range": rowcol_to_a1(*key), "values": [[value]]} for key, value in overwrites.items()]
+        if version_col:
+            updates += [{"range": rowcol_to_a1(row, version_col), "values": [[version]]} for row in rows]
+        if version_keys:
+            # 読んだ時点の版のままのときだけ書く（変わっていれば、読んだ値をもとに書くと先の追記を消してしまう）
+            before = _read_cells(sheet, version_keys)
+            moved = sorted(row for row, col in version_keys if before[(row, col)] != current[(row, col)])
+            if moved:
+                logger.info("rows %s changed before write, rereading (attempt %d)", moved, attempt + 1)
+                time.sleep(random.uniform(0.05, 0.2) * (attempt + 1))
+                continue
+        if updates:
+            sheet.batch_update(updates, value_input_option="RAW")
+        if not version_keys:
+            return  # 版の列がない場合は従来どおり検証しない（上書きは最後の書き込みが残ればよい）
+
+        # 版が自分のものでない行は、読んでから書くまでの間か書いた後に別の書き込みがあった
+        versions = _read_cells(sheet, [(row, version_col) for row in rows])
+        conflicted = {row for row in rows if versions[(row, version_col)] != version}
+        if not conflicted:
+            return
+        # 後から追記されたセルは、自分が書いた値（読んだ値 + 自分の追記）そのものか、それに改行と続きを足した値になる。そうでなければ、
+        # 自分より前に読んだ値をもとにした書き込みで上書きされ、追記が消えている
+        # （同じテキストが以前から履歴にあっても、部分一致ではなく書いた値全体で確かめるので見逃さない）
+        check = [key for key in pending if key[0] in conflicted]
+        current = _read_cells(sheet, check)
+        pending = {key: pending[key] for key in check
+                   if current[key] != written[key] and not current[key].startswith(written[key] + "\n")}
+        if not pending:
+            return
+        overwrites = {}
+        logger.info("write conflict on rows %s, merging %d appends (attempt %d)", sorted(conflicted), len(pending), attempt + 1)
+        time.sleep(random.uniform(0.05, 0.2) * (attempt + 1))
+    raise RuntimeError(f"同時書き込みが続いたため追記できませんでした: {sorted(pending)}")
+
+
+# --- 保存先の共通インターフェース ---
+# アプリの user_exists / check_password / register_user / record_message / load_message は
+# このインターフェースを通して保存先（Google Sheets または SQLite）にアクセスする。
+
+
+class UserStore:
+    """ユーザー情報と会話履歴の保存先"""
+
+    def user_exists(self, username):
+        raise NotImplementedError
+
+    def check_password(self, username, password):
+        raise NotImplementedError
+
+    def register_user(self, username, password):
+        raise NotImplementedError
+
+    def record_message(self, username, new_message, where, chapter="", session_id="", timestamp=""):
+        raise NotImplementedError
+
+    def load_message(self, username, item):
+        raise NotImplementedError
+
+    def list_sessions(self, username):
+        """会話の索引（session_index.new_entry の一覧、新しい順）。本文は含まない"""
+        # 既定では連結形式の履歴から組み立てる（索引を別に持つ保存先は上書きする）
+        return index_blobs(self.load_message(username, "message"), self.load_message(username, "eval"))
+
+    def load_session(self, username, entry, memo=None):
+        """
+        索引の1件（list_sessions の要素）に対応するセッションの本文（「ユーザー: ...」「AI: ...」の行）。
+        memo は呼び出し側が保持する dict で、連結形式の履歴を一度だけ読み出して使い回すのに使う
+        """
+        if memo is None:
+            memo = {}
+        if "message" not in memo:
+            memo["message"] = self.load_message(username, "message")
+        return session_body(memo["message"], session_title(entry))
+
+    def load_scores(self, username):
+        """評価ごとの観点別スコア（scores.to_score_record の形式、古い順）"""
+        # 既定では連結形式の評価から取り出す（スコアを数値で保存している保存先は上書きする）
+        return [to_score_record("", *split_title(title), body)
+                for title, body in parse_eval_blocks(self.load_message(username, "eval"))]
+
+    def flush(self, username=None):
+        """遅延している書き込みを反映する（遅延のない保存先では何もしない）"""
+
+
+class SheetsUserStore(UserStore):
+    """Google Sheets（UserData シート、必要に応じて MessageLog シート）を使う保存先"""
+
+    def __init__(self, sheet, message_log=None, write_queue=None, score_log=None, session_log=None):
+        self.sheet = sheet
+        self.message_log = message_log
+        self.write_queue = write_queue
+        self.score_log = score_log
+        self.session_log = session_log
+
+    def user_exists(self, username):
+        return find_user_row(self.sheet, username) is not None
+
+    def check_password(self, username, password):
+        # キャッシュ済みのハッシュで照合できればシートにはアクセスしない
+        cached = cached_credential(self.sheet, username)
+        if cached and verify_password(password, cached):
+            return True
+
+        row = find_user_row(self.sheet, username)
+        if row is None:
+            return False
+        # ユーザーの行のユーザー名とパスワード（資格情報の列）だけを1回で取得する
+        password_col = get_user_index(self.sheet).col_of("password")
+        values = self.sheet.get(f"A{row}:{rowcol_to_a1(row, password_col)}")
+        cells = values[0] if values else []
+        if not cells or cells[0] != username:
+            return False
+        stored = cells[password_col - 1] if len(cells) >= password_col else ""
+        if not verify_password(password, stored):
+            return False
+
+        # 以前の平文パスワードはログイン成功時にハッシュへ置き換える
+        if not is_password_hash(stored):
+            stored = hash_password(password)
+            self.sheet.update_cell(row, password_col, stored)
+        cache_credential(self.sheet, username, stored)
+        return True
+
+    def register_user(self, username, password):
+        if self.user_exists(username):
+            return False
+        # ヘッダーに合わせて5列分のデータを持つ行を追加する（パスワードはハッシュで保存）
+        stored = hash_password(password)
+        self.sheet.append_row([username, stored, "", "", ""])
+        invalidate_user_index(self.sheet)
+        cache_credential(self.sheet, username, stored)
+        return True
+
+    def record_message(self, username, new_message, where, chapter="", session_id="", timestamp=""):
+        # 対象の列がなければ何もしない
+        if where not in ("message", "eval", "player_summary"):
+            return
+        # 遅延反映が有効な場合はキューに積むだけで戻る
+        if self.write_queue is not None:
+            self.write_queue.put(username, where, new_message, chapter, session_id, timestamp)
+            return
+        # 評価のスコアは、ここで一度だけ本文から取り出して Scores シートに数値で保存する
+        if where == "eval" and self.score_log is not None:
+            record = to_score_record(session_id, chapter, timestamp, new_message)
+            self.score_log.append_rows([self.score_log.row_for(username, record)])
+        # 会話の索引は、本文を含まない小さな行として SessionIndex シートに追記する
+        if self.session_log is not None:
+            self.session_log.append_rows(self.session_log.rows_for(username, chapter, session_id, timestamp, where, new_message))
+        # ログシート方式では、1発言・1評価ずつ行を追記するだけ（既存の履歴は読まない）
+        if self.message_log is not None and where != "player_summary":
+            self.message_log.append(username, chapter, session_id, timestamp, where, new_message)
+            return
+        col_index = get_user_index(self.sheet).col_of(where)
+        row = find_user_row(self.sheet, username)
+        if not col_index or row is None:
+            return
+
+        # player_summaryは追記ではなく、常に新しい内容で上書きする
+        if where == "player_summary":
+            self.sheet.update_cell(row, col_index, new_message)
+        else:  # messageとevalは従来通り追記（同時に書かれても追記が消えないよう版を確かめる）
+            write_cells(self.sheet, {(row, col_index): [new_message]})
+
+    def load_message(self, username, item):
+        stored = self._load_stored(username, item)
+        # まだキューに残っている書き込みも結果に重ねる
+        pending = self.write_queue.pending(username, item) if self.write_queue is not None else []
+        if not pending:
+            return stored
+        if item == "player_summary":
+            return pending[-1]
+        return "\n".join(([stored] if stored else []) + pending)
+
+    def _load_stored(self, username, item):
+        # ログシート方式では、そのユーザーの行だけを取得して従来と同じ形式に組み立てる
+        if self.message_log is not None and item != "player_summary":
+            return self.message_log.load(username, item)
+        col_index = get_user_index(self.sheet).col_of(item)
+        row = find_user_row(self.sheet, username)
+        if not col_index or row is None:
+            return ""
+        return self.sheet.cell(row, col_index).value or ""
+
+    def list_sessions(self, username):
+        if self.session_log is None:
+            return self._build_index(username)
+        # 索引は SessionIndex シートのそのユーザーの行だけから作る（本文は読まない）
+        rows = self.session_log.fetch_rows(username)
+        pending = [row for item in self._pending_items(username, "session_log")
+                   for row in self.session_log.rows_for(username, item["chapter"], item["session_id"],
+                                                        item["timestamp"], item["where"], item["text"])]
+        if not is_backfilled(rows):
+            # シートを使い始める前の履歴は、ユーザーごとに一度だけ従来の方法で索引にしてシートに書き込む
+            known = {row[1] for row in rows + pending} | {(row[2], row[3]) for row in rows + pending}
+            legacy = [e for e in self._build_index(username, include_pending=False)
+                      if e["key"] not in known and (e["chapter"], e["timestamp"]) not in known]
+            backfill = self.session_log.backfill_rows(username, legacy[::-1])  # 古い順に書く
+            self.session_log.append_rows(backfill)
+            rows = backfill + rows
+        return index_log_rows(rows + pending)
+
+    def _build_index(self, username, include_pending=True):
+        """会話の本文を含む履歴から索引を作る（SessionIndex シートを使わない場合と、使い始める前の履歴）"""
+        if self.message_log is not None:
+            rows = self.message_log.fetch_rows(username)
+            if include_pending:
+                rows += self._pending_log_rows(username)
+            return index_rows(rows)
+        load = self.load_message if include_pending else self._load_stored
+        return index_blobs(load(username, "message"), load(username, "eval"))
+
+    def load_session(self, username, entry, memo=None):
+        if self.message_log is None:
+            return super().load_session(username, entry, memo)
+        # ログシート方式では、そのセッションの行だけを読み出す
+        rows = self.message_log.fetch_session_rows(username, entry["key"])
+        rows += [row for row in self._pending_log_rows(username) if session_key(*row[1:4]) == entry["key"]]
+        return format_session_rows(rows)
+
+    def _pending_items(self, username, sink):
+        """キューに残っていて、まだ sink（書き込み先）に反映されていない書き込み"""
+        if self.write_queue is None:
+            return []
+        return [item for item in self.write_queue.pending_items(username)
+                if item["where"] != "player_summary" and sink not in item.get("done", [])]
+
+    def _pending_log_rows(self, username):
+        return [row for item in self._pending_items(username, "message_log")
+                for row in to_log_rows(username, item["chapter"], item["session_id"],
+                                       item["timestamp"], item["where"], item["text"])]
+
+    def load_scores(self, username):
+        if self.score_log is None:
+            return super().load_scores(username)
+        records = self.score_log.fetch(username)
+        # まだキューに残っている評価のスコアも結果に重ねる
+        if self.write_queue is not None:
+            records += [to_score_record("", "", "", text) for text in self.write_queue.pending(username, "eval")]
+        return records
+
+    def flush(self, username=None):
+        if self.write_queue is not None:
+            self.write_queue.flush(username)
+
+
+_stores = {}
+
+
+def get_sqlite_store(path):
+    """SQLite の保存先をパスごとにプロセス内で共有する"""
+    from sqlite_store import SQLiteUserStore
+
+    with _lock:
+        store = _stores.get(path)
+        if store is None:
+            store = SQLiteUserStore(path)
+            _stores[path] = store
+        return store
@@ -0,0 +1,89 @@
+import logging
+import os
+import threading
+import unicodedata
+
+logger = logging.getLogger(__name__)
+
+# --- 「言葉の意味を調べる」の段階的な検索 ---
+# 単語の意味のヒントはプロンプトが単語だけで決まるのに、毎回モデルを呼んでいた。
+# 1. 同梱の辞書ファイル（起動時に一度だけ読み込んで dict にする）
+# 2. 過去のモデルの回答のキャッシュ（PromptCache。ファイルに保存され、プロセス間でも共有される）
+# の順に引き、どちらにもない場合だけモデルを呼んで、その回答をキャッシュに入れる。
+# 辞書ファイルの形式: 1行に「単語<TAB>意味」。意味の中の改行は \n と書く。# で始まる行は無視する。
+
+TIERS = ("dictionary", "cache", "model")
+LOG_EVERY = 50
+
+
+def normalize_word(word):
+    """全角・半角の揺れと前後の空白・かぎ括弧、英字の大小を無視する"""
+    return unicodedata.normalize("NFKC", word).strip().strip("「」『』\"'").lower()
+
+
+def load_dictionary(path):
+    entries = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line or line.startswith("#") or "\t" not in line:
+                continue
+            word, meaning = line.split("\t", 1)
+            entries[normalize_word(word)] = meaning.replace("\\n", "\n")
+    return entries
+
+
+class WordLookup:
+    """辞書・回答のキャッシュ・モデルの順に単語の意味を引き、どこで見つかったかを数える"""
+
+    def __init__(self, dictionary, cache=None):
+        self.dictionary = dictionary  # {正規化した単語: 意味}
+        self.cache = cache            # PromptCache（なければ回答は保存しない）
+        self.counts = dict.fromkeys(TIERS, 0)
+        self._lock = threading.Lock()
+
+    def lookup(self, word, key, ask_model):
+        """
+        key は回答のキャッシュのキー（プロンプトとモデルから作る）、ask_model は両方になかったときの呼び出しで、
+        (意味, 保存してよいか) を返す（代わりのモデルの回答は key のモデルのものとして保存しない）
+        """
+        meaning = self.dictionary.get(normalize_word(word))
+        tier = "dictionary"
+        if meaning is None and self.cache is not None:
+            meaning = self.cache.get(key)
+            tier = "cache"
+        if meaning is None:
+            meaning, cacheable = ask_model()
+            tier = "model"
+            if self.cache is not None and cacheable:
+                self.cache.put(key, meaning)
+        self._count(tier)
+        return meaning
+
+    def _count(self, tier):
+        with self._lock:
+            self.counts[tier] += 1
+            total = sum(self.counts.values())
+            if total % LOG_EVERY == 0:
+                logger.info("word lookup: total=%d dictionary=%d cache=%d model=%d hit_rate=%.2f",
+                            total, self.counts["dictionary"], self.counts["cache"], self.counts["model"],
+                            1 - self.counts["model"] / total)
+
+
+_lookups = {}
+_lookups_lock = threading.Lock()
+
+
+def get_word_lookup(dictionary_path, cache=None):
+    """辞書ファイルごとの WordLookup をプロセス内で共有する（辞書ファイルがなければ空の辞書で動く）"""
+    with _lookups_lock:
+        lookup = _lookups.get(dictionary_path)
+        if lookup is None:
+            if os.path.exists(dictionary_path):
+                dictionary = load_dictionary(dictionary_path)
+            else:
+                logger.warning("word dictionary not found: %s", dictionary_path)
+                dictionary = {}
+            lookup = WordLookup(dictionary, cache)
+            _lookups[dictionary_path] = lookup
+        return lookup
@@ -0,0 +1,213 @@
+import atexit
+import json
+import logging
+import os
+import threading
+from user_store import get_user_index, find_user_row, write_cells
+from scores import to_score_record
+
+logger = logging.getLogger(__name__)
+
+# --- 書き込みの遅延・一括反映（write-behind） ---
+# record_message の書き込みをキューに積んですぐに戻り、バックグラウンドのスレッドが
+# 一定間隔または一定件数ごとにまとめて Google Sheets へ反映する。
+# キューの内容はスプールファイル（JSON Lines）にも書き出し、プロセスが再起動しても失われないようにする。
+
+
+class WriteBehindQueue:
+    """ユーザーごとの message / eval / player_summary の書き込みをまとめて反映するキュー"""
+
+    def __init__(self, writer, spool_path, interval=2.0, max_pending=20):
+        self.writer = writer
+        self.spool_path = spool_path
+        self.interval = interval
+        self.max_pending = max_pending
+        self._items = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._load_spool()
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def put(self, username, where, text, chapter="", session_id="", timestamp=""):
+        item = {"username": username, "where": where, "text": text,
+                "chapter": chapter, "session_id": session_id, "timestamp": timestamp}
+        with self._lock:
+            self._items.append(item)
+            self._append_spool(item)
+            size = len(self._items)
+        if size >= self.max_pending:
+            self._wakeup.set()
+
+    def pending(self, username, where):
+        """まだ反映されていない書き込み（読み出し時に結果へ重ねるため）"""
+        with self._lock:
+            return [item["text"] for item in self._items
+                    if item["username"] == username and item["where"] == where]
+
+    def pending_items(self, username):
+        """まだ反映し終えていない書き込みの写し（反映済みの書き込み先 "done" を含む）"""
+        with self._lock:
+            return [dict(item) for item in self._items if item["username"] == username]
+
+    def flush(self, username=None):
+        """キューの内容を反映する。username を指定するとそのユーザーの分だけ反映する"""
+        with self._flush_lock:
+            with self._lock:
+                batch = [item for item in self._items if username is None or item["username"] == username]
+            if not batch:
+                return
+            try:
+                self.writer.write(batch)
+            except Exception:
+                # 途中まで反映できた書き込みは、反映済みの書き込み先（item["done"]）をスプールにも残し、
+                # 次の周期で同じ行を重ねて追記しないようにする
+                with self._lock:
+                    self._rewrite_spool()
+                raise
+            with self._lock:
+                done = {id(item) for item in batch}
+                self._items = [item for item in self._items if id(item) not in done]
+                self._rewrite_spool()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                # 反映に失敗した書き込みはキューとスプールに残り、次の周期で再試行される
+                logger.exception("write-behind flush failed")
+
+    # --- スプールファイル ---
+    def _load_spool(self):
+        if not os.path.exists(self.spool_path):
+            return
+        with open(self.spool_path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    self._items.append(json.loads(line))
+        if self._items:
+            logger.info("restored %d queued writes from %s", len(self._items), self.spool_path)
+
+    def _append_spool(self, item):
+        with open(self.spool_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _rewrite_spool(self):
+        tmp_path = self.spool_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for item in self._items:
+                f.write(json.dumps(item, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.spool_path)
+
+
+class SheetsBatchWriter:
+    """
+    キューに溜まった書き込みを、まとめた少数のリクエストで Google Sheets に反映する。
+    書き込み先（message_log / score_log / session_log / cells）は1つずつ反映し、反映できた先を各 item の "done" に記録する。
+    途中の書き込み先で失敗して同じ item を再試行するときは、反映済みの書き込み先を飛ばす。
+    """
+
+    def __init__(self, sheet, message_log=None, score_log=None, session_log=None):
+        self.sheet = sheet
+        self.message_log = message_log
+        self.score_log = score_log
+        self.session_log = session_log
+
+    def write(self, items):
+        log_rows, log_items = [], []
+        score_rows, score_items = [], []
+        session_rows, session_items = [], []
+        appends = {}    # (username, where) -> 追記するテキストのリスト
+        overwrites = {} # (username, where) -> 最後に書き込まれた値
+        cell_items = []
+        for item in items:
+            done = item.get("done", [])
+            key = (item["username"], item["where"])
+            if item["where"] == "eval" and self.score_log is not None and "score_log" not in done:
+                record = to_score_record(item["session_id"], item["chapter"], item["timestamp"], item["text"])
+                score_rows.append(self.score_log.row_for(item["username"], record))
+                score_items.append(item)
+            if item["where"] != "player_summary" and self.session_log is not None and "session_log" not in done:
+                session_rows.extend(self.session_log.rows_for(
+                    item["username"], item["chapter"], item["session_id"],
+                    item["timestamp"], item["where"], item["text"]))
+                session_items.append(item)
+            if item["where"] == "player_summary":
+                if "cells" not in done:
+                    overwrites[key] = item["text"]
+                    cell_items.append(item)
+            elif self.message_log is not None:
+                if "message_log" not in done:
+                    log_rows.extend(self.message_log.rows_for(
+                        item["username"], item["chapter"], item["session_id"],
+                        item["timestamp"], item["where"], item["text"]))
+                    log_items.append(item)
+            elif "cells" not in done:
+                appends.setdefault(key, []).append(item["text"])
+                cell_items.append(item)
+
+        if log_rows:
+            self.message_log.append_rows(log_rows)
+        self._mark(log_items, "message_log")
+        if score_rows:
+            self.score_log.append_rows(score_rows)
+        self._mark(score_items, "score_log")
+        if session_rows:
+            self.session_log.append_rows(session_rows)
+        self._mark(session_items, "session_log")
+        if appends or overwrites:
+            self._write_cells(appends, overwrites)
+        self._mark(cell_items, "cells")
+
+    @staticmethod
+    def _mark(items, sink):
+        for item in items:
+            item.setdefault("done", []).append(sink)
+
+    def _write_cells(self, appends, overwrites):
+        index = get_user_index(self.sheet)
+        cells = {}
+        for username, where in list(appends) + list(overwrites):
+            row = find_user_row(self.sheet, username)
+            col = index.col_of(where)
+            if row is not None and col:
+                cells[(username, where)] = (row, col)
+            else:
+                # 行・列がなければ書き込み先がないので、再試行せずに捨てる（内容はログに残す）
+                texts = appends.get((username, where)) or [overwrites.get((username, where))]
+                logger.warning("write-behind dropped %d write(s): user=%s where=%s row=%s col=%s texts=%r",
+                               len(texts), username, where, row, col, texts)
+
+        # 追記する列の読み出しと書き込みは、版を確かめながらまとめて行う（user_store.write_cells）
+        write_cells(self.sheet,
+                    {cells[key]: texts for key, texts in appends.items() if key in cells},
+                    {cells[key]: value for key, value in overwrites.items() if key in cells})
+
+_queues = {}
+def spool_path_for(app, spreadsheet_id, directory="."):
+    """
+    アプリとスプレッドシートごとのスプールファイルのパス。同じ作業ディレクトリで動く別のアプリ
+    （日本語版・英語版など）や別のスプレッドシートのキューが、互いの書き込みを読み込んで反映し直さないようにする
+    """
+    return os.path.join(directory, f"write_behind_spool_{app}_{spreadsheet_id}.jsonl")
+
+
+_queues_lock = threading.Lock()
+
+
+def get_write_behind(key, factory):
+    """プロセス内で1つだけキューを作り、Streamlit の再実行をまたいで共有する"""
+    with _queues_lock:
+        queue = _queues.get(key)
+        if queue is None:
+            queue = factory()
+            _queues[key] = queue
+        return queue